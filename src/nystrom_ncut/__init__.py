@@ -7,9 +7,36 @@ from .nystrom import (
 from .transformer import (
     AxisAlign,
 )
+from .global_settings import (
+    CHUNK_PLANNER,
+    ChunkPlan,
+    ChunkPlanner,
+    DtypePolicy,
+    MIXED_PRECISION_POLICY,
+    register_chunk_plan_hook,
+)
 from .distance_utils import (
+    QuantileSketch,
     distance_from_features,
     affinity_from_features,
+    get_normalization_factor,
+)
+from .index_utils import (
+    IVFIndex,
+)
+from .parallel_utils import (
+    persistent_worker_pool,
+)
+from .profiler import (
+    CallbackSink,
+    JSONLinesSink,
+    ProfilerSink,
+    RecordFunctionSink,
+    SpanRecord,
+    add_sink,
+    current_span,
+    profiling,
+    span,
 )
 from .sampling_utils import (
     SampleConfig,
@@ -0,0 +1,329 @@
+"""Benchmark suite for fit, update and transform across shapes and solvers.
+
+Every case runs in a fresh process so that peak RSS is measured per case, results are written as JSON lines
+that can be compared between commits:
+    python -m nystrom_ncut.benchmark run --output before.jsonl --quick
+    python -m nystrom_ncut.benchmark run --output after.jsonl --quick --grid '{"n": [20000], "eig_solver": ["svd"]}'
+    python -m nystrom_ncut.benchmark compare before.jsonl after.jsonl --threshold 1.1
+"""
+import argparse
+import concurrent.futures
+import copy
+import dataclasses
+import itertools
+import json
+import multiprocessing
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Literal, Tuple
+
+import numpy as np
+import torch
+
+from .profiler import (
+    peak_rss_bytes,
+)
+
+
+TargetOptions = Literal[
+    "fit_transform", "update", "transform", "extrapolate_knn", "axis_align",
+    "rgb_from_tsne_2d", "rgb_from_tsne_3d", "rgb_from_euclidean_tsne_3d",
+    "rgb_from_umap_2d", "rgb_from_umap_3d", "rgb_from_umap_sphere",
+]
+ModelOptions = Literal["nystrom", "kernel"]
+MODEL_TARGETS = ("fit_transform", "update", "transform")
+BATCHED_TARGETS = MODEL_TARGETS + ("axis_align",)
+CASE_METRICS = ("wall_time", "wall_time_min", "throughput", "peak_rss_mb", "setup_rss_mb")
+
+
+@dataclass(frozen=True)
+class BenchmarkCase:
+    target: TargetOptions = "fit_transform"
+    model: ModelOptions = "nystrom"
+    n: int = 10000
+    d: int = 128
+    batch_shape: Tuple[int, ...] = ()
+    num_sample: int = 1000
+    n_components: int = 20
+    eig_solver: str = "svd_lowrank"
+    sample_method: str = "random"
+    affinity_type: str = "cosine"
+    repeat: int = 3
+    seed: int = 0
+
+    def key(self) -> str:
+        return json.dumps({k: v for k, v in dataclasses.asdict(self).items() if k != "repeat"}, sort_keys=True)
+
+    def canonicalize(self) -> "BenchmarkCase":
+        """Clears the fields a target does not depend on, so that grid sweeps do not repeat equivalent cases."""
+        changes = {"num_sample": min(self.num_sample, self.n)}
+        if self.target not in MODEL_TARGETS:
+            changes.update(model=None, eig_solver=None, sample_method=None)
+        elif self.model == "kernel":
+            changes.update(eig_solver=None)
+        if self.target == "axis_align":
+            changes.update(d=None, num_sample=None, affinity_type=None)
+        elif self.target.startswith("rgb_"):
+            changes.update(n_components=None)
+        if self.target not in BATCHED_TARGETS:
+            changes.update(batch_shape=())
+        return dataclasses.replace(self, **changes)
+
+
+QUICK_GRID: Dict[str, List[Any]] = {
+    "target": ["fit_transform", "update", "transform", "extrapolate_knn", "axis_align"],
+    "model": ["nystrom", "kernel"],
+    "n": [10000],
+    "d": [128],
+    "batch_shape": [()],
+    "num_sample": [1000],
+    "n_components": [20],
+    "eig_solver": ["svd_lowrank"],
+    "sample_method": ["random"],
+    "affinity_type": ["cosine"],
+}
+DEFAULT_GRID: Dict[str, List[Any]] = {
+    "target": list(TargetOptions.__args__),
+    "model": ["nystrom", "kernel"],
+    "n": [10000, 100000],
+    "d": [128, 768],
+    "batch_shape": [(), (4,)],
+    "num_sample": [1000, 10000],
+    "n_components": [20, 100],
+    "eig_solver": ["svd_lowrank", "lobpcg", "svd", "eigh"],
+    "sample_method": ["random", "fps"],
+    "affinity_type": ["cosine", "rbf"],
+}
+
+
+def iterate_cases(grid: Dict[str, List[Any]], repeat: int = 3, seed: int = 0) -> Iterator[BenchmarkCase]:
+    keys = list(grid.keys())
+    seen = set()
+    for values in itertools.product(*(grid[k] for k in keys)):
+        kwargs = dict(zip(keys, values))
+        kwargs["batch_shape"] = tuple(kwargs.get("batch_shape", ()))
+        case = BenchmarkCase(repeat=repeat, seed=seed, **kwargs).canonicalize()
+        if case.key() not in seen:
+            seen.add(case.key())
+            yield case
+
+
+def _peak_rss_mb() -> float:
+    rss = peak_rss_bytes()
+    return None if rss is None else rss / 2 ** 20
+
+
+def _build_model(case: BenchmarkCase):
+    from . import KernelNCut, NystromNCut, SampleConfig
+
+    sample_config = SampleConfig(method=case.sample_method, num_sample=case.num_sample)
+    match case.model:
+        case "nystrom":
+            return NystromNCut(
+                n_components=case.n_components,
+                affinity_type=case.affinity_type,
+                sample_config=sample_config,
+                eig_solver=case.eig_solver,
+            )
+        case "kernel":
+            return KernelNCut(
+                n_components=case.n_components,
+                affinity_type=case.affinity_type,
+                sample_config=sample_config,
+            )
+        case _:
+            raise ValueError(f"Model {case.model} not recognized.")
+
+
+def _reused(fn: Callable[[], Any]) -> Callable[[], Callable[[], Any]]:
+    # setup of targets that leave their state unchanged, every repeat times the same closure
+    return lambda: fn
+
+
+def _prepare(case: BenchmarkCase) -> Tuple[Callable[[], Callable[[], Any]], int]:
+    """Runs the untimed setup of a case.
+    Returns:
+        (Callable[[], Callable[[], Any]]): untimed per-repeat setup that returns the timed closure
+        (int): number of points processed by one call of the closure
+    """
+    from . import visualize_utils
+    from .transformer import AxisAlign
+
+    features = torch.randn((*case.batch_shape, case.n, case.d or case.n_components))
+    n_points = int(np.prod(case.batch_shape, dtype=np.int64)) * case.n
+
+    match case.target:
+        case "fit_transform":
+            model = _build_model(case)
+            return _reused(lambda: model.fit_transform(features)), n_points
+        case "update":
+            model = _build_model(case)
+            model.fit(features)
+            new_features = torch.randn_like(features)
+
+            # update accumulates into the model, so every repeat starts from a copy of the fitted model
+            def setup() -> Callable[[], Any]:
+                _model = copy.deepcopy(model)
+                return lambda: _model.update(new_features)
+            return setup, n_points
+        case "transform":
+            model = _build_model(case)
+            model.fit(features)
+            return _reused(lambda: model.transform(features)), n_points
+        case "extrapolate_knn":
+            anchor_features = features[torch.randperm(case.n)[:case.num_sample]]
+            anchor_output = torch.randn((case.num_sample, case.n_components))
+            return _reused(lambda: visualize_utils.extrapolate_knn(
+                anchor_features, anchor_output, features, case.affinity_type,
+            )), n_points
+        case "axis_align":
+            return _reused(lambda: AxisAlign().fit(features)), n_points
+        case _ if case.target.startswith("rgb_"):
+            rgb_func = getattr(visualize_utils, case.target)
+            return _reused(lambda: rgb_func(features, num_sample=case.num_sample, affinity_type=case.affinity_type)), n_points
+        case _:
+            raise ValueError(f"Target {case.target} not recognized.")
+
+
+def run_case(case: BenchmarkCase) -> Dict[str, Any]:
+    """Runs a single case in the current process, peak RSS is only meaningful in a fresh process."""
+    record = {**dataclasses.asdict(case), "key": case.key()}
+    torch.manual_seed(case.seed)
+    try:
+        setup, n_points = _prepare(case)
+    except ImportError as e:
+        return {**record, "status": "skipped", "error": str(e)}
+    record["setup_rss_mb"] = _peak_rss_mb()
+
+    wall_times = []
+    try:
+        for _ in range(case.repeat):
+            fn = setup()
+            t0 = time.perf_counter()
+            fn()
+            wall_times.append(time.perf_counter() - t0)
+    except ImportError as e:
+        return {**record, "status": "skipped", "error": str(e)}
+    except Exception as e:
+        return {**record, "status": "error", "error": repr(e)}
+
+    record.update({
+        "status": "ok",
+        "wall_time": statistics.median(wall_times),
+        "wall_time_min": min(wall_times),
+        "throughput": n_points / statistics.median(wall_times),
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+    return record
+
+
+def _run_case_from_dict(case: Dict[str, Any]) -> Dict[str, Any]:
+    return run_case(BenchmarkCase(**{**case, "batch_shape": tuple(case["batch_shape"])}))
+
+
+def _metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+def run(cases: List[BenchmarkCase], output: str) -> List[Dict[str, Any]]:
+    """Runs every case in its own spawned process and appends the results to `output` as JSON lines."""
+    metadata = _metadata()
+    records = []
+    context = multiprocessing.get_context("spawn")
+    with open(output, "a") as fp:
+        for i, case in enumerate(cases):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                future = executor.submit(_run_case_from_dict, dataclasses.asdict(case))
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = {**dataclasses.asdict(case), "key": case.key(), "status": "error", "error": repr(e)}
+            record.update(metadata)
+            records.append(record)
+            fp.write(json.dumps(record) + "\n")
+            fp.flush()
+            print(f"[{i + 1}/{len(cases)}] {record['status']:>7} {case.key()} "
+                  f"{record.get('wall_time', float('nan')):.4f}s {record.get('peak_rss_mb') or float('nan'):.0f}MB")
+    return records
+
+
+def load_results(path: str) -> Dict[str, Dict[str, Any]]:
+    with open(path) as fp:
+        records = [json.loads(line) for line in fp if line.strip()]
+    # Later records of the same case take precedence
+    return {record["key"]: record for record in records if record["status"] == "ok"}
+
+
+def compare(baseline: str, candidate: str, metric: str = "wall_time", threshold: float = 1.1) -> List[Dict[str, Any]]:
+    """
+    Args:
+        baseline (str): results file of the reference commit
+        candidate (str): results file of the commit under test
+        metric (str): metric to compare, higher ratios are regressions except for throughput
+        threshold (float): ratio above which a case is reported as a regression
+    Returns:
+        (List[Dict[str, Any]]): cases present in both files with their candidate / baseline ratio
+    """
+    baseline_records, candidate_records = load_results(baseline), load_results(candidate)
+    comparison = []
+    for key in sorted(baseline_records.keys() & candidate_records.keys()):
+        if baseline_records[key][metric] is None or candidate_records[key][metric] is None:
+            continue
+        ratio = candidate_records[key][metric] / baseline_records[key][metric]
+        if metric == "throughput":
+            ratio = 1 / ratio
+        comparison.append({"key": key, "baseline": baseline_records[key][metric],
+                           "candidate": candidate_records[key][metric], "ratio": ratio,
+                           "regression": ratio > threshold})
+    return comparison
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m nystrom_ncut.benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run a benchmark grid")
+    run_parser.add_argument("--output", required=True, help="JSON lines file the results are appended to")
+    run_parser.add_argument("--quick", action="store_true", help="start from the small grid instead of the full sweep")
+    run_parser.add_argument("--grid", default="{}", help="JSON object of field -> list of values overriding the grid")
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--seed", type=int, default=0)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--metric", default="wall_time", choices=CASE_METRICS)
+    compare_parser.add_argument("--threshold", type=float, default=1.1)
+
+    args = parser.parse_args(argv)
+    match args.command:
+        case "run":
+            grid = {**(QUICK_GRID if args.quick else DEFAULT_GRID), **json.loads(args.grid)}
+            run(list(iterate_cases(grid, repeat=args.repeat, seed=args.seed)), args.output)
+            return 0
+        case "compare":
+            comparison = compare(args.baseline, args.candidate, metric=args.metric, threshold=args.threshold)
+            for row in comparison:
+                flag = "REGRESSION" if row["regression"] else ""
+                print(f"{row['ratio']:6.3f}x {row['baseline']:10.4f} -> {row['candidate']:10.4f} {flag:>10} {row['key']}")
+            return int(any(row["regression"] for row in comparison))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
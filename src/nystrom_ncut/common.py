@@ -1,4 +1,5 @@
-from typing import Any
+import os
+from typing import Any, Callable, Dict, Iterable, Iterator, Union
 
 import numpy as np
 import torch
@@ -9,15 +10,97 @@ def ceildiv(a: int, b: int) -> int:
     return -(-a // b)
 
 
+def fwht(x: torch.Tensor) -> torch.Tensor:
+    """Orthonormal fast Walsh-Hadamard transform along the last dim in O(p log p).
+    Args:
+        x (torch.Tensor): input, shape (..., p) with p a power of 2
+    Returns:
+        (torch.Tensor): H @ x with H the normalized [p x p] Hadamard matrix, shape (..., p)
+    """
+    shape, p = x.shape, x.shape[-1]
+    h = 1
+    while h < p:
+        x = x.reshape((*shape[:-1], p // (2 * h), 2, h))
+        x = torch.stack((x[..., 0, :] + x[..., 1, :], x[..., 0, :] - x[..., 1, :]), dim=-2)
+        h *= 2
+    return x.reshape(shape) * (p ** -0.5)
+
+
+ChunkSource = Union[torch.Tensor, np.ndarray, Iterable[torch.Tensor], Callable[[], Iterable[torch.Tensor]]]
+
+
+def iterate_chunks(source: ChunkSource, chunk_size: int) -> Iterator[torch.Tensor]:
+    """Iterate over a feature source along dim -2 without loading all of it.
+    Args:
+        source: tensor or numpy array (e.g. np.memmap) of shape (..., n_samples, n_features) that is sliced lazily,
+            or a re-iterable of chunks of shape (..., chunk_size, n_features) that are yielded as they are,
+            or a zero-argument function returning a fresh iterator over such chunks
+        chunk_size (int): number of rows per chunk when slicing an array source
+    Returns:
+        (Iterator[torch.Tensor]): chunks of shape (..., chunk_size, n_features)
+    """
+    if isinstance(source, torch.Tensor):
+        for start in range(0, source.shape[-2], chunk_size):
+            yield propagate_normalized(source, source[..., start:start + chunk_size, :])
+    elif isinstance(source, np.ndarray):
+        for start in range(0, source.shape[-2], chunk_size):
+            yield torch.from_numpy(np.array(source[..., start:start + chunk_size, :]))
+    else:
+        for chunk in (source() if callable(source) else source):
+            yield torch.as_tensor(chunk)
+
+
+def check_reiterable(source: ChunkSource) -> None:
+    """Raises a TypeError for one-shot iterators (e.g. generators), which are exhausted after a single traversal."""
+    if not isinstance(source, (torch.Tensor, np.ndarray)) and not callable(source) and iter(source) is source:
+        raise TypeError(
+            f"source of type {type(source).__name__} can only be traversed once, pass a re-iterable "
+            "(e.g. a list or DataLoader) or a zero-argument function that returns a fresh iterator"
+        )
+
+
+def _version(x: torch.Tensor) -> int:
+    try:
+        return x._version
+    except RuntimeError:
+        # inference tensors do not track in-place modifications
+        return None
+
+
+def mark_normalized(x: torch.Tensor) -> torch.Tensor:
+    """Records on `x` that its rows are L2-normalized along dim -1, until `x` or its base is modified in place.
+    Only tensors created by the library are marked, never the tensors passed in by the caller.
+    """
+    x._normalized_version = _version(x)
+    return x
+
+
+def is_normalized(x: torch.Tensor) -> bool:
+    version = getattr(x, "_normalized_version", None)
+    return version is not None and version == _version(x)
+
+
+def propagate_normalized(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    """Carries the mark of `x` over to `y`, a selection of whole rows of `x`."""
+    return mark_normalized(y) if is_normalized(x) else y
+
+
 def lazy_normalize(x: torch.Tensor, n: int = 1000, **normalize_kwargs: Any) -> torch.Tensor:
-    numel = np.prod(x.shape[:-1])
-    n = min(n, numel)
-    random_indices = torch.randperm(numel, device=x.device)[:n]
-    _x = x.view((-1, x.shape[-1]))[random_indices]
-    if torch.allclose(torch.norm(_x, **normalize_kwargs), torch.ones(n, device=x.device)):
+    # rows normalized along the last dim are marked, so that chunks and later calls skip the check. The sampled check
+    # is a heuristic, so an input that passes it is returned as a marked alias rather than marking the caller's tensor
+    markable = normalize_kwargs.get("p", 2.0) == 2.0 and normalize_kwargs.get("dim", 1) in (-1, x.ndim - 1)
+    if markable and is_normalized(x):
         return x
+
+    numel = int(np.prod(x.shape[:-1]))
+    n = min(n, numel)
+    random_indices = torch.randint(max(numel, 1), (n,), device=x.device)
+    _x = x.reshape((-1, x.shape[-1]))[random_indices]
+    if torch.allclose(torch.norm(_x, **normalize_kwargs), torch.ones(n, device=x.device, dtype=x.dtype)):
+        result = x.view_as(x) if markable else x
     else:
-        return Fn.normalize(x, **normalize_kwargs)
+        result = Fn.normalize(x, **normalize_kwargs)
+    return mark_normalized(result) if markable else result
 
 
 def quantile_min_max(x: torch.Tensor, q1: float, q2: float, n_sample: int = 10000):
@@ -58,6 +141,81 @@ def quantile_normalize(x: torch.Tensor, q: float = 0.95):
     return x
 
 
+class StateDictMixin:
+    """Mixin that serializes public attributes, recursing into nested StateDictMixin objects.
+
+    State dicts only hold tensors, python scalars, strings, lists and dicts so that they load with
+    `torch.load(weights_only=True)`, and `load(path, mmap=True)` maps the saved tensors instead of reading them,
+    letting many processes share the same physical pages. Attributes starting with an underscore are not saved.
+    """
+    _registry: Dict[str, type] = {}
+
+    def __init_subclass__(cls, **kwargs: Any):
+        super().__init_subclass__(**kwargs)
+        StateDictMixin._registry[cls.__name__] = cls
+
+    def state_dict(self) -> Dict[str, Any]:
+        state_dict = {"__class__": type(self).__name__}
+        for k, v in vars(self).items():
+            if not k.startswith("_"):
+                state_dict[k] = _to_state(v)
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> "StateDictMixin":
+        for k, v in state_dict.items():
+            if k != "__class__":
+                setattr(self, k, _from_state(v))
+        return self
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(
+        cls,
+        path: Union[str, os.PathLike],
+        mmap: bool = True,
+        map_location: Union[str, torch.device] = None,
+    ) -> "StateDictMixin":
+        """
+        Args:
+            path: file written by `save`
+            mmap (bool): whether to memory-map the saved tensors instead of reading them into memory
+            map_location: optional device to remap the saved tensors to
+        Returns:
+            (StateDictMixin): restored object, without running its constructor or fit
+        """
+        obj = _from_state(torch.load(path, map_location=map_location, mmap=mmap, weights_only=True))
+        if not isinstance(obj, cls):
+            raise TypeError(f"{path} stores a {type(obj).__name__}, expected {cls.__name__}.")
+        return obj
+
+
+def _to_state(value: Any) -> Any:
+    if isinstance(value, StateDictMixin):
+        return value.state_dict()
+    elif isinstance(value, dict):
+        return {k: _to_state(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_to_state(v) for v in value]
+    elif value is None or isinstance(value, (torch.Tensor, torch.dtype, bool, int, float, str)):
+        return value
+    else:
+        raise TypeError(f"state_dict does not support values of type {type(value).__name__}.")
+
+
+def _from_state(value: Any) -> Any:
+    if isinstance(value, dict):
+        if "__class__" in value:
+            cls = StateDictMixin._registry[value["__class__"]]
+            return cls.__new__(cls).load_state_dict(value)
+        return {k: _from_state(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_from_state(v) for v in value]
+    else:
+        return value
+
+
 class default_device:
     def __init__(self, device: torch.device):
         self._device = device
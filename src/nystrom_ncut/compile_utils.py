@@ -0,0 +1,20 @@
+from typing import Callable, Dict
+
+import torch
+
+
+# Compiled stages are shared by every model in the process, so a new model or a new chunk size reuses them
+_COMPILED: Dict[Callable, Callable] = {}
+
+
+def compiled(fn: Callable) -> Callable:
+    """torch.compile'd version of a pure tensor function, built once per process.
+    Compiled with dynamic shapes, so the row counts of different chunks share one graph instead of recompiling.
+    """
+    if fn not in _COMPILED:
+        _COMPILED[fn] = torch.compile(fn, dynamic=True)
+    return _COMPILED[fn]
+
+
+def maybe_compile(fn: Callable, use_compile: bool) -> Callable:
+    return compiled(fn) if use_compile else fn
@@ -1,9 +1,18 @@
 import collections
-from typing import List, Literal, OrderedDict
+from typing import List, Literal, OrderedDict, Sequence, Union
 
 import torch
 
-from .common import lazy_normalize
+from .common import (
+    StateDictMixin,
+    lazy_normalize,
+)
+from .compile_utils import (
+    compiled,
+)
+from .global_settings import (
+    LOW_PRECISION_DTYPES,
+)
 
 
 DistanceOptions = Literal[
@@ -57,25 +66,113 @@ def distance_from_features(
         (torch.Tensor): affinity matrix, shape (n_samples, n_samples)
     """
     # compute distance matrix from input features
+    # normalized before flattening the batch dims, the view would drop the mark of an already normalized input
+    if distance_type == "cosine":
+        features_A = lazy_normalize(features_A, p=2, dim=-1)
+        features_B = lazy_normalize(features_B, p=2, dim=-1)
     shape: torch.Size = features_A.shape[:-2]
     features_A = features_A.view((-1, *features_A.shape[-2:]))
     features_B = features_B.view((-1, *features_B.shape[-2:]))
 
     match distance_type:
         case "cosine":
-            features_A = lazy_normalize(features_A, dim=-1)
-            features_B = lazy_normalize(features_B, dim=-1)
             D = 1 - features_A @ features_B.mT
         case "euclidean":
-            D = torch.cdist(features_A, features_B, p=2)
+            if features_A.dtype in LOW_PRECISION_DTYPES:
+                # cdist has no half precision kernels on CPU, expand ||a - b||^2 into a single matmul instead
+                D = torch.baddbmm(
+                    torch.sum(features_A ** 2, dim=-1)[..., :, None] + torch.sum(features_B ** 2, dim=-1)[..., None, :],
+                    features_A, features_B.mT, alpha=-2,
+                ).clamp_min_(0.0).sqrt_()
+            else:
+                D = torch.cdist(features_A, features_B, p=2)
         case _:
             raise ValueError("Distance should be 'cosine' or 'euclidean'")
     return D.view((*shape, *D.shape[-2:]))
 
 
-def get_normalization_factor(features: torch.Tensor, c: float = 2.0) -> torch.Tensor:
-    p = torch.erf(torch.tensor((-c, c), device=features.device) * (2 ** -0.5))
-    lo, hi = torch.nanquantile(features, q=(p + 1) / 2, dim=-2)     # [... x d], [... x d]
+class QuantileSketch(StateDictMixin):
+    """Mergeable per-feature quantile summary of rows streamed along dim -2, in memory independent of the row count.
+    Keeps `size` equally weighted points per feature at the midpoint quantiles of every row seen so far, so the
+    estimated quantiles are within about 1 / size in rank of the exact ones. NaN entries are ignored.
+
+    Args:
+        size (int): number of points kept per feature
+
+    Examples:
+        >>> sketch = QuantileSketch()
+        >>> for chunk in torch.randn(100000, 64).split(8192):
+        ...     sketch.update(chunk)
+        >>> normalization_factor = get_normalization_factor(sketch)
+    """
+    def __init__(self, size: int = 1024):
+        self.size: int = size
+        self.points: torch.Tensor = None                # [... x size x d]
+        self.count: torch.Tensor = None                 # [... x d]
+
+    def _compress(self, values: torch.Tensor, weights: torch.Tensor) -> None:
+        # resamples the weighted empirical distribution at `size` midpoint quantiles
+        values, order = torch.sort(values, dim=-2)                                  # [... x m x d], NaN sorted last
+        weights = torch.gather(weights, -2, order)                                  # [... x m x d]
+        n_valid = torch.sum(weights > 0, dim=-2, keepdim=True)                      # [... x 1 x d]
+        values = torch.where(
+            weights > 0, values, torch.gather(values, -2, (n_valid - 1).clamp_min(0)),
+        )                                                                           # [... x m x d]
+
+        cdf = torch.cumsum(weights, dim=-2) - weights / 2                           # [... x m x d]
+        self.count = torch.sum(weights, dim=-2)                                     # [... x d]
+        q = (torch.arange(self.size, device=values.device, dtype=values.dtype) + 0.5) / self.size
+        target = q[:, None] * self.count[..., None, :]                              # [... x size x d]
+
+        hi = torch.searchsorted(cdf.mT.contiguous(), target.mT.contiguous()).mT    # [... x size x d]
+        hi = hi.clamp(1, values.shape[-2] - 1) if values.shape[-2] > 1 else torch.zeros_like(hi)
+        lo = (hi - 1).clamp_min(0)
+        cdf_lo, cdf_hi = torch.gather(cdf, -2, lo), torch.gather(cdf, -2, hi)
+        t = ((target - cdf_lo) / (cdf_hi - cdf_lo).clamp_min(torch.finfo(values.dtype).tiny)).clamp(0.0, 1.0)
+        self.points = torch.lerp(torch.gather(values, -2, lo), torch.gather(values, -2, hi), t)
+
+    def _weighted_points(self) -> Sequence[torch.Tensor]:
+        return self.points, (self.count / self.size)[..., None, :].expand_as(self.points)
+
+    def update(self, features: torch.Tensor) -> "QuantileSketch":                  # [... x m x d]
+        # quantiles are taken in at least float32 since they are not implemented for half precision
+        features = features.to(torch.promote_types(features.dtype, torch.float32))
+        weights = (~torch.isnan(features)).to(features.dtype)                       # [... x m x d]
+        if self.points is not None:
+            points, point_weights = self._weighted_points()
+            features = torch.cat((points.to(features.device), features), dim=-2)
+            weights = torch.cat((point_weights.to(weights.device), weights), dim=-2)
+        self._compress(features, weights)
+        return self
+
+    def merge(self, sketches: List["QuantileSketch"]) -> "QuantileSketch":
+        weighted_points = [self._weighted_points()] if self.points is not None else []
+        weighted_points += [sketch._weighted_points() for sketch in sketches if sketch.points is not None]
+        if len(weighted_points) > 0:
+            self._compress(*(torch.cat(x, dim=-2) for x in zip(*weighted_points)))
+        return self
+
+    def quantile(self, q: torch.Tensor) -> torch.Tensor:
+        return torch.nanquantile(self.points, q=q, dim=-2)                          # [len(q) x ... x d]
+
+
+def get_normalization_factor(features: Union[torch.Tensor, QuantileSketch], c: float = 2.0) -> torch.Tensor:
+    """Robust per-batch feature scale, the norm of the per-feature spread between the -c and +c sigma quantiles.
+    Args:
+        features: features of shape (..., n_samples, n_features), or a QuantileSketch streamed over them
+        c (float): number of standard deviations spanned on either side
+    Returns:
+        (torch.Tensor): normalization factor, shape (...)
+    """
+    if isinstance(features, QuantileSketch):
+        points = features.points
+        p = torch.erf(torch.tensor((-c, c), device=points.device, dtype=points.dtype) * (2 ** -0.5))
+        lo, hi = features.quantile((p + 1) / 2)                     # [... x d], [... x d]
+    else:
+        # quantiles are taken in at least float32 since they are not implemented for half precision
+        features = features.to(torch.promote_types(features.dtype, torch.float32))
+        p = torch.erf(torch.tensor((-c, c), device=features.device, dtype=features.dtype) * (2 ** -0.5))
+        lo, hi = torch.nanquantile(features, q=(p + 1) / 2, dim=-2) # [... x d], [... x d]
     return torch.norm(hi - lo, dim=-1) / (2 * c)                    # [...]
 
 
@@ -84,6 +181,7 @@ def affinity_from_features(
     features_B: torch.Tensor,
     affinity_type: AffinityOptions,
     affinity_focal_gamma: float,
+    normalization_factor: torch.Tensor = None,
 ):
     """Compute affinity matrix from input features.
 
@@ -93,24 +191,144 @@ def affinity_from_features(
         affinity_focal_gamma (float): affinity matrix parameter, lower t reduce the edge weights
             on weak connections, default 1.0
         affinity_type (str): distance metric, 'cosine' (default) or 'euclidean'.
+        normalization_factor (torch.Tensor): precomputed `get_normalization_factor` for 'rbf', estimated from
+            features_A on every call if not given
     Returns:
         (torch.Tensor): affinity matrix, shape (n_samples, n_samples)
     """
     # compute affinity matrix from input features
+    return fused_affinity(features_A, features_B, affinity_type, affinity_focal_gamma, normalization_factor)
 
-    # if feature_B is not provided, compute affinity matrix on features x features
-    # if feature_B is provided, compute affinity matrix on features x feature_B
-    D = distance_from_features(features_A, features_B, AFFINITY_TO_DISTANCE[affinity_type])
 
+def affinity_from_distance(
+    D: torch.Tensor,
+    affinity_type: AffinityOptions,
+    affinity_focal_gamma: float,
+    normalization_factor: torch.Tensor = None,
+):
+    """Compute affinity matrix from a precomputed distance matrix.
+
+    Args:
+        D (torch.Tensor): distance matrix, shape (n_samples, m_samples)
+        affinity_type (str): distance metric, 'cosine' (default) or 'euclidean'.
+        affinity_focal_gamma (float): affinity matrix parameter, lower t reduce the edge weights
+            on weak connections, default 1.0
+        normalization_factor (torch.Tensor): per-batch feature scale from `get_normalization_factor`, required for 'rbf'
+    Returns:
+        (torch.Tensor): affinity matrix, shape (n_samples, m_samples)
+    """
     # lower affinity_focal_gamma reduce the weak edge weights
     match affinity_type:
         case "cosine":
             pass
         # case "laplacian":
-        #     D = D / get_normalization_factor(features_A)[..., None, None]
+        #     D = D / normalization_factor[..., None, None]
         case "rbf":
-            D = 0.5 * (D / get_normalization_factor(features_A)[..., None, None]) ** 2
+            D = 0.5 * (D / normalization_factor.to(D.dtype)[..., None, None]) ** 2
         case _:
             raise ValueError("Affinity should be 'cosine', 'rbf', or 'laplacian'")
     A = torch.exp(-D / affinity_focal_gamma)    # [... x n x n]
     return A
+
+
+def squared_norms(features: torch.Tensor) -> torch.Tensor:
+    return torch.linalg.vector_norm(features, dim=-1) ** 2                  # [... x n]
+
+
+def fused_affinity(
+    features_A: torch.Tensor,
+    features_B: torch.Tensor,
+    affinity_type: AffinityOptions,
+    affinity_focal_gamma: float,
+    normalization_factor: torch.Tensor = None,
+    squared_norms_A: torch.Tensor = None,
+    out: torch.Tensor = None,
+    tile_size: int = None,
+    use_compile: bool = False,
+) -> torch.Tensor:
+    """Compute the affinity matrix as exp(-f(a . b, |a|^2, |b|^2) / gamma) with a single matmul per tile,
+    every elementwise step is applied in place so no distance matrix or other [n x m] temporary is allocated.
+
+    Args:
+        features_A (torch.Tensor): input features, shape (..., n_samples, n_features)
+        features_B (torch.Tensor): input features, shape (..., m_samples, n_features)
+        affinity_type (str): 'cosine' or 'rbf'
+        affinity_focal_gamma (float): affinity matrix parameter, lower t reduce the edge weights
+            on weak connections
+        normalization_factor (torch.Tensor): precomputed `get_normalization_factor` for 'rbf',
+            estimated from features_A if not given
+        squared_norms_A (torch.Tensor): precomputed `squared_norms(features_A)` for 'rbf', e.g. of fixed anchors
+        out (torch.Tensor): optional output of shape (..., n_samples, m_samples), e.g. a column slice of a larger
+            buffer, written in its own dtype
+        tile_size (int): number of columns computed at once, bounds the temporaries when `out` has another dtype
+        use_compile (bool): whether each tile runs through a torch.compile'd kernel, its elementwise steps are fused
+            into one kernel that writes into `out`, the matmul of a tile still goes to a temporary of the tile's size
+    Returns:
+        (torch.Tensor): affinity matrix, `out` if it was given, shape (..., n_samples, m_samples)
+    """
+    if AFFINITY_TO_DISTANCE[affinity_type] == "cosine":
+        features_A = lazy_normalize(features_A, p=2, dim=-1)
+        features_B = lazy_normalize(features_B, p=2, dim=-1)
+    elif squared_norms_A is None:
+        squared_norms_A = squared_norms(features_A)                         # [... x n]
+    if affinity_type == "rbf" and normalization_factor is None:
+        normalization_factor = get_normalization_factor(features_A)
+
+    dtype = torch.promote_types(features_A.dtype, features_B.dtype)
+    m = features_B.shape[-2]
+    if out is None:
+        shape = torch.broadcast_shapes(features_A.shape[:-2], features_B.shape[:-2])
+        out = torch.empty((*shape, features_A.shape[-2], m), dtype=dtype, device=features_A.device)
+    tile_size = max(m, 1) if tile_size is None else tile_size
+
+    for start in range(0, m, tile_size):
+        _features_B = features_B[..., start:start + tile_size, :]           # [... x _m x d]
+        _out = out[..., start:start + tile_size]                            # [... x n x _m]
+        args = (features_A, _features_B, affinity_type, affinity_focal_gamma, normalization_factor, squared_norms_A)
+        if use_compile:
+            compiled(_affinity_tile_into)(*args, _out)
+        elif _out.dtype == dtype:
+            affinity_tile(*args, out=_out)
+        else:
+            _out.copy_(affinity_tile(*args))
+    return out
+
+
+def _affinity_tile_into(
+    features_A: torch.Tensor,                       # [... x n x d]
+    features_B: torch.Tensor,                       # [... x m x d]
+    affinity_type: AffinityOptions,
+    affinity_focal_gamma: float,
+    normalization_factor: torch.Tensor,             # [...]
+    squared_norms_A: torch.Tensor,                  # [... x n]
+    out: torch.Tensor,                              # [... x n x m]
+) -> torch.Tensor:
+    # compiled variant of affinity_tile, the in-place steps and the cast to the dtype of out fuse into one write
+    return out.copy_(affinity_tile(
+        features_A, features_B, affinity_type, affinity_focal_gamma, normalization_factor, squared_norms_A,
+    ))
+
+
+def affinity_tile(
+    features_A: torch.Tensor,                       # [... x n x d]
+    features_B: torch.Tensor,                       # [... x m x d]
+    affinity_type: AffinityOptions,
+    affinity_focal_gamma: float,
+    normalization_factor: torch.Tensor,             # [...]
+    squared_norms_A: torch.Tensor,                  # [... x n]
+    out: torch.Tensor = None,                       # [... x n x m]
+) -> torch.Tensor:
+    # one matmul followed by in place elementwise steps, see fused_affinity
+    A = torch.matmul(features_A, features_B.mT, out=out)                    # [... x n x m]
+    match affinity_type:
+        case "cosine":
+            # -(1 - a . b) / gamma
+            A.sub_(1.0).div_(affinity_focal_gamma)
+        case "rbf":
+            # -(|a|^2 + |b|^2 - 2 a . b) / (2 * factor^2 * gamma)
+            scale = 0.5 / (normalization_factor.to(A.dtype) ** 2 * affinity_focal_gamma)  # [...]
+            A.mul_(-2.0).add_(squared_norms_A[..., :, None]).add_(squared_norms(features_B)[..., None, :])
+            A.clamp_min_(0.0).mul_(-scale[..., None, None])
+        case _:
+            raise ValueError("Affinity should be 'cosine', 'rbf', or 'laplacian'")
+    return A.exp_()
@@ -1,2 +1,109 @@
+from dataclasses import dataclass
+from typing import Callable, List, Tuple
+
+import torch
+
+from .common import (
+    StateDictMixin,
+    propagate_normalized,
+)
+
 
 CHUNK_SIZE: int = 8192
+
+LOW_PRECISION_DTYPES = (torch.float16, torch.bfloat16)
+EIG_DTYPES = (torch.float32, torch.float64)
+
+
+def resolve_eig_dtype(dtype: torch.dtype, eig_dtype: torch.dtype = None) -> torch.dtype:
+    # linalg routines have no half precision kernels, so low precision inputs are solved in at least float32
+    if eig_dtype is None:
+        eig_dtype = torch.float32 if dtype in LOW_PRECISION_DTYPES else dtype
+    if eig_dtype not in EIG_DTYPES:
+        raise ValueError(f"eig_dtype should be torch.float32 or torch.float64, got {eig_dtype}.")
+    return eig_dtype
+
+
+@dataclass
+class DtypePolicy(StateDictMixin):
+    """Dtypes of each stage of the computation, None keeps the dtype of the incoming tensor.
+    Args:
+        compute_dtype (torch.dtype): dtype of distances, affinities and kernel features,
+            the [n x m] stage that dominates memory traffic, e.g. torch.bfloat16
+        accumulate_dtype (torch.dtype): dtype of row sums, anchor matrices and products accumulated over chunks,
+            also the dtype of the outputs, e.g. torch.float32
+        eig_dtype (torch.dtype): dtype of the eigensolve, torch.float32 or torch.float64
+    """
+    compute_dtype: torch.dtype = None
+    accumulate_dtype: torch.dtype = None
+    eig_dtype: torch.dtype = None
+
+    def to_compute(self, x: torch.Tensor) -> torch.Tensor:
+        return x if self.compute_dtype is None else x.to(self.compute_dtype)
+
+    def to_accumulate(self, x: torch.Tensor) -> torch.Tensor:
+        return x if self.accumulate_dtype is None else x.to(self.accumulate_dtype)
+
+
+MIXED_PRECISION_POLICY: DtypePolicy = DtypePolicy(
+    compute_dtype=torch.bfloat16,
+    accumulate_dtype=torch.float32,
+    eig_dtype=torch.float64,
+)
+
+
+@dataclass
+class ChunkPlan:
+    name: str           # call site that requested the plan
+    n_rows: int         # number of rows to be chunked
+    row_bytes: int      # estimated bytes of intermediate tensors per row, across batch dims
+    chunk_size: int     # chosen number of rows per chunk
+
+
+CHUNK_PLAN_HOOKS: List[Callable[[ChunkPlan], None]] = []
+
+
+def register_chunk_plan_hook(hook: Callable[[ChunkPlan], None]) -> Callable[[], None]:
+    """
+    Args:
+        hook (Callable): called with the ChunkPlan every time a chunk size is chosen
+    Returns:
+        (Callable): removes the hook
+    """
+    CHUNK_PLAN_HOOKS.append(hook)
+    return lambda: CHUNK_PLAN_HOOKS.remove(hook)
+
+
+@dataclass
+class ChunkPlanner(StateDictMixin):
+    """Derives chunk sizes from a memory budget and the shapes of each call instead of a fixed number of rows.
+    Args:
+        memory_budget (int): bytes the intermediate tensors of a single chunk may occupy
+        min_chunk_size (int): lower bound on the chunk size, takes precedence over memory_budget
+        max_chunk_size (int): optional upper bound on the chunk size
+    """
+    memory_budget: int = 2 ** 30
+    min_chunk_size: int = 256
+    max_chunk_size: int = None
+
+    def plan(self, name: str, n_rows: int, row_bytes: int) -> int:
+        chunk_size = max(self.memory_budget // max(row_bytes, 1), self.min_chunk_size)
+        if self.max_chunk_size is not None:
+            chunk_size = min(chunk_size, self.max_chunk_size)
+        chunk_size = max(min(chunk_size, n_rows), 1)
+
+        plan = ChunkPlan(name=name, n_rows=n_rows, row_bytes=row_bytes, chunk_size=chunk_size)
+        for hook in CHUNK_PLAN_HOOKS:
+            hook(plan)
+        return chunk_size
+
+    def split(self, name: str, x: torch.Tensor, row_bytes: int, dim: int = -2) -> Tuple[torch.Tensor, ...]:
+        chunks = torch.split(x, self.plan(name, x.shape[dim], row_bytes), dim=dim)
+        if dim % x.ndim != x.ndim - 1:
+            chunks = tuple(propagate_normalized(x, chunk) for chunk in chunks)
+        return chunks
+
+
+# Mutated in place to change the budget everywhere, e.g. `CHUNK_PLANNER.memory_budget = 8 * 2 ** 30`,
+# worker processes of the data-parallel updates are started with the settings of the parent
+CHUNK_PLANNER: ChunkPlanner = ChunkPlanner()
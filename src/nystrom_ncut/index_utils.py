@@ -0,0 +1,137 @@
+from typing import Tuple
+
+import torch
+import torch.nn.functional as Fn
+
+from .common import (
+    StateDictMixin,
+    mark_normalized,
+    propagate_normalized,
+)
+from .distance_utils import (
+    DistanceOptions,
+    distance_from_features,
+    to_euclidean,
+)
+from .global_settings import (
+    CHUNK_PLANNER,
+)
+
+
+class IVFIndex(StateDictMixin):
+    """Inverted-file index over anchor features for approximate nearest neighbour search.
+    Anchors are bucketed by k-means once at construction, each query only scans the `n_probe` closest buckets.
+
+    Args:
+        anchor_features (torch.Tensor): features to index, shape (n_samples, n_features)
+        distance_type (str): distance metric, 'cosine' or 'euclidean'
+        n_lists (int): number of k-means buckets, more buckets make each query faster, default sqrt(n_samples)
+        n_probe (int): number of buckets scanned per query, more probes increase recall, default 8
+        n_iter (int): number of k-means iterations used to build the buckets
+        seed (int): seed of the k-means initialization
+        anchor_indices (torch.Tensor): optional indices of `anchor_features` into a larger feature set,
+            used by `extrapolate_knn_with_subsampling` to reuse the anchors instead of resampling them
+
+    Examples:
+        >>> anchor_features = torch.randn(3000, 100)
+        >>> index = IVFIndex(anchor_features, "cosine", n_probe=4)
+        >>> distances, indices = index.search(torch.randn(200, 100), k=10)
+        >>> # distances.shape = indices.shape = (200, 10)
+    """
+    def __init__(
+        self,
+        anchor_features: torch.Tensor,
+        distance_type: DistanceOptions,
+        n_lists: int = None,
+        n_probe: int = 8,
+        n_iter: int = 10,
+        seed: int = 0,
+        anchor_indices: torch.Tensor = None,
+    ):
+        n = anchor_features.shape[0]
+        self.distance_type: DistanceOptions = distance_type
+        self.n_lists: int = min(n, int(n ** 0.5) if n_lists is None else n_lists)
+        self.n_probe: int = n_probe
+        self.anchor_indices: torch.Tensor = anchor_indices                              # int: [n]
+
+        self.anchor_features: torch.Tensor = to_euclidean(anchor_features, distance_type)   # float: [n x d]
+        self.centroids: torch.Tensor = None                                             # float: [n_lists x d]
+        self.list_indices: torch.Tensor = None                                          # int: [n']
+        self.list_offsets: torch.Tensor = None                                          # int: [n_lists + 1]
+        self._build(n_iter, seed)
+
+    def _normalize_centroids(self, centroids: torch.Tensor) -> torch.Tensor:
+        if self.distance_type == "cosine":
+            centroids = mark_normalized(Fn.normalize(centroids, p=2, dim=-1))
+        return centroids
+
+    def _assign(self, features: torch.Tensor) -> torch.Tensor:
+        # distances of a chunk to every centroid
+        row_bytes = self.centroids.shape[0] * features.dtype.itemsize
+        return torch.cat([
+            torch.argmin(distance_from_features(self.centroids, _features, self.distance_type), dim=0)
+            for _features in CHUNK_PLANNER.split("IVFIndex.assign", features, row_bytes)
+        ], dim=0)                                                                       # int: [n]
+
+    @torch.no_grad()
+    def _build(self, n_iter: int, seed: int) -> None:
+        device = self.anchor_features.device
+        valid_indices = torch.where(torch.all(torch.isfinite(self.anchor_features), dim=-1))[0]    # int: [n']
+        features = propagate_normalized(self.anchor_features, self.anchor_features[valid_indices])    # float: [n' x d]
+
+        # k-means
+        generator = torch.Generator(device=device).manual_seed(seed)
+        init_indices = torch.randperm(features.shape[0], generator=generator, device=device)[:self.n_lists]
+        self.centroids = propagate_normalized(features, features[init_indices])        # float: [n_lists x d]
+        for _ in range(n_iter):
+            assignment = self._assign(features)                                         # int: [n']
+            counts = torch.bincount(assignment, minlength=self.n_lists)                 # int: [n_lists]
+            sums = torch.zeros_like(self.centroids).index_add_(0, assignment, features) # float: [n_lists x d]
+            self.centroids = self._normalize_centroids(torch.where(
+                (counts > 0)[:, None], sums / counts[:, None].clamp_min(1), self.centroids,
+            ))
+
+        # inverted lists
+        assignment = self._assign(features)                                             # int: [n']
+        order = torch.argsort(assignment)                                               # int: [n']
+        self.list_indices = valid_indices[order]                                        # int: [n']
+        counts = torch.bincount(assignment, minlength=self.n_lists)                     # int: [n_lists]
+        self.list_offsets = torch.cat((counts.new_zeros((1,)), torch.cumsum(counts, dim=0)), dim=0)
+
+    @torch.no_grad()
+    def search(self, features: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            features (torch.Tensor): query features, shape (m_samples, n_features)
+            k (int): number of neighbours to return
+        Returns:
+            (torch.Tensor): distances to the nearest anchors, ascending, inf where fewer than k anchors were scanned, shape (m_samples, k)
+            (torch.Tensor): indices of the nearest anchors, -1 where fewer than k anchors were scanned, shape (m_samples, k)
+        """
+        m = features.shape[0]
+        features = to_euclidean(features, self.distance_type)                           # float: [m x d]
+        k = min(k, self.anchor_features.shape[0])
+
+        centroid_distance = distance_from_features(self.centroids, features, self.distance_type).mT       # float: [m x n_lists]
+        probes = torch.topk(centroid_distance, k=min(self.n_probe, self.n_lists), dim=-1, largest=False).indices   # int: [m x n_probe]
+
+        distances = torch.full((m, k), torch.inf, dtype=features.dtype, device=features.device)   # float: [m x k]
+        indices = torch.full((m, k), -1, dtype=torch.long, device=features.device)      # int: [m x k]
+        offsets = self.list_offsets.tolist()
+        for l in torch.unique(probes).tolist():
+            members = self.list_indices[offsets[l]:offsets[l + 1]]                      # int: [s]
+            if len(members) == 0:
+                continue
+            query_indices = torch.where(torch.any(probes == l, dim=-1))[0]              # int: [q]
+            _distances = distance_from_features(
+                propagate_normalized(self.anchor_features, self.anchor_features[members]),
+                propagate_normalized(features, features[query_indices]),
+                self.distance_type,
+            ).mT                                                                        # float: [q x s]
+
+            candidate_distances = torch.cat((distances[query_indices], _distances), dim=-1)                     # float: [q x (k + s)]
+            candidate_indices = torch.cat((indices[query_indices], members.expand(len(query_indices), -1)), dim=-1) # int: [q x (k + s)]
+            _distances, _order = torch.topk(candidate_distances, k=k, dim=-1, largest=False)                    # float: [q x k], int: [q x k]
+            distances[query_indices] = _distances
+            indices[query_indices] = torch.gather(candidate_indices, -1, _order)
+        return distances, indices
@@ -1,15 +1,37 @@
-from typing import Dict
+from typing import Any, Callable, Dict, Iterable, List, Literal, Union
 
 import torch
+import torch.nn.functional as Fn
 
 from ..common import (
+    ceildiv,
+    fwht,
     lazy_normalize,
 )
+from ..compile_utils import (
+    maybe_compile,
+)
 from ..distance_utils import (
     AffinityOptions,
     AFFINITY_TO_DISTANCE,
     get_normalization_factor,
 )
+from ..global_settings import (
+    CHUNK_PLANNER,
+    DtypePolicy,
+    resolve_eig_dtype,
+)
+from ..nystrom.nystrom_utils import (
+    solve_eig,
+)
+from ..parallel_utils import (
+    shard_rows,
+    worker_pool,
+)
+from ..profiler import (
+    current_span,
+    span,
+)
 from ..sampling_utils import (
     SampleConfig,
     OnlineTransformerSubsampleFit,
@@ -19,6 +41,22 @@ from ..transformer import (
 )
 
 
+FeatureMapOptions = Literal["gaussian", "orthogonal", "sorf"]
+
+
+def _fourier_features(W_features: torch.Tensor, kernel_dim: int) -> torch.Tensor:
+    return torch.cat((
+        torch.cos(W_features),
+        torch.sin(W_features),
+    ), dim=-1) / (kernel_dim ** 0.5)                                                # [... x m x (2 * kernel_dim)]
+
+
+def _project_kernelized(kernelized_features: torch.Tensor, r: torch.Tensor, transform_matrix: torch.Tensor) -> torch.Tensor:
+    row_sum = kernelized_features @ r[..., None]                                    # [... x m x 1]
+    normalized_kernelized_features = kernelized_features / (row_sum ** 0.5)         # [... x m x (2 * kernel_dim)]
+    return normalized_kernelized_features @ transform_matrix                        # [... x m x n_components]
+
+
 class KernelNCutBaseTransformer(OnlineTorchTransformerMixin):
     def __init__(
         self,
@@ -26,16 +64,29 @@ class KernelNCutBaseTransformer(OnlineTorchTransformerMixin):
         kernel_dim: int,
         affinity_type: AffinityOptions,
         affinity_focal_gamma: float,
+        dtype_policy: DtypePolicy,
+        feature_map: FeatureMapOptions = "gaussian",
+        incremental: bool = False,
+        use_compile: bool = False,
+        refresh_tol: float = 0.05,
     ):
         self.n_components: int = n_components
         self.kernel_dim: int = kernel_dim
         self.affinity_type: AffinityOptions = affinity_type
         self.affinity_focal_gamma = affinity_focal_gamma
+        self.dtype_policy: DtypePolicy = dtype_policy
+        self.feature_map: FeatureMapOptions = feature_map
+        self.incremental: bool = incremental
+        self.use_compile: bool = use_compile
+        self.refresh_tol: float = refresh_tol
 
         # Anchor matrices
         self.anchor_count: int = None                   # n
         self.kernelized_anchor: torch.Tensor = None     # [... x n x (2 * kernel_dim)]
         self.store: Dict[str, torch.Tensor] = {}
+        self.anchor_sum: torch.Tensor = None            # [... x (2 * kernel_dim)]
+        self.gram: torch.Tensor = None                  # [... x (2 * kernel_dim) x (2 * kernel_dim)]
+        self.gram_r: torch.Tensor = None                # [... x (2 * kernel_dim)]
 
         # Updated matrices
         self.total_count: int = None                    # m
@@ -43,29 +94,133 @@ class KernelNCutBaseTransformer(OnlineTorchTransformerMixin):
         self.transform_matrix: torch.Tensor = None      # [... x (2 * kernel_dim) x n_components]
         self.eigenvalues_: torch.Tensor = None          # [... x n_components]
 
+    def _prepare_features(self, features: torch.Tensor) -> torch.Tensor:
+        # normalized once before chunking, chunks inherit the mark and skip the check in _kernelize_features
+        features = self.dtype_policy.to_compute(features)
+        if self.affinity_type == "cosine":
+            features = lazy_normalize(features, p=2, dim=-1)
+        return features
+
     def _kernelize_features(self, features: torch.Tensor) -> torch.Tensor:
         match self.affinity_type:
             case "cosine" | "rbf":
-                if self.affinity_type == "cosine":
-                    features = lazy_normalize(features)
-                W_features = features @ self.store["W"] # [... x m x kernel_dim]
-                return torch.cat((
-                    torch.cos(W_features),
-                    torch.sin(W_features),
-                ), dim=-1) / (self.kernel_dim ** 0.5)   # [... x m x (2 * kernel_dim)]
+                features = self._prepare_features(features)
+                W_features = self._random_projection(features)  # [... x m x kernel_dim]
+                return self.dtype_policy.to_accumulate(maybe_compile(_fourier_features, self.use_compile)(
+                    W_features, self.kernel_dim,
+                ))  # [... x m x (2 * kernel_dim)]
 
             case _:
                 raise ValueError(self.affinity_type)
 
+    def _random_projection(self, features: torch.Tensor) -> torch.Tensor:
+        match self.feature_map:
+            case "gaussian" | "orthogonal":
+                return features @ self.store["W"]                                   # [... x m x kernel_dim]
+            case "sorf":
+                # sqrt(p) / scale * H @ D1 @ H @ D2 @ H @ D3 per block, with sqrt(p) / scale folded into D1
+                D = self.store["D"]                                                 # [... x n_blocks x 3 x p]
+                x = Fn.pad(features, (0, D.shape[-1] - features.shape[-1]))[..., :, None, :]  # [... x m x 1 x p]
+                for i in (2, 1, 0):
+                    x = fwht(x * D[..., None, :, i, :])                             # [... x m x n_blocks x p]
+                return x.flatten(-2, -1)[..., :self.kernel_dim]                     # [... x m x kernel_dim]
+            case _:
+                raise ValueError(f"Feature map {self.feature_map} not recognized.")
+
+    def _draw_feature_map(
+        self,
+        shape: torch.Size,
+        d: int,
+        scale: Union[float, torch.Tensor],              # [... x 1 x 1]
+        dtype: torch.dtype,
+        device: torch.device,
+    ) -> None:
+        match self.feature_map:
+            case "gaussian":
+                W = torch.randn((*shape, d, self.kernel_dim), device=device)       # [... x d x kernel_dim]
+            case "orthogonal":
+                # blocks of orthogonal rows rescaled to chi distributed norms, marginally Gaussian with lower variance
+                n_blocks = ceildiv(self.kernel_dim, d)
+                Q = torch.linalg.qr(torch.randn((*shape, n_blocks, d, d), device=device)).Q                # [... x n_blocks x d x d]
+                norms = torch.norm(torch.randn((*shape, n_blocks, d, d), device=device), dim=-1)          # [... x n_blocks x d]
+                W = (Q * norms[..., :, None]).flatten(-3, -2)[..., :self.kernel_dim, :].mT                 # [... x d x kernel_dim]
+            case "sorf":
+                # structured orthogonal random features, O(kernel_dim) storage and O(kernel_dim * log d) projection
+                p = 1 << (d - 1).bit_length()
+                n_blocks = ceildiv(self.kernel_dim, p)
+                D = torch.randint(0, 2, (*shape, n_blocks, 3, p), device=device) * 2.0 - 1.0            # [... x n_blocks x 3 x p]
+                D[..., 0, :] *= (p ** 0.5) / scale
+                self.store["D"] = self.dtype_policy.to_compute(D.to(dtype))
+                return
+            case _:
+                raise ValueError(f"Feature map {self.feature_map} not recognized.")
+        self.store["W"] = self.dtype_policy.to_compute((W / scale).to(dtype))
+
+    def row_bytes(self, features: torch.Tensor) -> int:
+        # projected features, their cos and sin, the concatenated kernel features and the output of each row
+        dtype = self.dtype_policy.compute_dtype or features.dtype
+        return features.shape[:-2].numel() * (5 * self.kernel_dim + self.n_components) * dtype.itemsize
+
+    def _flops(self, features: torch.Tensor, kernelize_passes: int = 1) -> float:
+        # random projection of every row per pass, then its row sum and projection onto the eigenvectors
+        rows = features.shape[:-1].numel()
+        return 2 * rows * (kernelize_passes * features.shape[-1] * self.kernel_dim + 2 * self.kernel_dim * (self.n_components + 1))
+
+    def _project(self, kernelized_features: torch.Tensor) -> torch.Tensor:
+        return maybe_compile(_project_kernelized, self.use_compile)(kernelized_features, self.r, self.transform_matrix)   # [... x m x n_components]
+
+    def refresh(self) -> None:
+        """Recomputes the Gram statistic of the incremental update exactly from the kernelized anchors,
+        G = sum_i k_i k_i^T / (k_i . r), in O(n * kernel_dim^2).
+        """
+        if self.kernelized_anchor is None:
+            raise ValueError("refresh requires the kernelized anchors, which were dropped")
+        kernelized_anchor = torch.nan_to_num(self.kernelized_anchor, nan=0.0)      # [... x n x (2 * kernel_dim)]
+        row_sum = kernelized_anchor @ self.r[..., None]                             # [... x n x 1]
+        normalized_kernelized_anchor = kernelized_anchor * torch.where(row_sum > 0, row_sum, torch.inf) ** -0.5
+        self.anchor_sum = torch.sum(kernelized_anchor, dim=-2)                      # [... x (2 * kernel_dim)]
+        self.gram = normalized_kernelized_anchor.mT @ normalized_kernelized_anchor  # [... x (2 * kernel_dim) x (2 * kernel_dim)]
+        self.gram_r = self.r                                                        # [... x (2 * kernel_dim)]
+
+    def drop_anchors(self) -> None:
+        """Frees the [n x (2 * kernel_dim)] kernelized anchors, afterwards only transform with features is available."""
+        if not self.incremental:
+            raise ValueError("drop_anchors requires incremental=True, the exact update needs the kernelized anchors")
+        self.kernelized_anchor = None
+
     def _update(self) -> None:
-        row_sum = self.kernelized_anchor @ self.r[..., None]                        # [... x n x 1]
-        normalized_kernelized_anchor = self.kernelized_anchor / (row_sum ** 0.5)    # [... x n x (2 * kernel_dim)]
-        _, S, V = torch.svd_lowrank(torch.nan_to_num(normalized_kernelized_anchor, nan=0.0), q=self.n_components)   # [... x n_components], [... x (2 * kernel_dim) x n_components]
-        S = S * (self.total_count / self.anchor_count) ** 0.5
-        self.transform_matrix = V * torch.nan_to_num(1 / S, posinf=0.0, neginf=0.0)[..., None, :]   # [... x (2 * kernel_dim) x n_components]
-        self.eigenvalues_ = S ** 2
-
-    def fit(self, features: torch.Tensor) -> "KernelNCutBaseTransformer":
+        with span("KernelNCutBaseTransformer.solve_eig"):
+            if self.incremental:
+                """ Incremental version """
+                # the rescaled statistic only follows the magnitude of r, so it is recomputed once the direction
+                # of r has drifted by more than refresh_tol, after drop_anchors the basis stays frozen at the last refresh
+                drift = torch.norm(Fn.normalize(self.r, dim=-1) - Fn.normalize(self.gram_r, dim=-1), dim=-1)   # [...]
+                if self.kernelized_anchor is not None and torch.max(drift).item() > self.refresh_tol:
+                    self.refresh()
+                # the right singular vectors of the row-normalized kernelized anchors are the eigenvectors of G(r),
+                # G is exact at gram_r and r moves every anchor row sum k_i . r by (s . r) / (s . gram_r) on average
+                scale = torch.sum(self.anchor_sum * self.gram_r, dim=-1) / torch.sum(self.anchor_sum * self.r, dim=-1)   # [...]
+                V, L = solve_eig(
+                    self.gram * scale[..., None, None], self.n_components, "eigh",
+                    eig_dtype=self.dtype_policy.eig_dtype,
+                )                                                                   # [... x (2 * kernel_dim) x n_components], [... x n_components]
+                L = L.clamp_min(0.0) * (self.total_count / self.anchor_count)
+                self.transform_matrix = V * torch.nan_to_num(L ** -0.5, posinf=0.0, neginf=0.0)[..., None, :]   # [... x (2 * kernel_dim) x n_components]
+                self.eigenvalues_ = L
+            else:
+                """ Exact version """
+                row_sum = self.kernelized_anchor @ self.r[..., None]                    # [... x n x 1]
+                normalized_kernelized_anchor = self.kernelized_anchor / (row_sum ** 0.5)    # [... x n x (2 * kernel_dim)]
+                dtype = normalized_kernelized_anchor.dtype
+                _, S, V = torch.svd_lowrank(torch.nan_to_num(
+                    normalized_kernelized_anchor.to(resolve_eig_dtype(dtype, self.dtype_policy.eig_dtype)), nan=0.0,
+                ), q=self.n_components)                                                 # [... x n_components], [... x (2 * kernel_dim) x n_components]
+                current_span().add(flops=12 * normalized_kernelized_anchor.numel() * self.n_components)
+                S = S * (self.total_count / self.anchor_count) ** 0.5
+                self.transform_matrix = (V * torch.nan_to_num(1 / S, posinf=0.0, neginf=0.0)[..., None, :]).to(dtype)  # [... x (2 * kernel_dim) x n_components]
+                self.eigenvalues_ = (S ** 2).to(dtype)
+
+    def fit(self, features: torch.Tensor, normalization_factor: torch.Tensor = None) -> "KernelNCutBaseTransformer":
         self.anchor_count = self.total_count = features.shape[-2]
         shape, d = features.shape[:-2], features.shape[-1]
 
@@ -73,37 +228,97 @@ class KernelNCutBaseTransformer(OnlineTorchTransformerMixin):
             case "cosine" | "rbf":
                 scale = self.affinity_focal_gamma ** 0.5
                 if self.affinity_type == "rbf":
-                    scale = get_normalization_factor(features)[..., None, None] * scale                     # [... x 1 x 1]
-                self.store["W"] = torch.randn((*shape, d, self.kernel_dim), device=features.device) / scale # [... x d x kernel_dim]
+                    if normalization_factor is None:
+                        normalization_factor = get_normalization_factor(features)                           # [...]
+                    scale = normalization_factor[..., None, None] * scale                                   # [... x 1 x 1]
+                self._draw_feature_map(shape, d, scale, features.dtype, features.device)
 
             case _:
                 raise ValueError(self.affinity_type)
 
         self.kernelized_anchor = self._kernelize_features(features)                     # [... x n * (2 * kernel_dim)]
         self.r = torch.sum(torch.nan_to_num(self.kernelized_anchor, nan=0.0), dim=-2)   # [... x (2 * kernel_dim)]
+        if self.incremental:
+            self.refresh()
         self._update()
         return self
 
     def update(self, features: torch.Tensor) -> torch.Tensor:
         self.total_count += features.shape[-2]
-        kernelized_features = self._kernelize_features(features)                        # [... x m x (2 * kernel_dim)]
-        b_r = torch.sum(torch.nan_to_num(kernelized_features, nan=0.0), dim=-2)         # [... x (2 * kernel_dim)]
-        self.r = self.r + b_r
+        features = self._prepare_features(features)
+        chunks = CHUNK_PLANNER.split("KernelNCutBaseTransformer.update", features, self.row_bytes(features))
+        with span("KernelNCutBaseTransformer.update", flops=self._flops(features, 2 if len(chunks) > 1 else 1), chunks=len(chunks)):
+            if len(chunks) > 1:
+                """ Chunked version """
+                # every chunk contributes to r before any output is normalized, so kernel features are computed twice
+                for chunk in chunks:
+                    kernelized_features = self._kernelize_features(chunk)               # [... x _m x (2 * kernel_dim)]
+                    self.r = self.r + torch.sum(torch.nan_to_num(kernelized_features, nan=0.0), dim=-2)
+                self._update()
+                return torch.cat([
+                    self._project(self._kernelize_features(chunk))
+                    for chunk in chunks
+                ], dim=-2)                                                              # [... x m x n_components]
+            else:
+                """ Unchunked version """
+                kernelized_features = self._kernelize_features(features)                # [... x m x (2 * kernel_dim)]
+                b_r = torch.sum(torch.nan_to_num(kernelized_features, nan=0.0), dim=-2) # [... x (2 * kernel_dim)]
+                self.r = self.r + b_r
+                self._update()
+                return self._project(kernelized_features)                               # [... x m x n_components]
+
+    def update_stream(self, chunks: Callable[[], Iterable[torch.Tensor]]) -> None:
+        """
+        Args:
+            chunks (Callable): returns a fresh iterator over chunks of shape (..., chunk_size, n_features),
+                rows that are entirely NaN are not counted
+        """
+        for chunk in chunks():
+            self.total_count += torch.max(torch.sum(torch.any(~torch.isnan(chunk), dim=-1), dim=-1)).item()
+            kernelized_features = self._kernelize_features(chunk)                       # [... x _m x (2 * kernel_dim)]
+            self.r = self.r + torch.sum(torch.nan_to_num(kernelized_features, nan=0.0), dim=-2)
+        self._update()
+
+    def accumulate(self, features: torch.Tensor) -> Dict[str, Any]:
+        r = 0.0
+        features = self._prepare_features(features)
+        for chunk in CHUNK_PLANNER.split("KernelNCutBaseTransformer.accumulate", features, self.row_bytes(features)):
+            kernelized_features = self._kernelize_features(chunk)                       # [... x _m x (2 * kernel_dim)]
+            r = r + torch.sum(torch.nan_to_num(kernelized_features, nan=0.0), dim=-2)   # [... x (2 * kernel_dim)]
+        return {"total_count": features.shape[-2], "r": r}
+
+    def merge(self, stats: List[Dict[str, Any]]) -> None:
+        for _stats in stats:
+            self.total_count += _stats["total_count"]
+            self.r = self.r + _stats["r"]
         self._update()
 
-        row_sum = kernelized_features @ self.r[..., None]                           # [... x m x 1]
-        normalized_kernelized_features = kernelized_features / (row_sum ** 0.5)     # [... x m x (2 * kernel_dim)]
-        return normalized_kernelized_features @ self.transform_matrix               # [... x m x n_components]
+    def update_parallel(self, features: torch.Tensor, num_workers: int) -> torch.Tensor:
+        """Data-parallel update, each worker process sums the kernel features of a shard and the parent merges them.
+        Args:
+            features (torch.Tensor): new features, shape (..., m_samples, n_features)
+            num_workers (int): number of worker processes, spawned per call unless inside `persistent_worker_pool`
+        Returns:
+            (torch.Tensor): eigenvectors of the new features, shape (..., m_samples, n_components)
+        """
+        shards = shard_rows(features, num_workers)
+        with worker_pool(len(shards)) as pool:
+            self.merge(pool.map(self.accumulate, shards))
+            return torch.cat(pool.map(self.transform, shards), dim=-2)                 # [... x m x n_components]
 
     def transform(self, features: torch.Tensor = None) -> torch.Tensor:
         if features is None:
-            kernelized_features = self.kernelized_anchor                            # [... x n x (2 * kernel_dim)]
+            if self.kernelized_anchor is None:
+                raise ValueError("transform without features requires the kernelized anchors, which were dropped")
+            return self._project(self.kernelized_anchor)                            # [... x n x n_components]
         else:
-            kernelized_features = self._kernelize_features(features)                # [... x m x (2 * kernel_dim)]
-
-        row_sum = kernelized_features @ self.r[..., None]                           # [... x m x 1]
-        normalized_kernelized_features = kernelized_features / (row_sum ** 0.5)     # [... x m x (2 * kernel_dim)]
-        return normalized_kernelized_features @ self.transform_matrix               # [... x m x n_components]
+            features = self._prepare_features(features)
+            chunks = CHUNK_PLANNER.split("KernelNCutBaseTransformer.transform", features, self.row_bytes(features))
+            with span("KernelNCutBaseTransformer.transform", flops=self._flops(features), chunks=len(chunks)):
+                return torch.cat([
+                    self._project(self._kernelize_features(chunk))
+                    for chunk in chunks
+                ], dim=-2)                                                          # [... x m x n_components]
 
 
 class KernelNCut(OnlineTransformerSubsampleFit):
@@ -116,7 +331,34 @@ class KernelNCut(OnlineTransformerSubsampleFit):
         affinity_type: AffinityOptions = "cosine",
         affinity_focal_gamma: float = 1.0,
         sample_config: SampleConfig = SampleConfig(),
+        dtype_policy: DtypePolicy = DtypePolicy(),
+        num_workers: int = 1,
+        feature_map: FeatureMapOptions = "gaussian",
+        incremental: bool = False,
+        use_compile: bool = False,
+        refresh_tol: float = 0.05,
     ):
+        """
+        Args:
+            n_components (int): number of top eigenvectors to return
+            kernel_dim (int): number of random features, each contributes a cos and a sin feature
+            affinity_type (str): distance metric for affinity matrix, ['cosine', 'rbf'].
+            affinity_focal_gamma (float): affinity matrix temperature, lower t reduce the not-so-connected edge weights
+            sample_config (SampleConfig): subgraph sampling used to pick the anchors
+            dtype_policy (DtypePolicy): dtypes of the random feature, accumulation and eigensolve stages
+            num_workers (int): number of worker processes the unsampled features are sharded across during fit
+            feature_map (str): random feature map, ['gaussian', 'orthogonal', 'sorf'].
+                'orthogonal' has lower variance per feature at the same cost, 'sorf' replaces the [d x kernel_dim]
+                projection with Hadamard-diagonal products, O(kernel_dim) storage and O(kernel_dim * log d) cost
+            incremental (bool): whether updates eigendecompose a [2 * kernel_dim x 2 * kernel_dim] Gram statistic
+                instead of the [n x 2 * kernel_dim] kernelized anchors, so their cost does not grow with the anchor count.
+                The statistic is rescaled to the magnitude of the degrees, so the eigenvectors stay fixed until it is
+                recomputed from the kernelized anchors, after drop_anchors they stay frozen at the last recompute
+            refresh_tol (float): drift of the direction of the degree vector since the last recompute of the statistic
+                above which an incremental update recomputes it from the kernelized anchors, in O(n * kernel_dim^2)
+            use_compile (bool): whether the random feature and projection stages run through torch.compile'd kernels,
+                compiled once per process with dynamic shapes so new chunk sizes do not recompile
+        """
         OnlineTransformerSubsampleFit.__init__(
             self,
             base_transformer=KernelNCutBaseTransformer(
@@ -124,9 +366,18 @@ class KernelNCut(OnlineTransformerSubsampleFit):
                 kernel_dim=kernel_dim,
                 affinity_type=affinity_type,
                 affinity_focal_gamma=affinity_focal_gamma,
+                dtype_policy=dtype_policy,
+                feature_map=feature_map,
+                incremental=incremental,
+                refresh_tol=refresh_tol,
+                use_compile=use_compile,
             ),
             distance_type=AFFINITY_TO_DISTANCE[affinity_type],
             sample_config=sample_config,
+            num_workers=num_workers,
         )
 
-
+    def drop_anchors(self) -> "KernelNCut":
+        """Frees the kernelized anchors of an incremental model, see KernelNCutBaseTransformer.drop_anchors."""
+        self.base_transformer.drop_anchors()
+        return self
@@ -1,16 +1,29 @@
-import einops
+from typing import Any, Dict, List, Union
+
 import torch
 
 from .nystrom_utils import (
     EigSolverOptions,
     OnlineKernel,
     OnlineNystrom,
+    SparseLowRankMatrix,
     solve_eig,
+    upcast_matmul,
 )
 from ..distance_utils import (
     AffinityOptions,
     AFFINITY_TO_DISTANCE,
-    affinity_from_features,
+    fused_affinity,
+    get_normalization_factor,
+    squared_norms,
+    to_euclidean,
+)
+from ..global_settings import (
+    CHUNK_PLANNER,
+    DtypePolicy,
+)
+from ..profiler import (
+    span,
 )
 from ..sampling_utils import (
     SampleConfig,
@@ -25,82 +38,234 @@ class LaplacianKernel(OnlineKernel):
         affinity_focal_gamma: float,
         adaptive_scaling: bool,
         eig_solver: EigSolverOptions,
+        dtype_policy: DtypePolicy,
+        eig_num_workers: int = 1,
+        sparse_knn: int = None,
+        use_compile: bool = False,
     ):
         self.affinity_type: AffinityOptions = affinity_type
         self.affinity_focal_gamma = affinity_focal_gamma
         self.adaptive_scaling: bool = adaptive_scaling
         self.eig_solver: EigSolverOptions = eig_solver
+        self.dtype_policy: DtypePolicy = dtype_policy
+        self.eig_num_workers: int = eig_num_workers
+        self.sparse_knn: int = sparse_knn
+        self.use_compile: bool = use_compile
 
         # Anchor matrices
         self.anchor_features: torch.Tensor = None                                   # [... x n x d]
         self.anchor_mask: torch.Tensor = None
-        self.A: torch.Tensor = None                                                 # [... x n x n]
-        self.Ainv: torch.Tensor = None                                              # [... x n x n]
+        self.anchor_squared_norms: torch.Tensor = None                             # [... x n]
+        self.normalization_factor: torch.Tensor = None                             # [...]
+        self.A: Union[torch.Tensor, SparseLowRankMatrix] = None                     # [... x n x n]
+        self.Ainv_U: torch.Tensor = None                                            # [... x n x (d + 1)]
+        self.Ainv_L: torch.Tensor = None                                            # [... x (d + 1)]
 
         # Updated matrices
         self.a_r: torch.Tensor = None                                               # [... x n]
         self.b_r: torch.Tensor = None                                               # [... x n]
 
-    def fit(self, features: torch.Tensor) -> None:
-        self.anchor_features = features                                             # [... x n x d]
+    def fit(self, features: torch.Tensor, normalization_factor: torch.Tensor = None) -> None:
+        # cosine anchors are normalized once here, every later affinity reuses them without rechecking
+        self.anchor_features = to_euclidean(
+            self.dtype_policy.to_compute(features), AFFINITY_TO_DISTANCE[self.affinity_type],
+        )                                                                           # [... x n x d]
+        self.anchor_mask = torch.all(torch.isnan(self.anchor_features), dim=-1)     # [... x n]
+        # the rbf scale is estimated once from the anchors unless given, e.g. from a QuantileSketch over every row
+        if self.affinity_type == "rbf" and normalization_factor is None:
+            normalization_factor = get_normalization_factor(self.anchor_features)
+        self.normalization_factor = normalization_factor                            # [...]
+        if AFFINITY_TO_DISTANCE[self.affinity_type] == "euclidean":
+            self.anchor_squared_norms = squared_norms(self.anchor_features)        # [... x n]
+
+
+        if self.sparse_knn is not None:
+            self.A = self._sparse_anchor_affinity()                                 # [... x n x n]
+            row_sum = self.A.row_sum()                                              # [... x n]
+        else:
+            self.A = self._raw_affinity(
+                self.anchor_features, self._accumulate_dtype(self.anchor_features),
+            ).masked_fill_(self.anchor_mask[..., None], 0.0)                        # [... x n x n]
+            row_sum = torch.sum(self.A.mT, dim=-1)                                  # [... x n]
+        self._solve_anchor_affinity(row_sum, features.shape[-1])
+
+    def replace_anchors(
+        self,
+        indices: torch.Tensor,
+        features: torch.Tensor,
+        warm_start: bool = False,
+        warm_start_iter: int = 1,
+        warm_start_tol: float = None,
+    ) -> None:
+        # only the rows and columns of the replaced anchors are recomputed, the rbf scale of the last fit is kept
+        if indices.shape[-1] == 0:
+            self.b_r = torch.zeros_like(self.a_r)                                   # [... x n]
+            return
+        features = to_euclidean(
+            self.dtype_policy.to_compute(features), AFFINITY_TO_DISTANCE[self.affinity_type],
+        )                                                                           # [... x k x d]
+        self.anchor_features = self.anchor_features.scatter(
+            -2, indices[..., None].expand(features.shape), features,
+        )                                                                           # [... x n x d]
         self.anchor_mask = torch.all(torch.isnan(self.anchor_features), dim=-1)     # [... x n]
+        if self.anchor_squared_norms is not None:
+            self.anchor_squared_norms = squared_norms(self.anchor_features)        # [... x n]
 
+        if self.sparse_knn is not None:
+            self.A = self._sparse_anchor_affinity()                                 # [... x n x n]
+            row_sum = self.A.row_sum()                                              # [... x n]
+        else:
+            C = self._raw_affinity(features, self.A.dtype).masked_fill_(self.anchor_mask[..., None], 0.0)   # [... x n x k]
+            self.A.scatter_(-1, indices[..., None, :].expand(C.shape), C)
+            self.A.scatter_(-2, indices[..., :, None].expand(C.mT.shape), C.mT)    # [... x n x n]
+            row_sum = torch.sum(self.A.mT, dim=-1)                                  # [... x n]
+        self._solve_anchor_affinity(
+            row_sum, features.shape[-1],
+            warm_start=self.Ainv_U if warm_start else None,
+            warm_start_iter=warm_start_iter,
+            warm_start_tol=warm_start_tol,
+        )
 
-        self.A = torch.where(self.anchor_mask[..., None], 0.0, affinity_from_features(
-            features_A=self.anchor_features,                                        # [... x n x d]
-            features_B=self.anchor_features,                                        # [... x n x d]
-            affinity_type=self.affinity_type,
-            affinity_focal_gamma=self.affinity_focal_gamma,
-        ))                                                                          # [... x n x n]
-        d = features.shape[-1]
-        U, L = solve_eig(
-            torch.nan_to_num(self.A, nan=0.0),
-            num_eig=d + 1,  # d * (d + 3) // 2 + 1,
-            eig_solver=self.eig_solver,
-        )                                                                                           # [... x n x (d + 1)], [... x (d + 1)]
-        self.Ainv = U @ torch.nan_to_num(torch.diag_embed(1 / L), posinf=0.0, neginf=0.0) @ U.mT    # [... x n x n]
-        self.a_r = torch.where(self.anchor_mask, torch.inf, torch.sum(self.A.mT, dim=-1))           # [... x n]
+    def _solve_anchor_affinity(
+        self,
+        row_sum: torch.Tensor,
+        d: int,
+        warm_start: torch.Tensor = None,
+        warm_start_iter: int = 1,
+        warm_start_tol: float = None,
+    ) -> None:
+        with span("LaplacianKernel.solve_eig"):
+            U, L = solve_eig(
+                self.A if self.sparse_knn is not None else torch.nan_to_num(self.A, nan=0.0),
+                num_eig=d + 1,  # d * (d + 3) // 2 + 1,
+                eig_solver=self.eig_solver,
+                warm_start=warm_start,
+                warm_start_iter=warm_start_iter,
+                warm_start_tol=warm_start_tol,
+                eig_dtype=self.dtype_policy.eig_dtype,
+                num_workers=self.eig_num_workers,
+            )                                                                                       # [... x n x (d + 1)], [... x (d + 1)]
+        self.Ainv_U = U                                                                             # [... x n x (d + 1)]
+        self.Ainv_L = torch.nan_to_num(1 / L, posinf=0.0, neginf=0.0)                              # [... x (d + 1)]
+        self.a_r = torch.where(self.anchor_mask, torch.inf, row_sum)                                # [... x n]
         self.b_r = torch.zeros_like(self.a_r)                                                       # [... x n]
 
+    def _apply_Ainv(self, x: torch.Tensor) -> torch.Tensor:
+        # Ainv @ x evaluated through its rank-(d + 1) factors, Ainv is never materialized
+        return self.Ainv_U @ (self.Ainv_L[..., :, None] * (self.Ainv_U.mT @ x))    # [... x n x k]
+
+    def row_bytes(self, features: torch.Tensor) -> int:
+        # affinity column in the compute dtype, and its upcast copy in the accumulate dtype if it is cast
+        compute_dtype = self._compute_dtype(features)
+        accumulate_dtype = self._accumulate_dtype(features)
+        upcast_itemsize = accumulate_dtype.itemsize if compute_dtype != accumulate_dtype else 0
+        return features.shape[:-2].numel() * self.anchor_features.shape[-2] * (compute_dtype.itemsize + upcast_itemsize)
+
+    def _compute_dtype(self, features: torch.Tensor) -> torch.dtype:
+        return torch.promote_types(self.anchor_features.dtype, self.dtype_policy.compute_dtype or features.dtype)
+
+    def _accumulate_dtype(self, features: torch.Tensor) -> torch.dtype:
+        return self.dtype_policy.accumulate_dtype or self._compute_dtype(features)
+
+    def _raw_affinity(self, features: torch.Tensor, dtype: torch.dtype = None) -> torch.Tensor:
+        # the [n x m] affinities stay in the compute dtype unless another dtype is asked for, e.g. the accumulate
+        # dtype of the [n x n] anchor affinity, reductions over them are upcast chunk by chunk
+        features = self.dtype_policy.to_compute(features)                           # [... x m x d]
+        B = torch.empty(
+            (*features.shape[:-2], self.anchor_features.shape[-2], features.shape[-2]),
+            dtype=dtype or self._compute_dtype(features), device=features.device,
+        )                                                                           # [... x n x m]
+
+        # each chunk is written into its column slice of B, only the output spans every column
+        with span("LaplacianKernel.affinity", flops=2 * B.numel() * features.shape[-1]) as s:
+            start = 0
+            for chunk in CHUNK_PLANNER.split("LaplacianKernel.affinity", features, self.row_bytes(features)):
+                fused_affinity(
+                    self.anchor_features, chunk, self.affinity_type, self.affinity_focal_gamma,
+                    normalization_factor=self.normalization_factor,
+                    squared_norms_A=self.anchor_squared_norms,
+                    out=B[..., start:start + chunk.shape[-2]],
+                    use_compile=self.use_compile,
+                )                                                                   # [... x n x _m]
+                start += chunk.shape[-2]
+                s.add(chunks=1)
+        return B
+
+    def _sparse_anchor_affinity(self) -> SparseLowRankMatrix:
+        # top-k affinities of each anchor, symmetrized as (W + W.mT) / 2 so memory is linear in n * k
+        shape, n = self.anchor_features.shape[:-2], self.anchor_features.shape[-2]
+        k = min(self.sparse_knn, n)
+        rows, cols, values = [], [], []
+        start = 0
+        for chunk in CHUNK_PLANNER.split("LaplacianKernel.sparse_affinity", self.anchor_features, self.row_bytes(self.anchor_features)):
+            _B = torch.nan_to_num(
+                self._raw_affinity(chunk, self._accumulate_dtype(chunk)).masked_fill_(self.anchor_mask[..., None], 0.0), nan=0.0,
+            )                                                                       # [... x n x _m]
+            _values, _rows = torch.topk(_B, k=k, dim=-2)                            # [... x k x _m], int: [... x k x _m]
+            _cols = torch.arange(start, start + _B.shape[-1], device=_B.device).expand(_rows.shape)
+            rows.append(_rows)
+            cols.append(_cols)
+            values.append(_values)
+            start += _B.shape[-1]
+        rows, cols, values = (
+            torch.cat(x, dim=-1).reshape((shape.numel(), -1))
+            for x in (rows, cols, values)
+        )                                                                           # [(...) x (k * n)]
+        return SparseLowRankMatrix.from_coo(
+            torch.cat((rows, cols), dim=-1),
+            torch.cat((cols, rows), dim=-1),
+            torch.cat((values, values), dim=-1) / 2,
+            (*shape, n, n),
+        )
+
     def _affinity(self, features: torch.Tensor) -> torch.Tensor:
-        B = torch.where(self.anchor_mask[..., None], 0.0, affinity_from_features(
-            features_A=self.anchor_features,                                        # [... x n x d]
-            features_B=features,                                                    # [... x m x d]
-            affinity_type=self.affinity_type,
-            affinity_focal_gamma=self.affinity_focal_gamma,
-        ))                                                                          # [... x n x m]
+        B = self._raw_affinity(features).masked_fill_(self.anchor_mask[..., None], 0.0)    # [... x n x m]
         if self.adaptive_scaling:
-            diagonal = (
-                einops.rearrange(B, "... n m -> ... m 1 n")                         # [... x m x 1 x n]
-                @ self.Ainv                                                         # [... x n x n]
-                @ einops.rearrange(B, "... n m -> ... m n 1")                       # [... x m x n x 1]
-            ).squeeze(-2, -1)                                                       # [... x m]
+            # diag(B^T @ Ainv @ B) through the rank-(d + 1) factorization of Ainv
+            UB = upcast_matmul(self.Ainv_U.mT, B)                                   # [... x (d + 1) x m]
+            diagonal = ((UB ** 2).mT @ self.Ainv_L[..., :, None])[..., 0]           # [... x m]
             adaptive_scale = diagonal ** -0.5                                       # [... x m]
-            B = B * adaptive_scale[..., None, :]
+            B.mul_(adaptive_scale[..., None, :])
         return B                                                                    # [... x n x m]
 
+    @staticmethod
+    def _normalize_(B: torch.Tensor, row_sum: torch.Tensor, col_sum: torch.Tensor) -> torch.Tensor:
+        # diagonal scaling applied in place, never materializes the [n x m] normalization matrix
+        B.mul_(row_sum[..., :, None] ** -0.5).mul_(col_sum[..., None, :] ** -0.5)  # [... x n x m]
+        return B.mT                                                                 # [... x m x n]
+
     def update(self, features: torch.Tensor) -> torch.Tensor:
         B = self._affinity(features)                                                # [... x n x m]
-        b_r = torch.sum(torch.nan_to_num(B, nan=0.0), dim=-1)                       # [... x n]
-        b_c = torch.sum(B, dim=-2)                                                  # [... x m]
+        b_r = torch.nansum(B, dim=-1, dtype=self.b_r.dtype)                         # [... x n]
+        b_c = torch.sum(B, dim=-2, dtype=self.b_r.dtype)                            # [... x m]
         self.b_r = self.b_r + b_r                                                   # [... x n]
 
         row_sum = self.a_r + self.b_r                                               # [... x n]
-        col_sum = b_c + (B.mT @ (self.Ainv @ self.b_r[..., None]))[..., 0]          # [... x m]
-        scale = (row_sum[..., :, None] * col_sum[..., None, :]) ** -0.5             # [... x n x m]
-        return (B * scale).mT                                                       # [... x m x n]
+        col_sum = b_c + upcast_matmul(self._apply_Ainv(self.b_r[..., None]).mT, B)[..., 0, :]   # [... x m]
+        return self._normalize_(B, row_sum, col_sum)                                # [... x m x n]
+
+    def accumulate(self, features: torch.Tensor) -> Dict[str, Any]:
+        b_r = 0.0
+        for chunk in CHUNK_PLANNER.split("LaplacianKernel.accumulate", features, self.row_bytes(features)):
+            b_r = b_r + torch.nansum(self._affinity(chunk), dim=-1, dtype=self.b_r.dtype)   # [... x n]
+        return {"b_r": b_r}
+
+    def merge(self, stats: List[Dict[str, Any]]) -> None:
+        for _stats in stats:
+            self.b_r = self.b_r + _stats["b_r"]                                     # [... x n]
 
     def transform(self, features: torch.Tensor = None) -> torch.Tensor:
         row_sum = self.a_r + self.b_r                                               # [... x n]
-        if features is None:
-            B = self.A                                                              # [... x n x n]
+        if features is None and isinstance(self.A, SparseLowRankMatrix):
+            return self.A.scale(row_sum ** -0.5)                                    # [... x n x n]
+        elif features is None:
+            B = self.A.clone()                                                      # [... x n x n]
             col_sum = row_sum                                                       # [... x n]
         else:
             B = self._affinity(features)                                            # [... x n x m]
-            b_c = torch.sum(B, dim=-2)                                              # [... x m]
-            col_sum = b_c + (B.mT @ (self.Ainv @ self.b_r[..., None]))[..., 0]      # [... x m]
-        scale = (row_sum[..., :, None] * col_sum[..., None, :]) ** -0.5             # [... x n x m]
-        return (B * scale).mT                                                       # [... x m x n]
+            b_c = torch.sum(B, dim=-2, dtype=row_sum.dtype)                         # [... x m]
+            col_sum = b_c + upcast_matmul(self._apply_Ainv(self.b_r[..., None]).mT, B)[..., 0, :]   # [... x m]
+        return self._normalize_(B, row_sum, col_sum)                                # [... x m x n]
 
 
 class NystromNCut(OnlineTransformerSubsampleFit):
@@ -114,6 +279,16 @@ class NystromNCut(OnlineTransformerSubsampleFit):
         adaptive_scaling: bool = False,
         sample_config: SampleConfig = SampleConfig(),
         eig_solver: EigSolverOptions = "svd_lowrank",
+        warm_start: bool = False,
+        dtype_policy: DtypePolicy = DtypePolicy(),
+        eig_num_workers: int = 1,
+        num_workers: int = 1,
+        sparse_knn: int = None,
+        use_compile: bool = False,
+        temporal: bool = False,
+        max_drift_fraction: float = 0.25,
+        warm_start_iter: int = 1,
+        warm_start_tol: float = 1e-2,
     ):
         """
         Args:
@@ -125,14 +300,38 @@ class NystromNCut(OnlineTransformerSubsampleFit):
             sample_config (str): subgraph sampling, ['farthest', 'random'].
                 farthest point sampling is recommended for better Nystrom-approximation accuracy
             eig_solver (str): eigen decompose solver, ['svd_lowrank', 'lobpcg', 'svd', 'eigh'].
+            warm_start (bool): whether repeated update calls refine the previous eigenvectors instead of solving from scratch
+            dtype_policy (DtypePolicy): dtypes of the affinity, accumulation and eigensolve stages,
+                e.g. MIXED_PRECISION_POLICY computes affinities in bfloat16 and solves in float64
+            eig_num_workers (int): number of threads the per-image eigenproblems across batch dims are spread over
+            num_workers (int): number of worker processes the unsampled features are sharded across during fit
+            sparse_knn (int): if set, keep only the top-k affinities of each anchor in a sparse anchor graph
+                and solve it iteratively, so memory is linear instead of quadratic in num_sample
+            use_compile (bool): whether the affinity chunks of fit, update and transform run through torch.compile'd
+                kernels, compiled once per process with dynamic shapes so new chunk sizes do not recompile
+            temporal (bool): whether repeated fit calls on consecutive frames of a video carry the anchors over,
+                only replacing the anchors that no longer cover the new frame, best combined with warm_start
+            max_drift_fraction (float): largest fraction of the anchors replaced per frame in temporal mode
+            warm_start_iter (int): number of subspace iterations applied to the previous eigenvectors when warm starting
+            warm_start_tol (float): largest relative Ritz residual accepted from a warm start before solving from scratch
         """
         OnlineTransformerSubsampleFit.__init__(
             self,
             base_transformer=OnlineNystrom(
                 n_components=n_components,
-                kernel=LaplacianKernel(affinity_type, affinity_focal_gamma, adaptive_scaling, eig_solver),
+                kernel=LaplacianKernel(
+                    affinity_type, affinity_focal_gamma, adaptive_scaling, eig_solver, dtype_policy, eig_num_workers, sparse_knn, use_compile,
+                ),
                 eig_solver=eig_solver,
+                warm_start=warm_start,
+                eig_dtype=dtype_policy.eig_dtype,
+                eig_num_workers=eig_num_workers,
+                warm_start_iter=warm_start_iter,
+                warm_start_tol=warm_start_tol,
             ),
             distance_type=AFFINITY_TO_DISTANCE[affinity_type],
             sample_config=sample_config,
+            num_workers=num_workers,
+            temporal=temporal,
+            max_drift_fraction=max_drift_fraction,
         )
@@ -1,13 +1,24 @@
+import concurrent.futures
+import warnings
 from abc import abstractmethod
-from typing import Literal, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Literal, Sequence, Tuple, Union
 
 import torch
 
 from ..common import (
-    ceildiv,
+    StateDictMixin,
 )
 from ..global_settings import (
-    CHUNK_SIZE,
+    CHUNK_PLANNER,
+    resolve_eig_dtype,
+)
+from ..parallel_utils import (
+    shard_rows,
+    worker_pool,
+)
+from ..profiler import (
+    current_span,
+    span,
 )
 from ..transformer import (
     OnlineTorchTransformerMixin,
@@ -17,9 +28,20 @@ from ..transformer import (
 EigSolverOptions = Literal["svd_lowrank", "lobpcg", "svd", "eigh"]
 
 
-class OnlineKernel:
+class OnlineKernel(StateDictMixin):
     @abstractmethod
-    def fit(self, features: torch.Tensor) -> "OnlineKernel":                # [... x n x d]
+    def fit(self, features: torch.Tensor, normalization_factor: torch.Tensor = None) -> "OnlineKernel":  # [... x n x d]
+        """"""
+
+    @abstractmethod
+    def replace_anchors(
+        self,
+        indices: torch.Tensor,                      # int: [... x k]
+        features: torch.Tensor,                     # float: [... x k x d]
+        warm_start: bool = False,
+        warm_start_iter: int = 1,
+        warm_start_tol: float = None,
+    ) -> None:
         """"""
 
     @abstractmethod
@@ -30,6 +52,117 @@ class OnlineKernel:
     def transform(self, features: torch.Tensor = None) -> torch.Tensor:     # [... x m x d] -> [... x m x n]
         """"""
 
+    @abstractmethod
+    def row_bytes(self, features: torch.Tensor) -> int:                     # [... x m x d] -> bytes per row of m
+        """"""
+
+    @abstractmethod
+    def accumulate(self, features: torch.Tensor) -> Dict[str, Any]:         # [... x m x d] -> partial statistics of update
+        """"""
+
+    @abstractmethod
+    def merge(self, stats: List[Dict[str, Any]]) -> None:                   # applies the summed statistics of every shard
+        """"""
+
+
+class SparseLowRankMatrix(StateDictMixin):
+    """Symmetric matrix of shape (..., n, n) stored as a sparse part plus a low rank part U @ C @ U.mT,
+    used where a dense [n x n] matrix does not fit. Only products with dense matrices are supported.
+    The sparse part is a single block diagonal CSR matrix of shape (bsz * n, bsz * n) over the flattened batch dims,
+    so that batches with different numbers of stored entries share one sparse matmul.
+    """
+    def __init__(
+        self,
+        crow_indices: torch.Tensor,                 # int: [bsz * n + 1]
+        col_indices: torch.Tensor,                  # int: [nnz]
+        values: torch.Tensor,                       # float: [nnz]
+        matrix_shape: Sequence[int],                # (..., n, n)
+        U: torch.Tensor = None,                     # [... x n x r]
+        C: torch.Tensor = None,                     # [... x r x r]
+    ):
+        self.crow_indices: torch.Tensor = crow_indices
+        self.col_indices: torch.Tensor = col_indices
+        self.values: torch.Tensor = values
+        self.matrix_shape: Tuple[int, ...] = tuple(matrix_shape)
+        self.U: torch.Tensor = U
+        self.C: torch.Tensor = C
+
+    @classmethod
+    def from_coo(
+        cls,
+        rows: torch.Tensor,                         # int: [(...) x nnz']
+        cols: torch.Tensor,                         # int: [(...) x nnz']
+        values: torch.Tensor,                       # float: [(...) x nnz']
+        matrix_shape: Sequence[int],
+    ) -> "SparseLowRankMatrix":
+        """Builds the sparse part from per-batch entries, duplicate entries are summed."""
+        n = matrix_shape[-1]
+        N = rows.shape[0] * n
+        offsets = torch.arange(rows.shape[0], device=rows.device)[:, None] * n      # int: [(...) x 1]
+        indices = torch.stack(((rows + offsets).flatten(), (cols + offsets).flatten()), dim=0)
+        A = torch.sparse_coo_tensor(indices, values.flatten(), (N, N)).coalesce().to_sparse_csr()
+        return cls(A.crow_indices(), A.col_indices(), A.values(), matrix_shape)
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size(self.matrix_shape)
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.values.dtype
+
+    @property
+    def device(self) -> torch.device:
+        return self.values.device
+
+    def _sparse(self) -> torch.Tensor:
+        N = self.shape[:-2].numel() * self.shape[-1]
+        return torch.sparse_csr_tensor(self.crow_indices, self.col_indices, self.values, (N, N))
+
+    def _rows(self) -> torch.Tensor:
+        return torch.repeat_interleave(
+            torch.arange(len(self.crow_indices) - 1, device=self.device), torch.diff(self.crow_indices),
+        )                                                                           # int: [nnz]
+
+    def __matmul__(self, X: torch.Tensor) -> torch.Tensor:
+        _X = X.reshape((-1, *X.shape[-2:]))                                         # [(...) x n x k]
+        out = (self._sparse() @ _X.reshape((-1, X.shape[-1]))).view(_X.shape)      # [(...) x n x k]
+        if self.U is not None:
+            U = self.U.reshape((-1, *self.U.shape[-2:]))                            # [(...) x n x r]
+            C = self.C.reshape((-1, *self.C.shape[-2:]))                            # [(...) x r x r]
+            out = out + U @ (C @ (U.mT @ _X))
+        return out.view(X.shape)                                                    # [... x n x k]
+
+    def to(self, dtype: torch.dtype) -> "SparseLowRankMatrix":
+        return SparseLowRankMatrix(
+            self.crow_indices, self.col_indices, self.values.to(dtype), self.matrix_shape,
+            None if self.U is None else self.U.to(dtype),
+            None if self.C is None else self.C.to(dtype),
+        )
+
+    def row_sum(self) -> torch.Tensor:
+        ones = torch.ones((*self.shape[:-1], 1), dtype=self.dtype, device=self.device)
+        return (self @ ones)[..., 0]                                                # [... x n]
+
+    def scale(self, d: torch.Tensor) -> "SparseLowRankMatrix":
+        """diag(d) @ self @ diag(d), the low rank part is scaled through U."""
+        d = d.flatten()                                                             # [(...) * n]
+        return SparseLowRankMatrix(
+            self.crow_indices, self.col_indices, self.values * d[self._rows()] * d[self.col_indices], self.matrix_shape,
+            None if self.U is None else self.U * d.view(self.shape[:-1])[..., None],
+            self.C,
+        )
+
+    def add_low_rank(self, U: torch.Tensor, C: torch.Tensor) -> "SparseLowRankMatrix":
+        """self + U @ C @ U.mT, stacked next to the existing low rank part."""
+        if self.U is not None:
+            r = self.U.shape[-1]
+            _C = C.new_zeros((*C.shape[:-2], r + C.shape[-2], r + C.shape[-1]))
+            _C[..., :r, :r] = self.C
+            _C[..., r:, r:] = C
+            U, C = torch.cat((self.U, U), dim=-1), _C
+        return SparseLowRankMatrix(self.crow_indices, self.col_indices, self.values, self.matrix_shape, U, C)
+
 
 class OnlineNystrom(OnlineTorchTransformerMixin):
     def __init__(
@@ -37,148 +170,317 @@ class OnlineNystrom(OnlineTorchTransformerMixin):
         n_components: int,
         kernel: OnlineKernel,
         eig_solver: EigSolverOptions,
+        warm_start: bool = False,
+        eig_dtype: torch.dtype = None,
+        eig_num_workers: int = 1,
+        warm_start_iter: int = 1,
+        warm_start_tol: float = 1e-2,
     ):
         """
         Args:
             n_components (int): number of top eigenvectors to return
             kernel (OnlineKernel): Online kernel that computes pairwise matrix entries from input features and allows updates
             eig_solver (str): eigen decompose solver, ['svd_lowrank', 'lobpcg', 'svd', 'eigh'].
+            warm_start (bool): whether update refines the previous eigenvectors with subspace iteration
+                instead of solving from scratch, for streams where the spectrum moves little between batches
+            eig_dtype (torch.dtype): dtype the eigensolves run in, None keeps the kernel dtype
+            eig_num_workers (int): number of threads the independent eigenproblems across batch dims are spread over
+            warm_start_iter (int): number of subspace iterations applied to the previous eigenvectors when warm starting
+            warm_start_tol (float): largest Ritz residual accepted from a warm start relative to the top eigenvalue,
+                above which the eigenproblem is solved from scratch
         """
         self.n_components: int = n_components
         self.kernel: OnlineKernel = kernel
         self.eig_solver: EigSolverOptions = eig_solver
+        self.warm_start: bool = warm_start
+        self.eig_dtype: torch.dtype = eig_dtype
+        self.eig_num_workers: int = eig_num_workers
+        self.warm_start_iter: int = warm_start_iter
+        self.warm_start_tol: float = warm_start_tol
         self.shape: torch.Size = None               # ...
 
         # Anchor matrices
         self.anchor_features: torch.Tensor = None   # [... x n x d]
         self.A: torch.Tensor = None                 # [... x n x n]
-        self.Ahinv: torch.Tensor = None             # [... x n x n]
         self.Ahinv_UL: torch.Tensor = None          # [... x n x indirect_pca_dim]
         self.Ahinv_VT: torch.Tensor = None          # [... x indirect_pca_dim x n]
+        # Eigenpairs of the last fit, restored when no anchor is replaced
+        self.anchor_U: torch.Tensor = None          # [... x n x indirect_pca_dim]
+        self.anchor_L: torch.Tensor = None          # [... x indirect_pca_dim]
 
         # Updated matrices
         self.S: torch.Tensor = None                 # [... x n x n]
+        self.US: torch.Tensor = None                # [... x n x n_components]
         self.transform_matrix: torch.Tensor = None  # [... x n x n_components]
         self.eigenvalues_: torch.Tensor = None      # [... x n_components]
 
-    def _update_to_kernel(self, d: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    def _update_to_kernel(self, d: int, warm_start: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
         self.A = self.kernel.transform()
-        self.S = torch.nan_to_num(self.A, nan=0.0)
-        U, L = solve_eig(
-            self.S,
-            num_eig=d + 1,  # d * (d + 3) // 2 + 1,
-            eig_solver=self.eig_solver,
-        )                                                                                           # [... x n x (? + 1)], [... x (? + 1)]
+        if isinstance(self.A, SparseLowRankMatrix):
+            self.S = self.A
+        else:
+            self.S = torch.nan_to_num(self.A, nan=0.0)
+        with span("OnlineNystrom.solve_eig"):
+            U, L = solve_eig(
+                self.S,
+                num_eig=d + 1,  # d * (d + 3) // 2 + 1,
+                eig_solver=self.eig_solver,
+                warm_start=self.Ahinv_VT.mT if warm_start else None,
+                warm_start_iter=self.warm_start_iter,
+                warm_start_tol=self.warm_start_tol,
+                eig_dtype=self.eig_dtype,
+                num_workers=self.eig_num_workers,
+            )                                                                                       # [... x n x (? + 1)], [... x (? + 1)]
         self.Ahinv_UL = U * (L[..., None, :] ** -0.5)                                               # [... x n x (? + 1)]
         self.Ahinv_VT = U.mT                                                                        # [... x (? + 1) x n]
-        self.Ahinv = self.Ahinv_UL @ self.Ahinv_VT                                                  # [... x n x n]
         return U, L
 
-    def fit(self, features: torch.Tensor) -> "OnlineNystrom":
+    def row_bytes(self, features: torch.Tensor) -> int:
+        # kernel intermediates, compressed projection and output of each row
+        return self.kernel.row_bytes(features) + (
+            features.shape[:-2].numel() * (self.Ahinv_VT.shape[-2] + self.n_components) * self.A.dtype.itemsize
+        )
+
+    def fit(self, features: torch.Tensor, normalization_factor: torch.Tensor = None) -> "OnlineNystrom":
         self.anchor_features = features
 
-        self.kernel.fit(self.anchor_features)
-        U, L = self._update_to_kernel(features.shape[-1])                                           # [... x n x (d + 1)], [... x (d + 1)]
+        self.kernel.fit(self.anchor_features, normalization_factor=normalization_factor)
+        self._fit_to_kernel(features.shape[-1])
+        return self
 
-        self.transform_matrix = (U / L[..., None, :])[..., :, :self.n_components]                   # [... x n x n_components]
-        self.eigenvalues_ = L[..., :self.n_components]                                              # [... x n_components]
+    def replace_anchors(self, indices: torch.Tensor, features: torch.Tensor) -> "OnlineNystrom":
+        """Replaces some anchors in place of a new fit, only the affinities of the replaced anchors are recomputed.
+        With warm_start, the eigenproblems are warm started from the previous eigenvectors unless more than half of the
+        anchors are replaced, and fall back to a cold solve above warm_start_tol. Previous updates are discarded as in fit,
+        if no anchor is replaced this is all that happens and nothing is solved again.
+        Args:
+            indices (torch.Tensor): positions of the replaced anchors, shape (..., k)
+            features (torch.Tensor): new anchor features, shape (..., k, n_features)
+        Returns:
+            (OnlineNystrom): self
+        """
+        if indices.shape[-1] == 0:
+            self.kernel.replace_anchors(indices, features)
+            self._reset_to_kernel()
+            return self
+        self.anchor_features = self.anchor_features.scatter(-2, indices[..., None].expand(features.shape), features)
+        warm_start = self.warm_start and 2 * indices.shape[-1] <= self.anchor_features.shape[-2]
+        self.kernel.replace_anchors(
+            indices, features,
+            warm_start=warm_start,
+            warm_start_iter=self.warm_start_iter,
+            warm_start_tol=self.warm_start_tol,
+        )
+        self._fit_to_kernel(features.shape[-1], warm_start=warm_start)
         return self
 
-    def update(self, features: torch.Tensor) -> torch.Tensor:
-        d = features.shape[-1]
-        n_chunks = ceildiv(features.shape[-2], CHUNK_SIZE)
-        if n_chunks > 1:
-            """ Chunked version """
-            chunks = torch.chunk(features, n_chunks, dim=-2)
-            for chunk in chunks:
-                self.kernel.update(chunk)
-            self._update_to_kernel(d)
-
-            compressed_BBT = 0.0                                                                    # [... x (? + 1) x (? + 1))]
-            for chunk in chunks:
-                _B = self.kernel.transform(chunk).mT                                                # [... x n x _m]
-                _compressed_B = self.Ahinv_VT @ _B                                                  # [... x (? + 1) x _m]
-                _compressed_B = torch.nan_to_num(_compressed_B, nan=0.0)
-                compressed_BBT = compressed_BBT + _compressed_B @ _compressed_B.mT                  # [... x (? + 1) x (? + 1)]
-            self.S = self.S + self.Ahinv_UL @ compressed_BBT @ self.Ahinv_UL.mT                     # [... x n x n]
-            US, self.eigenvalues_ = solve_eig(self.S, self.n_components, self.eig_solver)           # [... x n x n_components], [... x n_components]
-            self.transform_matrix = self.Ahinv @ US * (self.eigenvalues_[..., None, :] ** -0.5)     # [... x n x n_components]
-
-            VS = []
-            for chunk in chunks:
-                VS.append(self.kernel.transform(chunk) @ self.transform_matrix)                     # [... x _m x n_components]
-            VS = torch.cat(VS, dim=-2)
-            return VS                                                                               # [... x m x n_components]
+    def _fit_to_kernel(self, d: int, warm_start: bool = False) -> None:
+        U, L = self._update_to_kernel(d, warm_start=warm_start)                                     # [... x n x (d + 1)], [... x (d + 1)]
+        self.anchor_U, self.anchor_L = U, L
+        self._set_anchor_eig(U, L)
+
+    def _reset_to_kernel(self) -> None:
+        # the kernel is back to its state after the last fit, whose eigenpairs are restored instead of solved again
+        self.A = self.kernel.transform()
+        if isinstance(self.A, SparseLowRankMatrix):
+            self.S = self.A
         else:
-            """ Unchunked version """
-            B = self.kernel.update(features).mT                                                     # [... x n x m]
-            self._update_to_kernel(d)
-            compressed_B = self.Ahinv_VT @ B                                                        # [... x (? + 1) x m]
-            compressed_B = torch.nan_to_num(compressed_B, nan=0.0)
+            self.S = torch.nan_to_num(self.A, nan=0.0)
+        self.Ahinv_UL = self.anchor_U * (self.anchor_L[..., None, :] ** -0.5)                       # [... x n x (d + 1)]
+        self.Ahinv_VT = self.anchor_U.mT                                                            # [... x (d + 1) x n]
+        self._set_anchor_eig(self.anchor_U, self.anchor_L)
+
+    def _set_anchor_eig(self, U: torch.Tensor, L: torch.Tensor) -> None:
+        self.US = U[..., :, :self.n_components]                                                     # [... x n x n_components]
+        self.transform_matrix = (U / L[..., None, :])[..., :, :self.n_components]                   # [... x n x n_components]
+        self.eigenvalues_ = L[..., :self.n_components]                                              # [... x n_components]
 
-            self.S = self.S + self.Ahinv_UL @ (compressed_B @ compressed_B.mT) @ self.Ahinv_UL.mT   # [... x n x n]
-            US, self.eigenvalues_ = solve_eig(self.S, self.n_components, self.eig_solver)           # [... x n x n_components], [... x n_components]
-            self.transform_matrix = self.Ahinv @ US * (self.eigenvalues_[..., None, :] ** -0.5)     # [... x n x n_components]
+    def _update_chunks(
+        self,
+        chunks: Callable[[], Iterable[torch.Tensor]],
+        d: int,
+        keep_compressed: bool = False,
+    ) -> List[torch.Tensor]:
+        for chunk in chunks():
+            self.kernel.update(chunk)
+        self._update_to_kernel(d, warm_start=self.warm_start)
 
-            return B.mT @ self.transform_matrix                                                     # [... x m x n_components]
+        compressed_Bs = []
+        compressed_BBT = 0.0                                                                        # [... x (? + 1) x (? + 1))]
+        for chunk in chunks():
+            _B = self.kernel.transform(chunk).mT                                                    # [... x n x _m]
+            _compressed_B = upcast_matmul(self.Ahinv_VT, _B)                                        # [... x (? + 1) x _m]
+            if keep_compressed:
+                compressed_Bs.append(_compressed_B)
+            _compressed_B = torch.nan_to_num(_compressed_B, nan=0.0)
+            compressed_BBT = compressed_BBT + _compressed_B @ _compressed_B.mT                      # [... x (? + 1) x (? + 1)]
+        self._update_from_compressed(compressed_BBT)
+        return compressed_Bs
 
-    def transform(self, features: torch.Tensor = None) -> torch.Tensor:
-        if features is None:
-            VS = self.A @ self.transform_matrix                                                     # [... x n x n_components]
+    def _update_from_compressed(self, compressed_BBT: torch.Tensor) -> None:
+        if isinstance(self.S, SparseLowRankMatrix):
+            self.S = self.S.add_low_rank(self.Ahinv_UL, compressed_BBT)                             # [... x n x n]
         else:
-            n_chunks = ceildiv(features.shape[-2], CHUNK_SIZE)
-            if n_chunks > 1:
+            self.S = self.S + self.Ahinv_UL @ compressed_BBT @ self.Ahinv_UL.mT                     # [... x n x n]
+        with span("OnlineNystrom.solve_eig"):
+            self.US, self.eigenvalues_ = solve_eig(
+                self.S, self.n_components, self.eig_solver,
+                warm_start=self.US if self.warm_start else None,
+                warm_start_iter=self.warm_start_iter,
+                warm_start_tol=self.warm_start_tol,
+                eig_dtype=self.eig_dtype,
+                num_workers=self.eig_num_workers,
+            )                                                                                       # [... x n x n_components], [... x n_components]
+        self.transform_matrix = self.Ahinv_UL @ (self.Ahinv_VT @ self.US) * (self.eigenvalues_[..., None, :] ** -0.5)    # [... x n x n_components]
+
+    def _accumulate_compressed(self, features: torch.Tensor) -> torch.Tensor:
+        compressed_BBT = 0.0                                                                        # [... x (? + 1) x (? + 1))]
+        for chunk in CHUNK_PLANNER.split("OnlineNystrom.accumulate", features, self.row_bytes(features)):
+            _compressed_B = torch.nan_to_num(upcast_matmul(self.Ahinv_VT, self.kernel.transform(chunk).mT), nan=0.0)   # [... x (? + 1) x _m]
+            compressed_BBT = compressed_BBT + _compressed_B @ _compressed_B.mT                      # [... x (? + 1) x (? + 1)]
+        return compressed_BBT
+
+    def update(self, features: torch.Tensor) -> torch.Tensor:
+        d = features.shape[-1]
+        chunks = CHUNK_PLANNER.split("OnlineNystrom.update", features, self.row_bytes(features))
+        # compression and projection of every row, affinities and eigensolves are counted by their own spans
+        n, p = self.anchor_features.shape[-2], self.Ahinv_VT.shape[-2]
+        flops = 2 * features.shape[:-1].numel() * (p * n + p * p + n * self.n_components)
+        with span("OnlineNystrom.update", flops=flops, chunks=len(chunks)):
+            if len(chunks) > 1:
                 """ Chunked version """
-                chunks = torch.chunk(features, n_chunks, dim=-2)
+                compressed_Bs = self._update_chunks(lambda: chunks, d, keep_compressed=True)
+
+                # B.mT @ transform_matrix == (Ahinv_VT @ B).mT @ (Ahinv_UL.mT @ US) * eigenvalues ** -0.5,
+                # so outputs are recovered from the compressed projections without recomputing any affinity
+                compressed_transform_matrix = (
+                    (self.Ahinv_UL.mT @ self.US) * (self.eigenvalues_[..., None, :] ** -0.5)
+                )                                                                                   # [... x (? + 1) x n_components]
                 VS = []
-                for chunk in chunks:
-                    VS.append(self.kernel.transform(chunk) @ self.transform_matrix)                 # [... x _m x n_components]
+                for _compressed_B in compressed_Bs:
+                    VS.append(_compressed_B.mT @ compressed_transform_matrix)                      # [... x _m x n_components]
                 VS = torch.cat(VS, dim=-2)
+                return VS                                                                           # [... x m x n_components]
             else:
                 """ Unchunked version """
-                VS = self.kernel.transform(features) @ self.transform_matrix                        # [... x m x n_components]
+                B = self.kernel.update(features).mT                                                 # [... x n x m]
+                self._update_to_kernel(d, warm_start=self.warm_start)
+                compressed_B = upcast_matmul(self.Ahinv_VT, B)                                      # [... x (? + 1) x m]
+                compressed_B = torch.nan_to_num(compressed_B, nan=0.0)
+                self._update_from_compressed(compressed_B @ compressed_B.mT)
+
+                return upcast_matmul(B.mT, self.transform_matrix)                                   # [... x m x n_components]
+
+    def update_stream(self, chunks: Callable[[], Iterable[torch.Tensor]]) -> None:
+        """
+        Args:
+            chunks (Callable): returns a fresh iterator over chunks of shape (..., chunk_size, n_features) on every call,
+                the chunks are traversed twice and never held in memory together
+        """
+        self._update_chunks(chunks, self.anchor_features.shape[-1])
+
+    def update_parallel(self, features: torch.Tensor, num_workers: int) -> torch.Tensor:
+        """Data-parallel update, each worker process computes the sufficient statistics of a shard of the features
+        against the shared anchor state and the parent merges them, in two rounds since the compressed products
+        depend on the kernel row sums of every shard.
+        Args:
+            features (torch.Tensor): new features, shape (..., m_samples, n_features)
+            num_workers (int): number of worker processes, spawned per call unless inside `persistent_worker_pool`
+        Returns:
+            (torch.Tensor): eigenvectors of the new features, shape (..., m_samples, n_components)
+        """
+        shards = shard_rows(features, num_workers)
+        with worker_pool(len(shards)) as pool:
+            self.kernel.merge(pool.map(self.kernel.accumulate, shards))
+            self._update_to_kernel(features.shape[-1], warm_start=self.warm_start)
+            self._update_from_compressed(sum(pool.map(self._accumulate_compressed, shards)))
+            return torch.cat(pool.map(self.transform, shards), dim=-2)                             # [... x m x n_components]
+
+    def transform(self, features: torch.Tensor = None) -> torch.Tensor:
+        if features is None:
+            VS = self.A @ self.transform_matrix                                                     # [... x n x n_components]
+        else:
+            chunks = CHUNK_PLANNER.split("OnlineNystrom.transform", features, self.row_bytes(features))
+            flops = 2 * features.shape[:-1].numel() * self.anchor_features.shape[-2] * self.n_components
+            with span("OnlineNystrom.transform", flops=flops, chunks=len(chunks)):
+                if len(chunks) > 1:
+                    """ Chunked version """
+                    VS = []
+                    for chunk in chunks:
+                        VS.append(upcast_matmul(self.kernel.transform(chunk), self.transform_matrix))   # [... x _m x n_components]
+                    VS = torch.cat(VS, dim=-2)
+                else:
+                    """ Unchunked version """
+                    VS = upcast_matmul(self.kernel.transform(features), self.transform_matrix)      # [... x m x n_components]
         return VS                                                                                   # [... x m x n_components]
 
 
 def solve_eig(
-    A: torch.Tensor,
+    A: Union[torch.Tensor, SparseLowRankMatrix],
     num_eig: int,
     eig_solver: EigSolverOptions,
     eig_value_buffer: float = 0.0,
+    warm_start: torch.Tensor = None,
+    warm_start_iter: int = 1,
+    warm_start_tol: float = None,
+    eig_dtype: torch.dtype = None,
+    num_workers: int = 1,
+    sparse_n_iter: int = 10,
+    sparse_tol: float = 1e-4,
+    sparse_max_iter: int = 200,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """PyTorch implementation of Eigensolver cut without Nystrom-like approximation.
 
     Args:
-        A (torch.Tensor): input matrix, shape (n_samples, n_samples)
+        A (torch.Tensor | SparseLowRankMatrix): input matrix, shape (n_samples, n_samples), a SparseLowRankMatrix
+            is solved by subspace iteration on matrix products regardless of eig_solver
         num_eig (int): number of eigenvectors to return
         eig_solver (str): eigen decompose solver, ['svd_lowrank', 'lobpcg', 'svd', 'eigh']
         eig_value_buffer (float): value added to diagonal to buffer symmetric but non-PSD matrices
+        warm_start (torch.Tensor): previous eigenvectors used as the starting subspace, shape (n_samples, num_eig),
+            overrides eig_solver with `warm_start_iter` subspace iterations followed by Rayleigh-Ritz
+        warm_start_iter (int): number of subspace iterations applied to warm_start
+        warm_start_tol (float): largest Ritz residual accepted from warm_start relative to the top eigenvalue,
+            above which the eigenproblem is solved from scratch, None always accepts it
+        eig_dtype (torch.dtype): dtype the eigensolve runs in, float32 or float64, default A's dtype (at least float32),
+            the outputs are cast back to A's dtype after sorting and sign correction
+        num_workers (int): number of threads the independent eigenproblems across batch dims are spread over,
+            each thread solves a contiguous slice of the batch
+        sparse_n_iter (int): number of subspace iterations applied to the oversampled subspace of a SparseLowRankMatrix
+            between two residual checks
+        sparse_tol (float): largest Ritz residual of a SparseLowRankMatrix relative to the top eigenvalue,
+            the subspace iteration continues until every returned eigenpair is below it
+        sparse_max_iter (int): largest number of subspace iterations for a SparseLowRankMatrix, warns if not converged
     Returns:
         (torch.Tensor): eigenvectors corresponding to the eigenvalues, shape (n_samples, num_eig)
         (torch.Tensor): eigenvalues of the eigenvectors, sorted in descending order
     """
     shape: torch.Size = A.shape[:-2]
-    A = A.view((-1, *A.shape[-2:]))
-    bsz: int = A.shape[0]
+    bsz: int = shape.numel()
 
-    A = A + eig_value_buffer * torch.eye(A.shape[-1], device=A.device)
+    dtype = A.dtype
+    A = A.to(resolve_eig_dtype(dtype, eig_dtype))
+    if isinstance(A, SparseLowRankMatrix):
+        # the sparse matrix is never densified, so no diagonal buffer is added
+        eig_value_buffer = 0.0
+    else:
+        A = A.view((-1, *A.shape[-2:]))
+        A = A + eig_value_buffer * torch.eye(A.shape[-1], device=A.device, dtype=A.dtype)
     num_eig = min(A.shape[-1], num_eig)
     # compute eigenvectors
-    if eig_solver == "svd_lowrank":  # default
-        # only top q eigenvectors, fastest
-        eigen_vector, eigen_value, _ = torch.svd_lowrank(A, q=num_eig)              # complex: [(...) x N x D], [(...) x D]
-    elif eig_solver == "lobpcg":
-        # only top k eigenvectors, fast
-        eigen_value, eigen_vector = torch.lobpcg(A, k=num_eig)
-    elif eig_solver == "svd":
-        # all eigenvectors, slow
-        eigen_vector, eigen_value, _ = torch.svd(A)
-    elif eig_solver == "eigh":
-        # all eigenvectors, slow
-        eigen_value, eigen_vector = torch.linalg.eigh(A)
-    else:
-        raise ValueError(
-            "eigen_solver should be 'lobpcg', 'svd_lowrank', 'svd' or 'eigh'"
+    eigen_vector = eigen_value = None
+    if warm_start is not None and warm_start.shape[-2:] == (A.shape[-1], num_eig):
+        # refine the previous eigenvectors, cheapest when the spectrum barely moved
+        warm_start = warm_start.reshape((-1, *warm_start.shape[-2:])).to(A.dtype)
+        eigen_vector, eigen_value = subspace_iteration(A, warm_start, n_iter=warm_start_iter)
+        # products of the iterations, the Rayleigh-Ritz step and the residual check
+        current_span().add(flops=(warm_start_iter + 1 + (warm_start_tol is not None)) * _product_flops(A, num_eig))
+        if warm_start_tol is not None and ritz_residual(A, eigen_vector, eigen_value) > warm_start_tol:
+            # the spectrum moved too far for the warm start to converge, solve from scratch
+            eigen_vector = eigen_value = None
+    if eigen_vector is None:
+        eigen_vector, eigen_value = _solve_eig_cold(
+            A, bsz, num_eig, eig_solver, num_workers, sparse_n_iter, sparse_tol, sparse_max_iter,
         )
     eigen_value = eigen_value - eig_value_buffer
 
@@ -192,6 +494,172 @@ def solve_eig(
     sign[sign == 0] = 1.0
     eigen_vector = eigen_vector * sign
 
-    eigen_value = eigen_value.view((*shape, *eigen_value.shape[-1:]))               # complex: [... x S]
-    eigen_vector = eigen_vector.view((*shape, *eigen_vector.shape[-2:]))            # complex: [... x N x S]
+    eigen_value = eigen_value.view((*shape, *eigen_value.shape[-1:])).to(dtype)     # complex: [... x S]
+    eigen_vector = eigen_vector.view((*shape, *eigen_vector.shape[-2:])).to(dtype)  # complex: [... x N x S]
+    return eigen_vector, eigen_value
+
+
+def _solve_eig_cold(
+    A: Union[torch.Tensor, SparseLowRankMatrix],
+    bsz: int,
+    num_eig: int,
+    eig_solver: EigSolverOptions,
+    num_workers: int,
+    sparse_n_iter: int,
+    sparse_tol: float,
+    sparse_max_iter: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    if isinstance(A, SparseLowRankMatrix):
+        # only matrix products are available, refine a random subspace oversampled by a factor of 2 until the
+        # num_eig dominant Ritz pairs converge, the smallest of them are inverted downstream so they must not be noise
+        X = torch.randn((bsz, A.shape[-1], min(2 * num_eig, A.shape[-1])), device=A.device, dtype=A.dtype)
+        n_iter = 0
+        while True:
+            X, eigen_value = subspace_iteration(A, X, n_iter=sparse_n_iter)        # [(...) x N x S], [(...) x S]
+            n_iter += sparse_n_iter
+            indices = torch.topk(eigen_value.abs(), k=num_eig, dim=-1).indices     # int: [(...) x num_eig]
+            residual = ritz_residual(
+                A, torch.gather(X, -1, indices[..., None, :].expand((-1, X.shape[-2], -1))),
+                torch.gather(eigen_value, -1, indices),
+            )
+            current_span().add(flops=(sparse_n_iter + 1) * _product_flops(A, X.shape[-1]) + _product_flops(A, num_eig))
+            if residual <= sparse_tol:
+                break
+            elif n_iter >= sparse_max_iter:
+                warnings.warn(
+                    f"Sparse eigensolve did not converge after {n_iter} iterations, relative Ritz residual {residual:.2e} "
+                    f"is above {sparse_tol:.2e}, the smallest eigenvalues may be inaccurate."
+                )
+                break
+        return X, eigen_value
+    elif eig_solver in EigSolverOptions.__args__:
+        current_span().add(flops=_dense_eig_flops(A, num_eig, eig_solver))
+        num_workers = max(min(num_workers, bsz), 1)
+        if num_workers > 1:
+            # linalg kernels release the GIL, so threads solve slices of the batch concurrently
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = list(executor.map(
+                    lambda _A: _solve_eig_batch(_A, num_eig, eig_solver),
+                    torch.tensor_split(A, num_workers, dim=0),
+                ))
+            eigen_vector = torch.cat([_eigen_vector for _eigen_vector, _ in results], dim=0)
+            eigen_value = torch.cat([_eigen_value for _, _eigen_value in results], dim=0)
+            return eigen_vector, eigen_value
+        else:
+            return _solve_eig_batch(A, num_eig, eig_solver)
+    else:
+        raise ValueError(
+            "eigen_solver should be 'lobpcg', 'svd_lowrank', 'svd' or 'eigh'"
+        )
+
+
+def _product_flops(A: Union[torch.Tensor, SparseLowRankMatrix], k: int) -> float:
+    # A @ X for X with k columns, over every batch element
+    if isinstance(A, SparseLowRankMatrix):
+        r = 0 if A.U is None else A.U.shape[-1]
+        return 2 * k * (A.values.numel() + 2 * A.shape[:-1].numel() * r)
+    return 2 * k * A.numel()
+
+
+def _dense_eig_flops(A: torch.Tensor, num_eig: int, eig_solver: EigSolverOptions) -> float:
+    # rough counts of the solvers in _solve_eig_batch: svd_lowrank with 2 power iterations, lobpcg at about
+    # 20 iterations of a 3 * num_eig block, and the Golub-Van Loan counts of eigh and svd with vectors
+    bsz, n = A.shape[0], A.shape[-1]
+    if eig_solver == "svd_lowrank":
+        return 6 * _product_flops(A, num_eig)
+    elif eig_solver == "lobpcg" and n >= 3 * num_eig:
+        return 20 * _product_flops(A, 3 * num_eig)
+    elif eig_solver == "svd":
+        return 21 * bsz * n ** 3
+    else:
+        return 9 * bsz * n ** 3
+
+
+def _solve_eig_batch(
+    A: torch.Tensor,
+    num_eig: int,
+    eig_solver: EigSolverOptions,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    if eig_solver == "svd_lowrank":  # default
+        # only top q eigenvectors, fastest
+        eigen_vector, eigen_value, _ = torch.svd_lowrank(A, q=num_eig)              # complex: [(...) x N x D], [(...) x D]
+    elif eig_solver == "lobpcg" and A.shape[-1] >= 3 * num_eig:
+        # only top k eigenvectors, fast, torch.lobpcg does not support batches so each problem is solved separately
+        eigen_value, eigen_vector = map(torch.stack, zip(*(
+            torch.lobpcg(_A, k=num_eig)
+            for _A in A
+        )))                                                                         # [(...) x D], [(...) x N x D]
+    elif eig_solver == "svd":
+        # all eigenvectors, slow
+        eigen_vector, eigen_value, _ = torch.svd(A)
+    else:
+        # all eigenvectors, slow, also used by lobpcg when N < 3 * num_eig where it is not applicable
+        eigen_value, eigen_vector = torch.linalg.eigh(A)
     return eigen_vector, eigen_value
+
+
+def subspace_iteration(
+    A: Union[torch.Tensor, SparseLowRankMatrix],
+    X: torch.Tensor,
+    n_iter: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Subspace iteration with a final Rayleigh-Ritz step for the dominant eigenpairs of symmetric A.
+
+    Args:
+        A (torch.Tensor | SparseLowRankMatrix): symmetric input matrix, shape (bsz, n_samples, n_samples)
+        X (torch.Tensor): starting subspace, shape (bsz, n_samples, num_eig)
+        n_iter (int): number of multiplications by A before the Rayleigh-Ritz step
+    Returns:
+        (torch.Tensor): Ritz vectors, shape (bsz, n_samples, num_eig)
+        (torch.Tensor): Ritz values, shape (bsz, num_eig)
+    """
+    X = torch.linalg.qr(X).Q                                                        # [(...) x N x S]
+    for _ in range(n_iter):
+        X = torch.linalg.qr(A @ X).Q                                                # [(...) x N x S]
+    T = X.mT @ (A @ X)                                                              # [(...) x S x S]
+    eigen_value, W = torch.linalg.eigh((T + T.mT) / 2)                              # [(...) x S], [(...) x S x S]
+    return X @ W, eigen_value
+
+
+def ritz_residual(
+    A: Union[torch.Tensor, SparseLowRankMatrix],
+    X: torch.Tensor,
+    L: torch.Tensor,
+) -> float:
+    """Largest residual norm |A @ x - l * x| of the Ritz pairs relative to the top eigenvalue, over every batch element.
+    Args:
+        A (torch.Tensor | SparseLowRankMatrix): symmetric input matrix, shape (bsz, n_samples, n_samples)
+        X (torch.Tensor): Ritz vectors, shape (bsz, n_samples, num_eig)
+        L (torch.Tensor): Ritz values, shape (bsz, num_eig)
+    Returns:
+        (float): largest relative residual
+    """
+    residual = torch.linalg.norm(A @ X - X * L[..., None, :], dim=-2)                 # [(...) x S]
+    scale = torch.max(L.abs(), dim=-1, keepdim=True).values.clamp_min(torch.finfo(L.dtype).tiny)   # [(...) x 1]
+    return torch.max(residual / scale).item()
+
+
+def upcast_matmul(X: torch.Tensor, Y: torch.Tensor) -> torch.Tensor:
+    """X @ Y in the more precise of the two dtypes, for affinities held in a low precision compute dtype.
+    The low precision operand is upcast one chunk at a time, so it never exists at full size in the higher dtype.
+    Args:
+        X (torch.Tensor): left operand, shape (..., n, k)
+        Y (torch.Tensor): right operand, shape (..., k, m)
+    Returns:
+        (torch.Tensor): product, shape (..., n, m)
+    """
+    if X.dtype == Y.dtype:
+        return X @ Y
+    dtype = torch.promote_types(X.dtype, Y.dtype)
+    if X.dtype != dtype:
+        row_bytes = X.shape[:-2].numel() * (X.shape[-1] + Y.shape[-1]) * dtype.itemsize
+        return torch.cat([
+            chunk.to(dtype) @ Y
+            for chunk in CHUNK_PLANNER.split("upcast_matmul", X, row_bytes)
+        ], dim=-2)                                                                  # [... x n x m]
+    else:
+        row_bytes = Y.shape[:-2].numel() * (Y.shape[-2] + X.shape[-2]) * dtype.itemsize
+        return torch.cat([
+            X @ chunk.to(dtype)
+            for chunk in CHUNK_PLANNER.split("upcast_matmul", Y, row_bytes, dim=-1)
+        ], dim=-1)                                                                  # [... x n x m]
@@ -0,0 +1,104 @@
+"""Process pools of the data-parallel updates.
+
+Workers are spawned rather than forked, so every new pool pays for fresh interpreters that import torch,
+and scripts that call `update_parallel` or fit with num_workers > 1 must guard their entry point with
+`if __name__ == "__main__":`. Workers start with the chunk planner settings, chunk plan hooks and profiler sinks
+of the parent, except hooks and sinks that cannot be pickled (e.g. lambdas). Repeated calls reuse one pool with:
+    >>> with persistent_worker_pool(4):
+    ...     for features in stream:
+    ...         model.update_parallel(features, num_workers=4)
+"""
+import os
+import pickle
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+from .global_settings import (
+    CHUNK_PLAN_HOOKS,
+    CHUNK_PLANNER,
+)
+from .profiler import (
+    add_sink,
+    registered_sinks,
+)
+
+
+# pool opened by persistent_worker_pool, with its size and the worker config it was started with
+_PERSISTENT_POOL: Dict[str, Any] = {}
+
+
+def _picklable(objects: Iterable[Any]) -> List[Any]:
+    picklable = []
+    for obj in objects:
+        try:
+            pickle.dumps(obj)
+        except Exception:
+            continue
+        picklable.append(obj)
+    return picklable
+
+
+def _worker_config(num_workers: int) -> Tuple[Any, ...]:
+    num_threads = max((os.cpu_count() or 1) // num_workers, 1)
+    return num_threads, CHUNK_PLANNER.state_dict(), _picklable(CHUNK_PLAN_HOOKS), _picklable(registered_sinks())
+
+
+def _init_worker(num_threads: int, planner_state: Dict[str, Any], hooks: List[Any], sinks: List[Any]) -> None:
+    torch.set_num_threads(num_threads)
+    CHUNK_PLANNER.load_state_dict(planner_state)
+    CHUNK_PLAN_HOOKS[:] = hooks
+    for sink in sinks:
+        add_sink(sink)
+
+
+def _start_pool(num_workers: int, config: Tuple[Any, ...]) -> mp.Pool:
+    return mp.get_context("spawn").Pool(num_workers, initializer=_init_worker, initargs=config)
+
+
+@contextmanager
+def worker_pool(num_workers: int) -> Iterator[mp.Pool]:
+    """Pool of spawned worker processes that split the cores of the machine between them.
+    Tensors sent to and returned from workers are moved to shared memory by torch.multiprocessing instead of copied,
+    so anchor state and feature shards are only materialized once across all workers.
+    Inside `persistent_worker_pool` its pool is reused, otherwise a new pool is started and terminated on exit.
+    Args:
+        num_workers (int): number of worker processes of a new pool
+    Returns:
+        (multiprocessing.Pool): pool
+    """
+    if len(_PERSISTENT_POOL) > 0:
+        config = _worker_config(_PERSISTENT_POOL["num_workers"])
+        if config != _PERSISTENT_POOL["config"]:
+            # the parent settings changed since the workers started, so they are restarted with the new ones
+            _PERSISTENT_POOL["pool"].terminate()
+            _PERSISTENT_POOL.update(pool=_start_pool(_PERSISTENT_POOL["num_workers"], config), config=config)
+        yield _PERSISTENT_POOL["pool"]
+    else:
+        with _start_pool(num_workers, _worker_config(num_workers)) as pool:
+            yield pool
+
+
+@contextmanager
+def persistent_worker_pool(num_workers: int) -> Iterator[mp.Pool]:
+    """Keeps one pool of worker processes alive, every data-parallel update inside the context reuses it
+    instead of spawning its own, so the spawn cost is paid once.
+    Args:
+        num_workers (int): number of worker processes
+    """
+    if len(_PERSISTENT_POOL) > 0:
+        raise RuntimeError("persistent_worker_pool is already open")
+    config = _worker_config(num_workers)
+    _PERSISTENT_POOL.update(num_workers=num_workers, pool=_start_pool(num_workers, config), config=config)
+    try:
+        yield _PERSISTENT_POOL["pool"]
+    finally:
+        _PERSISTENT_POOL.pop("pool").terminate()
+        _PERSISTENT_POOL.clear()
+
+
+def shard_rows(features: torch.Tensor, num_workers: int) -> Tuple[torch.Tensor, ...]:
+    # contiguous slices along dim -2, at most one per row
+    return torch.tensor_split(features, max(min(num_workers, features.shape[-2]), 1), dim=-2)
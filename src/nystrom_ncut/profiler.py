@@ -0,0 +1,240 @@
+"""Per-stage timing and memory instrumentation.
+
+Stages of fit, update and transform are wrapped in `span`s, which cost a single check while no sink is registered:
+    >>> records = []
+    >>> with profiling(CallbackSink(records.append), JSONLinesSink("spans.jsonl")):
+    ...     NystromNCut(n_components=20).fit_transform(features)
+    >>> # records[i].name, records[i].wall_time, records[i].flops, ...
+"""
+import dataclasses
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then reported as None
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    # only needed for the current RSS where /proc/self/statm does not exist, e.g. macOS and Windows
+    psutil = None
+
+
+@dataclass
+class SpanRecord:
+    name: str
+    parent: str                     # name of the enclosing span, None at the top level
+    depth: int
+    wall_time: float                # seconds
+    flops: float = None             # estimate of the floating point operations of the stage, excluding nested spans
+    chunks: int = None              # number of chunks the stage was split into
+    cuda_allocated_bytes: int = None    # change in allocated CUDA memory across the stage
+    cuda_peak_bytes: int = None     # peak allocated CUDA memory since the enclosing top level span began
+    rss_delta_bytes: int = None     # change in resident set size of the process across the stage, including nested spans
+    process_peak_rss_bytes: int = None  # peak resident set size of the process when the stage ended, a high-water mark
+                                        # over the lifetime of the process, not attributable to the stage
+
+
+class ProfilerSink:
+    def enter(self, name: str) -> None:
+        pass
+
+    def exit(self, record: SpanRecord) -> None:
+        pass
+
+
+class CallbackSink(ProfilerSink):
+    def __init__(self, callback: Callable[[SpanRecord], None]):
+        self.callback: Callable[[SpanRecord], None] = callback
+
+    def exit(self, record: SpanRecord) -> None:
+        self.callback(record)
+
+
+class JSONLinesSink(ProfilerSink):
+    """Appends one JSON object per finished span to `path`."""
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path: Union[str, os.PathLike] = path
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the lock is recreated, so the sink can be sent to worker processes
+        return {"path": self.path}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["path"])
+
+    def exit(self, record: SpanRecord) -> None:
+        with self._lock, open(self.path, "a") as fp:
+            fp.write(json.dumps(dataclasses.asdict(record)) + "\n")
+
+
+class RecordFunctionSink(ProfilerSink):
+    """Forwards spans to torch.profiler as `record_function` ranges, so stages show up in its traces."""
+    def __init__(self):
+        self._local = threading.local()
+
+    def _stack(self) -> List[torch.autograd.profiler.record_function]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def enter(self, name: str) -> None:
+        context = torch.autograd.profiler.record_function(name)
+        context.__enter__()
+        self._stack().append(context)
+
+    def exit(self, record: SpanRecord) -> None:
+        self._stack().pop().__exit__(None, None, None)
+
+
+_SINKS: List[ProfilerSink] = []
+_LOCAL = threading.local()
+
+
+def add_sink(sink: ProfilerSink) -> Callable[[], None]:
+    """Registers a sink, spans are only measured while at least one sink is registered.
+    Returns:
+        (Callable[[], None]): removes the sink
+    """
+    _SINKS.append(sink)
+    return lambda: _SINKS.remove(sink)
+
+
+def registered_sinks() -> Tuple[ProfilerSink, ...]:
+    return tuple(_SINKS)
+
+
+@contextmanager
+def profiling(*sinks: ProfilerSink) -> Iterator[None]:
+    removers = [add_sink(sink) for sink in sinks]
+    try:
+        yield
+    finally:
+        for remove in removers:
+            remove()
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the process so far, None where the resource module is unavailable (Windows)."""
+    if resource is None:
+        return None
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 2 ** 10
+
+
+def current_rss_bytes() -> int:
+    """Current resident set size of the process, None where neither /proc/self/statm nor psutil is available."""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def _span_stack() -> List["_Span"]:
+    if not hasattr(_LOCAL, "stack"):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+class _Span:
+    def __init__(self, name: str, flops: float, chunks: int):
+        self.name: str = name
+        self.flops: float = flops
+        self.chunks: int = chunks
+
+    def add(self, flops: float = None, chunks: int = None) -> None:
+        if flops is not None:
+            self.flops = (self.flops or 0) + flops
+        if chunks is not None:
+            self.chunks = (self.chunks or 0) + chunks
+
+    def __enter__(self) -> "_Span":
+        stack = _span_stack()
+        self._parent = stack[-1].name if len(stack) > 0 else None
+        self._depth = len(stack)
+        stack.append(self)
+
+        self._sinks = tuple(_SINKS)
+        for sink in self._sinks:
+            sink.enter(self.name)
+        self._cuda = torch.cuda.is_initialized()
+        if self._cuda:
+            # peaks are reset by top level spans only, nested spans report the peak since their top level span began
+            if self._depth == 0:
+                torch.cuda.reset_peak_memory_stats()
+            self._cuda_allocated = torch.cuda.memory_allocated()
+        self._rss = current_rss_bytes()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self._cuda:
+            torch.cuda.synchronize()
+        wall_time = time.perf_counter() - self._t0
+        rss = current_rss_bytes()
+        record = SpanRecord(
+            name=self.name,
+            parent=self._parent,
+            depth=self._depth,
+            wall_time=wall_time,
+            flops=self.flops,
+            chunks=self.chunks,
+            cuda_allocated_bytes=torch.cuda.memory_allocated() - self._cuda_allocated if self._cuda else None,
+            cuda_peak_bytes=torch.cuda.max_memory_allocated() if self._cuda else None,
+            rss_delta_bytes=rss - self._rss if rss is not None and self._rss is not None else None,
+            process_peak_rss_bytes=peak_rss_bytes(),
+        )
+        _span_stack().pop()
+        for sink in reversed(self._sinks):
+            sink.exit(record)
+
+
+class _NullSpan:
+    def add(self, flops: float = None, chunks: int = None) -> None:
+        pass
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def current_span() -> Union[_Span, _NullSpan]:
+    """Innermost open span of the thread, for stages that only know their cost once it has run."""
+    stack = _span_stack()
+    if len(_SINKS) == 0 or len(stack) == 0:
+        return _NULL_SPAN
+    return stack[-1]
+
+
+def span(name: str, flops: float = None, chunks: int = None) -> Union[_Span, _NullSpan]:
+    """Context manager that measures a stage, a shared no-op while no sink is registered.
+    Args:
+        name (str): stage name, e.g. "LaplacianKernel.affinity"
+        flops (float): estimate of the floating point operations of the stage, can be added to with `.add`
+        chunks (int): number of chunks the stage is split into, can be added to with `.add`
+    """
+    if len(_SINKS) == 0:
+        return _NULL_SPAN
+    return _Span(name, flops, chunks)
@@ -1,34 +1,63 @@
 import copy
+import warnings
 from dataclasses import dataclass
-from typing import Any, Literal, Tuple
+from typing import Any, Callable, Dict, Iterable, Literal, Tuple, Union
 
+import numpy as np
 import torch
-from pytorch3d.ops import sample_farthest_points
 
 from .common import (
+    ChunkSource,
+    StateDictMixin,
+    check_reiterable,
     default_device,
+    iterate_chunks,
 )
 from .distance_utils import (
     DistanceOptions,
+    QuantileSketch,
+    get_normalization_factor,
     to_euclidean,
 )
+from .global_settings import (
+    CHUNK_PLANNER,
+    CHUNK_SIZE,
+)
+from .profiler import (
+    span,
+)
 from .transformer import (
     TorchTransformerMixin,
     OnlineTorchTransformerMixin,
 )
 
 
-SampleOptions = Literal["full", "random", "fps", "fps_recursive"]
+SampleOptions = Literal["full", "random", "fps", "fps_recursive", "fps_hierarchical"]
+FPSBackendOptions = Literal["native", "pytorch3d"]
 
 
 @dataclass
-class SampleConfig:
+class SampleConfig(StateDictMixin):
     method: SampleOptions = "full"
     num_sample: int = 10000
     fps_dim: int = 12
+    fps_backend: FPSBackendOptions = "native"
+    fps_chunk_size: int = 262144
+    fps_pca_sample: int = 100000
+    fps_grid_dim: int = 3
+    fps_bins_per_sample: int = 4
+    fps_rebin_iter: int = 3
     n_iter: int = None
+    stable_fraction: float = 0.95
     _recursive_obj: TorchTransformerMixin = None
 
+    def state_dict(self) -> Dict[str, Any]:
+        # the recursive transformer is needed by the next fit of a loaded fps_recursive model, so it is saved too
+        state_dict = super().state_dict()
+        if self.method == "fps_recursive" and self._recursive_obj is not None:
+            state_dict["_recursive_obj"] = self._recursive_obj.state_dict()
+        return state_dict
+
 
 @torch.no_grad()
 def subsample_features(
@@ -37,7 +66,7 @@ def subsample_features(
     config: SampleConfig,
 ):
     features = features.detach()                                                                        # float: [... x n x d]
-    with default_device(features.device):
+    with span("subsample_features"), default_device(features.device):
         if config.method == "full" or config.num_sample >= features.shape[0]:
             sampled_indices = torch.arange(features.shape[-2]).expand(features.shape[:-1])              # int: [... x n]
         else:
@@ -52,18 +81,10 @@ def subsample_features(
                     sampled_indices = torch.topk(weights, k=config.num_sample, dim=-1).indices          # int: [... x num_sample]
 
                 case "fps_recursive":
-                    features = to_euclidean(features, distance_type)                                    # float: [... x n x d]
-                    sampled_indices = subsample_features(
-                        features=features,
-                        distance_type=distance_type,
-                        config=SampleConfig(method="fps", num_sample=config.num_sample, fps_dim=config.fps_dim)
-                    )                                                                                   # int: [... x num_sample]
-                    nc = config._recursive_obj
-                    for _ in range(config.n_iter):
-                        fps_features, eigenvalues = nc.fit_transform(features, precomputed_sampled_indices=sampled_indices)
-
-                        fps_features = to_euclidean(fps_features[:, :config.fps_dim], "cosine")
-                        sampled_indices = torch.sort(fpsample(fps_features, config), dim=-1).values
+                    sampled_indices = fps_recursive(to_euclidean(features, distance_type), config)   # int: [... x num_sample]
+
+                case "fps_hierarchical":
+                    sampled_indices = fps_hierarchical(to_euclidean(features, distance_type), config)    # int: [... x num_sample]
 
                 case _:
                     raise ValueError("sample_method should be 'farthest' or 'random'")
@@ -71,6 +92,95 @@ def subsample_features(
         return sampled_indices
 
 
+def _gather_rows(x: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    return torch.gather(x, -2, indices[..., None].expand((*indices.shape, x.shape[-1])))   # [... x s x d]
+
+
+def _nearest_anchor(fps_features: torch.Tensor, anchor_indices: torch.Tensor) -> torch.Tensor:
+    # fps features are unit norm, so the nearest anchor has the largest inner product
+    anchors = torch.nan_to_num(_gather_rows(fps_features, anchor_indices), nan=0.0)    # float: [... x s x f]
+    row_bytes = anchor_indices.numel() * fps_features.dtype.itemsize
+    return torch.cat([
+        torch.gather(anchor_indices, -1, torch.argmax(torch.nan_to_num(chunk, nan=0.0) @ anchors.mT, dim=-1))
+        for chunk in CHUNK_PLANNER.split("fps_recursive.nearest_anchor", fps_features, row_bytes)
+    ], dim=-1)                                                                          # int: [... x n]
+
+
+def _nearest_squared_distances(features: torch.Tensor, anchors: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # squared distance of every point to its nearest anchor and of every anchor to its nearest point,
+    # NaN rows (e.g. padding) are infinitely far from everything so they are never the nearest of anything
+    anchor_sq_norm = torch.sum(anchors ** 2, dim=-1)                                   # float: [... x s]
+    row_bytes = anchors.shape[:-1].numel() * features.dtype.itemsize
+    point_dist, anchor_dist = [], torch.full_like(anchor_sq_norm, torch.inf)
+    for chunk in CHUNK_PLANNER.split("OnlineTransformerSubsampleFit.coverage", features, row_bytes):
+        _dist = torch.baddbmm(
+            (torch.sum(chunk ** 2, dim=-1)[..., :, None] + anchor_sq_norm[..., None, :]).view((-1, chunk.shape[-2], anchors.shape[-2])),
+            chunk.reshape((-1, *chunk.shape[-2:])), anchors.reshape((-1, *anchors.shape[-2:])).mT, alpha=-2.0,
+        ).view((*chunk.shape[:-1], anchors.shape[-2]))                                  # float: [... x _n x s]
+        _dist = torch.where(torch.isnan(_dist), torch.inf, _dist)                       # float: [... x _n x s]
+        point_dist.append(torch.min(_dist, dim=-1).values)                              # float: [... x _n]
+        anchor_dist = torch.minimum(anchor_dist, torch.min(_dist, dim=-2).values)       # float: [... x s]
+    return torch.cat(point_dist, dim=-1), anchor_dist
+
+
+def _coverage_radius(features: torch.Tensor, anchors: torch.Tensor) -> torch.Tensor:
+    # largest squared distance of a point to its nearest anchor, ignoring NaN rows
+    point_dist, _ = _nearest_squared_distances(features, anchors)                      # float: [... x n]
+    point_dist = torch.where(torch.isfinite(point_dist), point_dist, 0.0)              # float: [... x n]
+    return torch.max(point_dist, dim=-1).values                                         # float: [...]
+
+
+@torch.no_grad()
+def fps_recursive(
+    features: torch.Tensor,
+    config: SampleConfig,
+) -> torch.Tensor:
+    """Farthest point sampling repeated in the spectral embedding of the previous sample.
+    The embedding of every point, with the degrees updated by every point, is only computed once. Each later iteration
+    refits the anchors alone, rotates the carried embeddings onto the new basis and recomputes the points whose
+    nearest anchor changed. Iterations stop early once `stable_fraction` of the sample is kept between iterations.
+    Args:
+        features (torch.Tensor): euclidean features, shape (..., n_samples, n_features)
+        config (SampleConfig): sampling config with the recursive transformer in `_recursive_obj`
+    Returns:
+        (torch.Tensor): sampled indices, shape (..., num_sample)
+    """
+    sampled_indices = torch.sort(fpsample(features, config), dim=-1).values            # int: [... x num_sample]
+    V = config._recursive_obj.fit_transform(features, precomputed_sampled_indices=sampled_indices)    # float: [... x n x n_components]
+    base_transformer = config._recursive_obj.base_transformer
+
+    n_iter = config.n_iter or 0
+    for i in range(n_iter):
+        fps_features = to_euclidean(V[..., :config.fps_dim], "cosine")                 # float: [... x n x fps_dim]
+        new_sampled_indices = torch.sort(fpsample(fps_features, config), dim=-1).values    # int: [... x num_sample]
+
+        # fraction of the new sample that was already sampled, in the least stable batch element
+        position = torch.searchsorted(sampled_indices, new_sampled_indices).clamp_max(sampled_indices.shape[-1] - 1)
+        kept = torch.gather(sampled_indices, -1, position) == new_sampled_indices       # bool: [... x num_sample]
+        stable = torch.min(torch.mean(kept.to(torch.float), dim=-1)).item() >= config.stable_fraction
+        sampled_indices, previous_sampled_indices = new_sampled_indices, sampled_indices
+        if stable or i == n_iter - 1:
+            # the embedding of the new sample is only needed by another iteration
+            break
+
+        changed = _nearest_anchor(fps_features, previous_sampled_indices) != _nearest_anchor(fps_features, sampled_indices)  # bool: [... x n]
+        previous_V = torch.nan_to_num(_gather_rows(V, sampled_indices), nan=0.0)       # float: [... x num_sample x n_components]
+        base_transformer.fit(_gather_rows(features, sampled_indices))
+        anchor_V = torch.nan_to_num(base_transformer.transform(), nan=0.0)             # float: [... x num_sample x n_components]
+
+        # orthogonal Procrustes rotation of the carried embeddings onto the new eigenbasis
+        U, _, Vh = torch.linalg.svd(previous_V.mT @ anchor_V)                           # float: [... x n_components x n_components]
+        V = V @ (U @ Vh).to(V.dtype)                                                    # float: [... x n x n_components]
+
+        # only points whose nearest anchor changed are embedded again, padded to the largest count in the batch
+        count = torch.max(torch.sum(changed, dim=-1)).item()
+        if count > 0:
+            changed_indices = torch.topk(changed.to(torch.int), k=count, dim=-1).indices   # int: [... x count]
+            changed_V = base_transformer.transform(_gather_rows(features, changed_indices))    # float: [... x count x n_components]
+            V.scatter_(-2, changed_indices[..., None].expand(changed_V.shape), changed_V.to(V.dtype))
+    return sampled_indices
+
+
 def fpsample(
     features: torch.Tensor,
     config: SampleConfig,
@@ -81,71 +191,361 @@ def fpsample(
 
     mask = torch.all(torch.isfinite(features), dim=-1)                                  # bool: [(...) x n]
     count = torch.sum(mask, dim=-1)                                                     # int: [(...)]
-    order = torch.topk(mask.to(torch.int), k=torch.max(count).item(), dim=-1).indices   # int: [(...) x max_count]
-
-    features = torch.nan_to_num(features[torch.arange(bsz)[:, None], order], nan=0.0)   # float: [(...) x max_count x d]
+    if torch.all(count == features.shape[-2]).item():
+        # every row is valid, no compaction needed
+        order = torch.arange(features.shape[-2], device=features.device).expand((bsz, -1))  # int: [(...) x n]
+    else:
+        order = torch.topk(mask.to(torch.int), k=torch.max(count).item(), dim=-1).indices   # int: [(...) x max_count]
+        features = torch.nan_to_num(features[torch.arange(bsz)[:, None], order], nan=0.0)   # float: [(...) x max_count x d]
     if features.shape[-1] > config.fps_dim:
         U, S, V = torch.pca_lowrank(features, q=config.fps_dim)                         # float: [(...) x max_count x fps_dim], [(...) x fps_dim], [(...) x fps_dim x fps_dim]
         features = U * S[..., None, :]                                                  # float: [(...) x max_count x fps_dim]
 
-    try:
-        sample_indices = sample_farthest_points(
-            features, lengths=count, K=config.num_sample
-        )[1]                                                                            # int: [(...) x num_sample]
-    except RuntimeError:
-        original_device = features.device
-        alternative_device = "cuda" if original_device == "cpu" else "cpu"
-        sample_indices = sample_farthest_points(
-            features.to(alternative_device), lengths=count.to(alternative_device), K=config.num_sample
-        )[1].to(original_device)                                                        # int: [(...) x num_sample]
+    match config.fps_backend:
+        case "native":  # default
+            sample_indices = farthest_point_sampling(
+                features, lengths=count, K=config.num_sample, chunk_size=config.fps_chunk_size,
+            )                                                                           # int: [(...) x num_sample]
+
+        case "pytorch3d":
+            try:
+                from pytorch3d.ops import sample_farthest_points
+            except ImportError:
+                raise ImportError("pytorch3d import failed, please install `pip install pytorch3d`")
+            try:
+                sample_indices = sample_farthest_points(
+                    features, lengths=count, K=config.num_sample
+                )[1]                                                                    # int: [(...) x num_sample]
+            except RuntimeError:
+                sample_indices = farthest_point_sampling(
+                    features, lengths=count, K=config.num_sample, chunk_size=config.fps_chunk_size,
+                )                                                                       # int: [(...) x num_sample]
+
+        case _:
+            raise ValueError("fps_backend should be 'native' or 'pytorch3d'")
     sample_indices = torch.gather(order, 1, sample_indices)                             # int: [(...) x num_sample]
 
     return sample_indices.view((*shape, *sample_indices.shape[-1:]))                    # int: [... x num_sample]
 
 
+@torch.no_grad()
+def fps_hierarchical(
+    features: torch.Tensor,
+    config: SampleConfig,
+) -> torch.Tensor:
+    """Two-stage farthest point sampling in near-linear time for very large n.
+    Points are projected onto principal axes fit on a subsample of `fps_pca_sample` rows, binned on an
+    equal-frequency grid over the leading `fps_grid_dim` axes with about `fps_bins_per_sample * num_sample` cells,
+    farthest point sampling runs over the bin means, and each selected bin contributes its point closest to the mean.
+    While fewer bins than num_sample are occupied, e.g. on clustered data, the grid is refined up to `fps_rebin_iter`
+    times with twice the cells per axis, after which it warns and falls back to farthest point sampling over every point.
+    Args:
+        features (torch.Tensor): euclidean features, shape (..., n_samples, n_features)
+        config (SampleConfig): sampling config
+    Returns:
+        (torch.Tensor): sampled indices, shape (..., num_sample)
+    """
+    shape, (n, d) = features.shape[:-2], features.shape[-2:]                           # ..., n, d
+    features = features.reshape((-1, n, d))                                             # float: [(...) x n x d]
+    bsz, device = features.shape[0], features.device
+    batch_indices = torch.arange(bsz, device=device)                                    # int: [(...)]
+    mask = torch.all(torch.isfinite(features), dim=-1)                                  # bool: [(...) x n]
+
+    # principal axes of a random subsample of the valid rows
+    subsample_indices = torch.topk(
+        mask.to(torch.float) + torch.rand(mask.shape, device=device), k=min(config.fps_pca_sample, n), dim=-1,
+    ).indices                                                                           # int: [(...) x s]
+    subsample = features[batch_indices[:, None], subsample_indices]                     # float: [(...) x s x d]
+    subsample_mask = mask[batch_indices[:, None], subsample_indices]                    # bool: [(...) x s]
+    mean = torch.nanmean(subsample, dim=-2, keepdim=True)                               # float: [(...) x 1 x d]
+    subsample = torch.where(subsample_mask[..., None], subsample - mean, 0.0)           # float: [(...) x s x d]
+    q = min(config.fps_dim, d, subsample.shape[-2])
+    _, _, V = torch.pca_lowrank(subsample, q=q, center=False)                           # float: [(...) x d x q]
+
+    # projection streamed over chunks of rows, invalid rows stay NaN
+    row_bytes = bsz * (d + q) * features.dtype.itemsize
+    projected = torch.cat([
+        (chunk - mean) @ V
+        for chunk in CHUNK_PLANNER.split("fps_hierarchical.project", features, row_bytes)
+    ], dim=-2)                                                                          # float: [(...) x n x q]
+
+    # equal-frequency grid over the leading axes, quantiles taken on the projected subsample,
+    # refined with twice the cells per axis while clustered data leaves fewer than num_sample bins occupied
+    grid_dim = min(config.fps_grid_dim, q)
+    projected_subsample = torch.where(subsample_mask[..., None], subsample @ V, torch.nan)[..., :grid_dim]  # float: [(...) x s x grid_dim]
+    valid_batch, valid_rows = torch.where(mask)                                         # int: [N], [N]
+    points = projected[valid_batch, valid_rows]                                         # float: [N x q]
+    cells = max(round((config.fps_bins_per_sample * config.num_sample) ** (1 / grid_dim)), 1)
+    for _ in range(config.fps_rebin_iter + 1):
+        p = torch.linspace(0, 1, cells + 1, device=device, dtype=projected.dtype)[1:-1]    # float: [cells - 1]
+        edges = torch.nanquantile(projected_subsample, p, dim=-2).permute(1, 2, 0)      # float: [(...) x grid_dim x (cells - 1)]
+        coordinates = torch.searchsorted(
+            edges.contiguous(), projected[..., :grid_dim].mT.contiguous(),
+        )                                                                               # int: [(...) x grid_dim x n]
+        bins = torch.sum(coordinates * (cells ** torch.arange(grid_dim, device=device))[:, None], dim=-2)  # int: [(...) x n]
+        bins = bins + batch_indices[:, None] * cells ** grid_dim                        # int: [(...) x n]
+
+        # bins are sorted by batch element since their ids are offset by it
+        bin_ids, inverse, bin_counts = torch.unique(bins[valid_batch, valid_rows], return_inverse=True, return_counts=True)    # int: [B], [N], [B]
+        bin_batch = bin_ids // cells ** grid_dim                                        # int: [B]
+        bins_per_batch = torch.bincount(bin_batch, minlength=bsz)                       # int: [(...)]
+        if torch.min(bins_per_batch).item() >= config.num_sample:
+            break
+        cells *= 2
+    else:
+        warnings.warn(
+            f"fps_hierarchical occupied {torch.min(bins_per_batch).item()} bins, fewer than num_sample={config.num_sample}, "
+            f"after {config.fps_rebin_iter} refinements, falling back to farthest point sampling over every point",
+        )
+        sample_indices = fpsample(projected.view((*shape, n, q)), config)              # int: [... x num_sample]
+        return sample_indices
+
+    # bin means
+    bin_means = torch.zeros((len(bin_ids), q), dtype=points.dtype, device=device).index_add_(0, inverse, points)
+    bin_means = bin_means / bin_counts[:, None]                                         # float: [B x q]
+
+    # farthest point sampling over the bin means
+    bin_offsets = torch.cumsum(bins_per_batch, dim=0) - bins_per_batch                 # int: [(...)]
+    bin_positions = torch.arange(len(bin_ids), device=device) - bin_offsets[bin_batch]  # int: [B]
+    padded_bin_means = torch.zeros((bsz, torch.max(bins_per_batch).item(), q), dtype=points.dtype, device=device)
+    padded_bin_means[bin_batch, bin_positions] = bin_means                              # float: [(...) x max_B x q]
+    sampled_bins = farthest_point_sampling(
+        padded_bin_means, lengths=bins_per_batch, K=config.num_sample, chunk_size=config.fps_chunk_size,
+    ) + bin_offsets[:, None]                                                            # int: [(...) x num_sample]
+
+    # refinement, the point of each bin closest to its mean represents it
+    distance = torch.sum((points - bin_means[inverse]) ** 2, dim=-1)                    # float: [N]
+    closest = torch.full((len(bin_ids),), torch.inf, dtype=distance.dtype, device=device).scatter_reduce_(
+        0, inverse, distance, reduce="amin",
+    )                                                                                   # float: [B]
+    is_closest = distance == closest[inverse]                                           # bool: [N]
+    representatives = torch.full((len(bin_ids),), n, device=device).scatter_reduce_(
+        0, inverse[is_closest], valid_rows[is_closest], reduce="amin",
+    )                                                                                   # int: [B]
+    sample_indices = representatives[sampled_bins]                                      # int: [(...) x num_sample]
+    return sample_indices.view((*shape, config.num_sample))                             # int: [... x num_sample]
+
+
+@torch.no_grad()
+def farthest_point_sampling(
+    features: torch.Tensor,
+    lengths: torch.Tensor,
+    K: int,
+    chunk_size: int,
+    min_dist: torch.Tensor = None,
+) -> torch.Tensor:
+    """Batched farthest point sampling in pure PyTorch, drop-in for `pytorch3d.ops.sample_farthest_points`.
+    Args:
+        features (torch.Tensor): points to sample from, shape (bsz, n, d)
+        lengths (torch.Tensor): number of valid leading points of each batch element, shape (bsz,)
+        K (int): number of points to sample
+        chunk_size (int): number of points whose distances are updated at once, bounds the temporary memory
+        min_dist (torch.Tensor): squared distances of each point to an existing sample, shape (bsz, n),
+            if given sampling continues that sample from its farthest point instead of starting from index 0
+    Returns:
+        (torch.Tensor): sampled indices, padded with -1 past lengths, shape (bsz, K)
+    """
+    bsz, n, _ = features.shape
+    device = features.device
+    batch_indices = torch.arange(bsz, device=device)                                    # int: [bsz]
+
+    sq_norm = torch.sum(features ** 2, dim=-1)                                          # float: [bsz x n]
+    valid = torch.arange(n, device=device) < lengths[:, None]                           # bool: [bsz x n]
+
+    sample_indices = torch.full((bsz, K), -1, dtype=torch.long, device=device)          # int: [bsz x K]
+    if min_dist is None:
+        min_dist = torch.where(valid, torch.inf, -torch.inf).to(features.dtype)         # float: [bsz x n]
+        idx = torch.zeros((bsz,), dtype=torch.long, device=device)                      # int: [bsz]
+    else:
+        min_dist = torch.where(valid, min_dist, -torch.inf).to(features.dtype)          # float: [bsz x n]
+        idx = torch.argmax(min_dist, dim=-1)                                            # int: [bsz]
+    for k in range(K):
+        sample_indices[:, k] = torch.where(k < lengths, idx, -1)
+        last = features[batch_indices, idx]                                             # float: [bsz x d]
+        last_sq_norm = sq_norm[batch_indices, idx]                                      # float: [bsz]
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            _dist = torch.baddbmm(
+                sq_norm[:, start:end, None] + last_sq_norm[:, None, None],              # float: [bsz x _n x 1]
+                features[:, start:end], last[:, :, None], alpha=-2.0,
+            )[..., 0]                                                                   # float: [bsz x _n]
+            _min_dist = min_dist[:, start:end]
+            torch.minimum(_min_dist, _dist, out=_min_dist)
+        idx = torch.argmax(min_dist, dim=-1)                                            # int: [bsz]
+    return sample_indices
+
+
+@torch.no_grad()
+def reservoir_sample(
+    chunks: Iterable[torch.Tensor],
+    size: int,
+    seed: int = 0,
+) -> Tuple[torch.Tensor, torch.Tensor, int]:
+    """Uniform sample of rows from a stream of chunks in a single pass (Algorithm R), batched over the leading dims.
+    Args:
+        chunks (Iterable[torch.Tensor]): chunks of shape (..., chunk_size, n_features)
+        size (int): number of rows to keep
+        seed (int): seed of the replacement draws
+    Returns:
+        (torch.Tensor): sampled rows, shape (..., min(size, n_samples), n_features)
+        (torch.Tensor): positions of the sampled rows in the stream, shape (..., min(size, n_samples))
+        (int): total number of rows in the stream
+    """
+    reservoir = reservoir_indices = generator = None
+    shape, n = None, 0
+    for chunk in chunks:
+        shape, (_m, d) = chunk.shape[:-2], chunk.shape[-2:]                                # ..., _m, d
+        chunk = chunk.reshape((-1, _m, d))                                                  # float: [(...) x _m x d]
+        if reservoir is None:
+            generator = torch.Generator(device=chunk.device).manual_seed(seed)
+            reservoir = torch.full((chunk.shape[0], size, d), torch.nan, dtype=chunk.dtype, device=chunk.device)    # float: [(...) x size x d]
+            reservoir_indices = torch.full((chunk.shape[0], size), -1, device=chunk.device)                         # int: [(...) x size]
+
+        # row at stream position t replaces slot j ~ U{0, ..., t} whenever j < size
+        positions = n + torch.arange(_m, device=chunk.device)                               # int: [_m]
+        draws = torch.rand(chunk.shape[:-1], dtype=torch.float64, generator=generator, device=chunk.device)    # float: [(...) x _m]
+        slots = torch.where(positions < size, positions, (draws * (positions + 1)).to(torch.long))             # int: [(...) x _m]
+        slots = torch.where(slots < size, slots, size)                                      # int: [(...) x _m]
+
+        # later rows of the chunk win repeated slots, as in the sequential algorithm
+        winner = torch.full((chunk.shape[0], size + 1), -1, device=chunk.device)            # int: [(...) x (size + 1)]
+        winner.scatter_reduce_(-1, slots, torch.arange(_m, device=chunk.device).expand_as(slots), reduce="amax")
+        batch_indices, slot_indices = torch.where(winner[:, :size] >= 0)
+        row_indices = winner[batch_indices, slot_indices]
+        reservoir[batch_indices, slot_indices] = chunk[batch_indices, row_indices]
+        reservoir_indices[batch_indices, slot_indices] = n + row_indices
+        n += _m
+
+    size = min(size, n)
+    reservoir = reservoir[:, :size].reshape((*shape, size, reservoir.shape[-1]))               # float: [... x size x d]
+    reservoir_indices = reservoir_indices[:, :size].reshape((*shape, size))                  # int: [... x size]
+    return reservoir, reservoir_indices, n
+
+
 class OnlineTransformerSubsampleFit(TorchTransformerMixin, OnlineTorchTransformerMixin):
     def __init__(
         self,
         base_transformer: OnlineTorchTransformerMixin,
         distance_type: DistanceOptions,
         sample_config: SampleConfig,
+        num_workers: int = 1,
+        temporal: bool = False,
+        max_drift_fraction: float = 0.25,
     ):
         OnlineTorchTransformerMixin.__init__(self)
         self.base_transformer: OnlineTorchTransformerMixin = base_transformer
         self.distance_type: DistanceOptions = distance_type
         self.sample_config: SampleConfig = sample_config
+        self.num_workers: int = num_workers
+        self.temporal: bool = temporal
+        self.max_drift_fraction: float = max_drift_fraction
+        # cleared first so the copy does not nest the recursive transformer of a previous model sharing the config
+        self.sample_config._recursive_obj = None
         self.sample_config._recursive_obj = copy.deepcopy(self)
         self.anchor_indices: torch.Tensor = None
 
+        # Temporal state, the anchors carried over to the next frame
+        self.anchor_features: torch.Tensor = None       # [... x num_sample x d]
+        self.coverage_radius: torch.Tensor = None       # [...]
+
     def _fit_helper(
         self,
         features: torch.Tensor,
         precomputed_sampled_indices: torch.Tensor,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         _n = features.shape[-2]
+        if (
+            self.temporal and precomputed_sampled_indices is None and self.anchor_features is not None
+            and self.anchor_features.shape[:-2] == features.shape[:-2] and self.anchor_features.shape[-1] == features.shape[-1]
+        ):
+            return self._carry_over_helper(features)
         self.sample_config.num_sample = min(self.sample_config.num_sample, _n)
 
-        if precomputed_sampled_indices is not None:
-            self.anchor_indices = precomputed_sampled_indices
-        else:
-            self.anchor_indices = subsample_features(
-                features=features,
-                distance_type=self.distance_type,
-                config=self.sample_config,
-            )
+        with span("OnlineTransformerSubsampleFit.sample"):
+            if precomputed_sampled_indices is not None:
+                self.anchor_indices = precomputed_sampled_indices
+            else:
+                self.anchor_indices = subsample_features(
+                    features=features,
+                    distance_type=self.distance_type,
+                    config=self.sample_config,
+                )
         sampled_features = torch.gather(features, -2, self.anchor_indices[..., None].expand([-1] * self.anchor_indices.ndim + [features.shape[-1]]))
-        self.base_transformer.fit(sampled_features)
+        with span("OnlineTransformerSubsampleFit.fit"):
+            self.base_transformer.fit(sampled_features)
+        if self.temporal:
+            # anchors cover the frame up to the largest distance of a point to its nearest anchor
+            self.anchor_features = sampled_features
+            self.coverage_radius = _coverage_radius(
+                to_euclidean(features, self.distance_type), to_euclidean(sampled_features, self.distance_type),
+            )                                                                               # float: [...]
 
         _n_not_sampled = _n - self.anchor_indices.shape[-1]
         if _n_not_sampled > 0:
             unsampled_mask = torch.full(features.shape[:-1], True, device=features.device).scatter_(-1, self.anchor_indices, False)
             unsampled_indices = torch.where(unsampled_mask)[-1].view((*features.shape[:-2], -1))
             unsampled_features = torch.gather(features, -2, unsampled_indices[..., None].expand([-1] * unsampled_indices.ndim + [features.shape[-1]]))
-            V_unsampled = self.base_transformer.update(unsampled_features)
+            with span("OnlineTransformerSubsampleFit.update"):
+                if self.num_workers > 1:
+                    V_unsampled = self.base_transformer.update_parallel(unsampled_features, self.num_workers)
+                else:
+                    V_unsampled = self.base_transformer.update(unsampled_features)
         else:
             unsampled_indices = V_unsampled = None
         return unsampled_indices, V_unsampled
 
+    def _carry_over_helper(self, features: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # anchors with no point of the new frame within the coverage radius have drifted, at most
+        # max_drift_fraction of them are replaced by farthest point sampling seeded with the kept anchors
+        shape, (n, d) = features.shape[:-2], features.shape[-2:]
+        euclidean = to_euclidean(features, self.distance_type)                              # float: [... x n x d]
+        anchors = to_euclidean(self.anchor_features, self.distance_type)                    # float: [... x num_sample x d]
+        num_sample = anchors.shape[-2]
+
+        with span("OnlineTransformerSubsampleFit.sample"):
+            _, anchor_dist = _nearest_squared_distances(euclidean, anchors)                # float: [... x num_sample]
+            num_drifted = torch.sum(~(anchor_dist <= self.coverage_radius[..., None]), dim=-1)   # int: [...]
+            k = min(torch.max(num_drifted).item(), int(self.max_drift_fraction * num_sample))
+            order = torch.argsort(anchor_dist, dim=-1, descending=True)                     # int: [... x num_sample]
+            replaced_indices, kept_indices = order[..., :k], order[..., k:]                 # int: [... x k], [... x (num_sample - k)]
+            if k > 0:
+                point_dist, _ = _nearest_squared_distances(euclidean, _gather_rows(anchors, kept_indices))    # float: [... x n]
+                valid = torch.all(torch.isfinite(euclidean), dim=-1)                        # bool: [... x n]
+                new_indices = farthest_point_sampling(
+                    torch.nan_to_num(euclidean, nan=0.0).reshape((-1, n, d)),
+                    lengths=torch.full((shape.numel(),), n, device=features.device),
+                    K=k,
+                    chunk_size=self.sample_config.fps_chunk_size,
+                    min_dist=torch.where(valid, point_dist, -torch.inf).reshape((-1, n)),
+                ).view((*shape, k))                                                         # int: [... x k]
+                new_features = _gather_rows(features, new_indices)                         # float: [... x k x d]
+            else:
+                new_indices = torch.empty((*shape, 0), dtype=torch.long, device=features.device)    # int: [... x 0]
+                new_features = features.new_empty((*shape, 0, d))                           # float: [... x 0 x d]
+            self.anchor_features = self.anchor_features.scatter(
+                -2, replaced_indices[..., None].expand(new_features.shape), new_features,
+            )                                                                               # float: [... x num_sample x d]
+            if k > 0:
+                # the radius follows the frames the anchors were last fit to, so drift is measured against them
+                self.coverage_radius = _coverage_radius(
+                    euclidean, to_euclidean(self.anchor_features, self.distance_type),
+                )                                                                           # float: [...]
+        with span("OnlineTransformerSubsampleFit.fit"):
+            self.base_transformer.replace_anchors(replaced_indices, new_features)
+
+        # carried over anchors are not rows of the frame, so every row goes through update except the new anchors,
+        # which are masked out as in fit_transform_stream so they are not counted twice in the degrees
+        self.anchor_indices = None
+        unsampled_features = features.scatter(-2, new_indices[..., None].expand(new_features.shape), torch.nan)  # float: [... x n x d]
+        with span("OnlineTransformerSubsampleFit.update"):
+            if self.num_workers > 1:
+                V = self.base_transformer.update_parallel(unsampled_features, self.num_workers)
+            else:
+                V = self.base_transformer.update(unsampled_features)                       # float: [... x n x num_eig]
+        V_new = _gather_rows(self.base_transformer.transform(), replaced_indices)           # float: [... x k x num_eig]
+        V = V.scatter(-2, new_indices[..., None].expand(V_new.shape), V_new)                # float: [... x n x num_eig]
+        return torch.arange(n, device=features.device).expand((*shape, n)), V
+
     def fit(
         self,
         features: torch.Tensor,
@@ -178,21 +578,121 @@ class OnlineTransformerSubsampleFit(TorchTransformerMixin, OnlineTorchTransforme
             (torch.Tensor): eigen_values, sorted in descending order, shape (num_eig,)
         """
         unsampled_indices, V_unsampled = self._fit_helper(features, precomputed_sampled_indices)
+        if self.anchor_indices is None:
+            return V_unsampled
         V_sampled = self.base_transformer.transform()
 
         if unsampled_indices is not None:
-            V = torch.zeros((*features.shape[:-1], V_sampled.shape[-1]), device=features.device)
+            V = torch.zeros((*features.shape[:-1], V_sampled.shape[-1]), device=features.device, dtype=V_sampled.dtype)
             for (indices, _V) in [(self.anchor_indices, V_sampled), (unsampled_indices, V_unsampled)]:
                 V.scatter_(-2, indices[..., None].expand([-1] * indices.ndim + [V_sampled.shape[-1]]), _V)
         else:
             V = V_sampled
         return V
 
+    def fit_transform_stream(
+        self,
+        source: ChunkSource,
+        chunk_size: int = CHUNK_SIZE,
+        reservoir_size: int = None,
+        out: Union[torch.Tensor, np.ndarray] = None,
+        seed: int = 0,
+        sketch_size: int = None,
+    ) -> Union[torch.Tensor, np.ndarray]:
+        """Out-of-core fit_transform, peak memory is bounded by the reservoir and chunk sizes instead of n_samples.
+        Anchors are sampled in one pass by reservoir sampling followed by the sample_config method on the reservoir,
+        the remaining points are streamed through `update_stream`, and outputs are written chunk by chunk.
+        Args:
+            source: features of shape (..., n_samples, n_features), either a tensor or numpy array (e.g. np.memmap)
+                sliced along dim -2, or a re-iterable (e.g. a list or DataLoader) of chunks of shape (..., chunk_size, n_features),
+                or a zero-argument function returning a fresh iterator over such chunks, the source is traversed three times
+            chunk_size (int): number of rows per chunk when slicing an array source
+            reservoir_size (int): number of rows uniformly sampled before anchor sampling, default 10 * num_sample
+            out: optional preallocated tensor or numpy array (e.g. np.memmap) of shape (..., n_samples, num_eig)
+            seed (int): seed of the reservoir sampling
+            sketch_size (int): for 'rbf', estimates the normalization factor over every row with a QuantileSketch
+                of this size during the reservoir pass, instead of over the anchors only
+        Returns:
+            (torch.Tensor | np.ndarray): eigen_vectors, shape (..., n_samples, num_eig), `out` if it was given
+        """
+        check_reiterable(source)
+
+        def chunks() -> Iterable[torch.Tensor]:
+            return iterate_chunks(source, chunk_size)
+
+        # sample anchors from a uniform reservoir
+        if reservoir_size is None:
+            reservoir_size = 10 * self.sample_config.num_sample
+        fit_kwargs = {}
+        if sketch_size is not None and self.distance_type == "euclidean":
+            sketch = QuantileSketch(sketch_size)
+
+            def sketched_chunks() -> Iterable[torch.Tensor]:
+                for chunk in chunks():
+                    sketch.update(chunk)
+                    yield chunk
+            reservoir, reservoir_indices, n = reservoir_sample(sketched_chunks(), reservoir_size, seed=seed)
+            fit_kwargs["normalization_factor"] = get_normalization_factor(sketch)
+        else:
+            reservoir, reservoir_indices, n = reservoir_sample(chunks(), reservoir_size, seed=seed)
+        self.sample_config.num_sample = min(self.sample_config.num_sample, reservoir.shape[-2])
+        sampled_indices = subsample_features(
+            features=reservoir,
+            distance_type=self.distance_type,
+            config=self.sample_config,
+        )                                                                                   # int: [... x num_sample]
+        self.anchor_indices = torch.gather(reservoir_indices, -1, sampled_indices)          # int: [... x num_sample]
+        sampled_features = torch.gather(reservoir, -2, sampled_indices[..., None].expand([-1] * sampled_indices.ndim + [reservoir.shape[-1]]))
+        del reservoir, reservoir_indices
+        self.base_transformer.fit(sampled_features, **fit_kwargs)
+
+        # stream the unsampled points, anchors are masked out as NaN rows
+        sorted_anchor_indices = torch.sort(self.anchor_indices, dim=-1).values              # int: [... x num_sample]
+
+        def unsampled_chunks() -> Iterable[torch.Tensor]:
+            start = 0
+            for chunk in chunks():
+                positions = start + torch.arange(chunk.shape[-2], device=chunk.device)     # int: [_m]
+                positions = positions.expand((*chunk.shape[:-2], -1)).contiguous()          # int: [... x _m]
+                start += chunk.shape[-2]
+
+                nearest = torch.searchsorted(sorted_anchor_indices, positions).clamp_max(sorted_anchor_indices.shape[-1] - 1)
+                is_anchor = torch.gather(sorted_anchor_indices, -1, nearest) == positions   # bool: [... x _m]
+                yield torch.where(is_anchor[..., None], torch.nan, chunk)
+        self.base_transformer.update_stream(unsampled_chunks)
+
+        # write outputs chunk by chunk
+        start = 0
+        for chunk in chunks():
+            V = self.base_transformer.transform(chunk)                                      # float: [... x _m x num_eig]
+            if out is None:
+                out = torch.empty((*V.shape[:-2], n, V.shape[-1]), dtype=V.dtype, device=V.device)
+            if isinstance(out, np.ndarray):
+                out[..., start:start + V.shape[-2], :] = V.numpy(force=True)
+            else:
+                out[..., start:start + V.shape[-2], :] = V
+            start += V.shape[-2]
+
+        V_sampled = self.base_transformer.transform()                                       # float: [... x num_sample x num_eig]
+        indices = self.anchor_indices[..., None].expand(V_sampled.shape)                    # int: [... x num_sample x num_eig]
+        if isinstance(out, np.ndarray):
+            np.put_along_axis(out, indices.numpy(force=True), V_sampled.numpy(force=True), axis=-2)
+        else:
+            out.scatter_(-2, indices.to(out.device), V_sampled.to(out.device))
+        return out
+
     def update(self, features: torch.Tensor) -> torch.Tensor:
         return self.base_transformer.update(features)
 
+    def update_stream(self, chunks: Callable[[], Iterable[torch.Tensor]]) -> None:
+        self.base_transformer.update_stream(chunks)
+
+    def update_parallel(self, features: torch.Tensor, num_workers: int) -> torch.Tensor:
+        return self.base_transformer.update_parallel(features, num_workers)
+
     def transform(self, features: torch.Tensor = None, **transform_kwargs) -> torch.Tensor:
-        return self.base_transformer.transform(features)
+        with span("OnlineTransformerSubsampleFit.transform"):
+            return self.base_transformer.transform(features)
 
     @property
     def eigenvalues_(self) -> torch.Tensor:
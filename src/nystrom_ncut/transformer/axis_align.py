@@ -6,6 +6,9 @@ import torch.nn.functional as Fn
 from ..common import (
     default_device,
 )
+from ..profiler import (
+    span,
+)
 from .transformer_mixin import (
     TorchTransformerMixin,
 )
@@ -30,7 +33,7 @@ class AxisAlign(TorchTransformerMixin):
 
     def fit(self, X: torch.Tensor) -> "AxisAlign":
         # Normalize eigenvectors
-        with default_device(X.device):
+        with span("AxisAlign.fit"), default_device(X.device):
             d = X.shape[-1]
             normalized_X = Fn.normalize(X, p=2, dim=-1)                                                         # float: [... x n x d]
 
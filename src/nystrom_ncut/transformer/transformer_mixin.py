@@ -1,10 +1,14 @@
 from abc import abstractmethod
-from typing import Any
+from typing import Any, Callable, Iterable
 
 import torch
 
+from ..common import (
+    StateDictMixin,
+)
 
-class TorchTransformerMixin:
+
+class TorchTransformerMixin(StateDictMixin):
     """Mixin class for all transformers in scikit-learn.
 
     This mixin defines the following functionality:
@@ -49,7 +53,7 @@ class TorchTransformerMixin:
         """"""
 
 
-class OnlineTorchTransformerMixin:
+class OnlineTorchTransformerMixin(StateDictMixin):
     @abstractmethod
     def fit(self, X: torch.Tensor) -> "OnlineTorchTransformerMixin":
         """"""
@@ -61,3 +65,11 @@ class OnlineTorchTransformerMixin:
     @abstractmethod
     def update(self, X: torch.Tensor) -> torch.Tensor:
         """"""
+
+    @abstractmethod
+    def update_stream(self, chunks: Callable[[], Iterable[torch.Tensor]]) -> None:
+        """"""
+
+    @abstractmethod
+    def update_parallel(self, X: torch.Tensor, num_workers: int) -> torch.Tensor:
+        """"""
@@ -6,7 +6,6 @@ import torch.nn.functional as Fn
 from sklearn.base import TransformerMixin, BaseEstimator
 
 from .common import (
-    ceildiv,
     lazy_normalize,
     quantile_min_max,
     quantile_normalize,
@@ -15,10 +14,22 @@ from .distance_utils import (
     AffinityOptions,
     AFFINITY_TO_DISTANCE,
     to_euclidean,
-    affinity_from_features,
+    affinity_from_distance,
+    fused_affinity,
+    get_normalization_factor,
+    squared_norms,
+)
+from .compile_utils import (
+    maybe_compile,
 )
 from .global_settings import (
-    CHUNK_SIZE,
+    CHUNK_PLANNER,
+)
+from .index_utils import (
+    IVFIndex,
+)
+from .profiler import (
+    span,
 )
 from .sampling_utils import (
     SampleConfig,
@@ -35,6 +46,8 @@ def extrapolate_knn(
     affinity_focal_gamma: float = 1.0,
     device: str = None,
     move_output_to_cpu: bool = False,
+    index: IVFIndex = None,
+    use_compile: bool = False,
 ) -> torch.Tensor:                          # [m x d']
     """A generic function to propagate new nodes using KNN.
 
@@ -45,6 +58,9 @@ def extrapolate_knn(
         knn (int): number of KNN to propagate eige nvectors
         affinity_type (str): distance metric, 'cosine' (default) or 'euclidean', 'rbf'
         device (str): device to use for computation, if None, will not change device
+        index (IVFIndex): prebuilt approximate nearest neighbour index over anchor_features, reused across calls
+            so each query only scans a few buckets instead of every anchor, requires knn
+        use_compile (bool): whether the per-chunk affinity and propagation run through torch.compile'd kernels
     Returns:
         torch.Tensor: propagated eigenvectors, shape (new_num_samples, D)
 
@@ -54,42 +70,72 @@ def extrapolate_knn(
         >>> new_features = torch.randn(200, 100)
         >>> new_eigenvectors = extrapolate_knn(old_features, old_eigenvectors, new_features, knn=3)
         >>> # new_eigenvectors.shape = (200, 20)
+        >>> index = IVFIndex(old_features, "cosine")
+        >>> new_eigenvectors = extrapolate_knn(old_features, old_eigenvectors, new_features, knn=3, index=index)
 
     """
     device = anchor_output.device if device is None else device
+    if index is not None:
+        if knn is None:
+            raise ValueError("extrapolate_knn with an index requires knn")
+        if index.distance_type != AFFINITY_TO_DISTANCE[affinity_type]:
+            raise ValueError(f"index built for distance_type {index.distance_type}, expected {AFFINITY_TO_DISTANCE[affinity_type]}")
+    # estimated once instead of per chunk
+    normalization_factor = get_normalization_factor(anchor_features) if affinity_type == "rbf" else None
 
     # used in nystrom_ncut
     # propagate eigen_vector from subgraph to full graph
     anchor_output = anchor_output.to(device)
-
-    n_chunks = ceildiv(extrapolation_features.shape[0], CHUNK_SIZE)
-    V_list = []
-    for _v in torch.chunk(extrapolation_features, n_chunks, dim=0):
-        _v = _v.to(device)                                                                              # [_m x d]
-
-        _A = affinity_from_features(
-            features_A=anchor_features,
-            features_B=_v,
-            affinity_type=affinity_type,
-            affinity_focal_gamma=affinity_focal_gamma,
-        ).mT                                                                                            # [_m x n]
-        if knn is not None:
-            _A, indices = _A.topk(k=knn, dim=-1, largest=True)                                          # [_m x k], [_m x k]
-            _anchor_output = anchor_output[indices]                                                     # [_m x k x d]
-        else:
-            _anchor_output = anchor_output[None]                                                        # [1 x n x d]
-
-        _A = Fn.normalize(_A, p=1, dim=-1)                                                              # [_m x k]
-        _V = (_A[:, None, :] @ _anchor_output).squeeze(1)                                               # [_m x d]
-
-        if move_output_to_cpu:
-            _V = _V.cpu()
-        V_list.append(_V)
+    if index is None:
+        # normalized once for cosine, every chunk below then skips the check on the anchors
+        anchor_features = to_euclidean(anchor_features, AFFINITY_TO_DISTANCE[affinity_type])
+        anchor_squared_norms = squared_norms(anchor_features) if affinity_type == "rbf" else None
+
+    # affinities to every anchor and their normalized copy, plus the gathered anchor outputs of each row
+    row_bytes = anchor_features.dtype.itemsize * (2 * anchor_features.shape[0] + (knn or 1) * anchor_output.shape[-1])
+    with span("extrapolate_knn") as s:
+        V_list = []
+        for _v in CHUNK_PLANNER.split("extrapolate_knn", extrapolation_features, row_bytes, dim=0):
+            _v = _v.to(device)                                                                          # [_m x d]
+
+            if index is not None:
+                _D, indices = index.search(_v, knn)                                                     # [_m x k], [_m x k]
+                _A = affinity_from_distance(_D, affinity_type, affinity_focal_gamma, normalization_factor)  # [_m x k]
+                _anchor_output = anchor_output[indices]                                                 # [_m x k x d]
+            else:
+                _A = fused_affinity(
+                    features_A=anchor_features,
+                    features_B=_v,
+                    affinity_type=affinity_type,
+                    affinity_focal_gamma=affinity_focal_gamma,
+                    normalization_factor=normalization_factor,
+                    squared_norms_A=anchor_squared_norms,
+                    use_compile=use_compile,
+                ).mT                                                                                    # [_m x n]
+                if knn is not None:
+                    _A, indices = _A.topk(k=knn, dim=-1, largest=True)                                  # [_m x k], [_m x k]
+                    _anchor_output = anchor_output[indices]                                             # [_m x k x d]
+                else:
+                    _anchor_output = anchor_output[None]                                                # [1 x n x d]
+
+            _V = maybe_compile(_propagate, use_compile)(_A, _anchor_output)                                # [_m x d]
+
+            if move_output_to_cpu:
+                _V = _V.cpu()
+            V_list.append(_V)
+            # dense affinities to every anchor unless searched in the index, then the weighted sum of anchor outputs
+            affinity_flops = 0 if index is not None else 2 * _v.shape[0] * anchor_features.shape[0] * _v.shape[-1]
+            s.add(flops=affinity_flops + 2 * _A.numel() * anchor_output.shape[-1], chunks=1)
 
     extrapolation_output = torch.cat(V_list, dim=0)
     return extrapolation_output
 
 
+def _propagate(A: torch.Tensor, anchor_output: torch.Tensor) -> torch.Tensor:
+    A = Fn.normalize(A, p=1, dim=-1)                                    # [m x k]
+    return (A[:, None, :] @ anchor_output).squeeze(1)                   # [m x d]
+
+
 # wrapper functions for adding new nodes to existing graph
 def extrapolate_knn_with_subsampling(
     full_features: torch.Tensor,            # [n x d]
@@ -101,6 +147,8 @@ def extrapolate_knn_with_subsampling(
     affinity_focal_gamma: float = 1.0,
     device: str = None,
     move_output_to_cpu: bool = False,
+    index: IVFIndex = None,
+    use_compile: bool = False,
 ) -> torch.Tensor:                          # [m x d']
     """Propagate eigenvectors to new nodes using KNN. Note: this is equivalent to the class API `NCUT.tranform(new_features)`, expect for the sampling is re-done in this function.
     Args:
@@ -110,6 +158,9 @@ def extrapolate_knn_with_subsampling(
         knn (int): number of KNN to propagate eigenvectors, default 3
         sample_config (str): sample method, 'farthest' (default) or 'random'
         device (str): device to use for computation, if None, will not change device
+        index (IVFIndex): prebuilt index over `full_features[index.anchor_indices]`, reuses its anchors
+            instead of resampling the subgraph and searches them approximately
+        use_compile (bool): whether the per-chunk affinity and propagation run through torch.compile'd kernels
     Returns:
         torch.Tensor: propagated eigenvectors, shape (n_new_samples, num_eig)
 
@@ -124,11 +175,16 @@ def extrapolate_knn_with_subsampling(
     device = full_output.device if device is None else device
 
     # sample subgraph
-    anchor_indices = subsample_features(
-        features=full_features,
-        distance_type=AFFINITY_TO_DISTANCE[affinity_type],
-        config=sample_config,
-    )
+    if index is not None:
+        if index.anchor_indices is None:
+            raise ValueError("extrapolate_knn_with_subsampling requires an index built with anchor_indices")
+        anchor_indices = index.anchor_indices
+    else:
+        anchor_indices = subsample_features(
+            features=full_features,
+            distance_type=AFFINITY_TO_DISTANCE[affinity_type],
+            config=sample_config,
+        )
 
     anchor_output = full_output[anchor_indices].to(device)
     anchor_features = full_features[anchor_indices].to(device)
@@ -144,6 +200,8 @@ def extrapolate_knn_with_subsampling(
         affinity_focal_gamma=affinity_focal_gamma,
         device=device,
         move_output_to_cpu=move_output_to_cpu,
+        index=index,
+        use_compile=use_compile,
     )
     return extrapolation_output
 
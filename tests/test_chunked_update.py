@@ -0,0 +1,19 @@
+import torch
+
+from nystrom_ncut import CHUNK_PLANNER, NystromNCut, SampleConfig
+
+
+def _model() -> NystromNCut:
+    return NystromNCut(n_components=5, sample_config=SampleConfig(method="random", num_sample=100), eig_solver="eigh")
+
+
+def test_chunked_update_matches_unchunked(monkeypatch):
+    torch.manual_seed(0)
+    features = torch.randn((1000, 16), dtype=torch.float64)
+    indices = torch.randperm(1000)[:100]
+
+    V = _model().fit_transform(features, precomputed_sampled_indices=indices)
+    monkeypatch.setattr(CHUNK_PLANNER, "max_chunk_size", 128)
+    monkeypatch.setattr(CHUNK_PLANNER, "min_chunk_size", 1)
+    V_chunked = _model().fit_transform(features, precomputed_sampled_indices=indices)
+    torch.testing.assert_close(V_chunked, V)
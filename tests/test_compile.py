@@ -0,0 +1,23 @@
+import pytest
+import torch
+
+from nystrom_ncut import KernelNCut, NystromNCut, SampleConfig
+from nystrom_ncut.common import StateDictMixin
+
+
+@pytest.mark.parametrize("model_cls, compiled_stage", [
+    (NystromNCut, lambda model: model.base_transformer.kernel),
+    (KernelNCut, lambda model: model.base_transformer),
+])
+def test_default_model_does_not_compile(model_cls, compiled_stage, tmp_path):
+    torch.manual_seed(0)
+    features = torch.randn((300, 16))
+    model = model_cls(n_components=5, sample_config=SampleConfig(method="random", num_sample=50))
+    assert compiled_stage(model).use_compile is False
+    model.fit(features)
+
+    path = tmp_path / "model.pt"
+    model.save(path)
+    loaded = StateDictMixin.load(path, mmap=False)
+    assert compiled_stage(loaded).use_compile is False
+    torch.testing.assert_close(loaded.transform(features), model.transform(features))
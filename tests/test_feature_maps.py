@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from nystrom_ncut import DtypePolicy, fused_affinity
+from nystrom_ncut.kernel.kernel_ncut import KernelNCutBaseTransformer
+
+
+@pytest.mark.parametrize("feature_map", ["gaussian", "orthogonal", "sorf"])
+@pytest.mark.parametrize("affinity_type", ["cosine", "rbf"])
+def test_random_features_approximate_affinity(feature_map, affinity_type):
+    torch.manual_seed(0)
+    features = torch.randn((60, 10), dtype=torch.float64)
+    normalization_factor = torch.tensor(1.5, dtype=torch.float64)
+    transformer = KernelNCutBaseTransformer(
+        n_components=5, kernel_dim=4096, affinity_type=affinity_type, affinity_focal_gamma=0.5,
+        dtype_policy=DtypePolicy(), feature_map=feature_map,
+    )
+    transformer.fit(features, normalization_factor=normalization_factor)
+
+    kernelized_features = transformer._kernelize_features(features)                    # [60 x (2 * kernel_dim)]
+    approximation = kernelized_features @ kernelized_features.mT                        # [60 x 60]
+    exact = fused_affinity(features, features, affinity_type, 0.5, normalization_factor=normalization_factor)
+    assert torch.mean(torch.abs(approximation - exact)).item() < 0.03
+    torch.testing.assert_close(torch.diagonal(approximation), torch.ones(60, dtype=torch.float64))
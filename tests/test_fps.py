@@ -0,0 +1,46 @@
+import torch
+
+from nystrom_ncut.sampling_utils import farthest_point_sampling
+
+
+def _brute_force_fps(features: torch.Tensor, K: int) -> torch.Tensor:
+    # farthest point order from index 0, recomputing every distance from scratch
+    indices = [0]
+    for _ in range(K - 1):
+        distances = torch.cdist(features, features[indices]) ** 2                       # [n x len(indices)]
+        indices.append(torch.argmax(torch.min(distances, dim=-1).values).item())
+    return torch.tensor(indices)
+
+
+def test_farthest_point_sampling_matches_brute_force():
+    torch.manual_seed(0)
+    features = torch.randn((3, 200, 5), dtype=torch.float64)
+    sample_indices = farthest_point_sampling(features, lengths=torch.full((3,), 200), K=20, chunk_size=64)
+
+    assert sample_indices.shape == (3, 20)
+    for _features, _indices in zip(features, sample_indices):
+        assert len(torch.unique(_indices)) == 20
+        torch.testing.assert_close(_indices, _brute_force_fps(_features, 20))
+
+
+def test_farthest_point_sampling_respects_lengths():
+    torch.manual_seed(0)
+    features = torch.randn((2, 100, 5), dtype=torch.float64)
+    lengths = torch.tensor([100, 10])
+    sample_indices = farthest_point_sampling(features, lengths=lengths, K=20, chunk_size=32)
+
+    torch.testing.assert_close(sample_indices[0], _brute_force_fps(features[0], 20))
+    torch.testing.assert_close(sample_indices[1, :10].sort().values, torch.arange(10))
+    assert torch.all(sample_indices[1, 10:] == -1)
+
+
+def test_farthest_point_sampling_continues_from_min_dist():
+    torch.manual_seed(0)
+    features = torch.randn((1, 150, 5), dtype=torch.float64)
+    reference = _brute_force_fps(features[0], 20)
+    min_dist = torch.min(torch.cdist(features[0], features[0, reference[:5]]) ** 2, dim=-1).values
+
+    sample_indices = farthest_point_sampling(
+        features, lengths=torch.tensor([150]), K=15, chunk_size=64, min_dist=min_dist[None],
+    )
+    torch.testing.assert_close(sample_indices[0], reference[5:])
@@ -0,0 +1,47 @@
+import warnings
+
+import pytest
+import torch
+
+from nystrom_ncut import SampleConfig
+from nystrom_ncut.sampling_utils import fps_hierarchical
+
+
+def _features() -> torch.Tensor:
+    torch.manual_seed(0)
+    features = torch.randn((2, 3000, 16), dtype=torch.float64)
+    features[1, 2500:] = torch.nan                                                      # padding rows
+    return features
+
+
+def _check_sample(sample_indices: torch.Tensor, features: torch.Tensor, num_sample: int) -> None:
+    assert sample_indices.shape == (2, num_sample)
+    for _features, _indices in zip(features, sample_indices):
+        assert len(torch.unique(_indices)) == num_sample
+        assert torch.all(torch.isfinite(_features[_indices]))
+
+
+def test_fps_hierarchical_samples_valid_rows():
+    features = _features()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        sample_indices = fps_hierarchical(features, SampleConfig(method="fps_hierarchical", num_sample=50))
+    _check_sample(sample_indices, features, 50)
+
+
+def test_fps_hierarchical_refines_sparse_grid():
+    # 2 cells per axis occupy 8 bins, one refinement to 4 cells per axis occupies enough
+    features = _features()
+    config = SampleConfig(method="fps_hierarchical", num_sample=50, fps_bins_per_sample=0.1, fps_rebin_iter=2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        sample_indices = fps_hierarchical(features, config)
+    _check_sample(sample_indices, features, 50)
+
+
+def test_fps_hierarchical_falls_back_to_fps():
+    features = _features()
+    config = SampleConfig(method="fps_hierarchical", num_sample=50, fps_bins_per_sample=0.1, fps_rebin_iter=0)
+    with pytest.warns(UserWarning, match="falling back"):
+        sample_indices = fps_hierarchical(features, config)
+    _check_sample(sample_indices, features, 50)
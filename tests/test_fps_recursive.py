@@ -0,0 +1,46 @@
+import torch
+
+from nystrom_ncut import NystromNCut, SampleConfig
+from nystrom_ncut import sampling_utils
+
+
+def _clustered_features(n: int = 600, d: int = 16) -> torch.Tensor:
+    torch.manual_seed(0)
+    centers = 4.0 * torch.randn((4, d), dtype=torch.float64)
+    return centers[torch.randint(0, 4, (n,))] + torch.randn((n, d), dtype=torch.float64)
+
+
+def test_fps_recursive_embedding_orientation_is_stable(monkeypatch):
+    fps_inputs = []
+    fpsample = sampling_utils.fpsample
+
+    def recording_fpsample(features, config):
+        fps_inputs.append(features.clone())
+        return fpsample(features, config)
+
+    monkeypatch.setattr(sampling_utils, "fpsample", recording_fpsample)
+    features = _clustered_features()
+    config = SampleConfig(method="fps_recursive", num_sample=60, n_iter=3, stable_fraction=1.1)
+    model = NystromNCut(n_components=8, sample_config=config, eig_solver="eigh")
+    model.fit(features)
+
+    # the raw features, then the embedding of every iteration
+    assert len(fps_inputs) == 4
+    for previous, current in zip(fps_inputs[1:-1], fps_inputs[2:]):
+        # rotated onto the new eigenbasis, so each point keeps its direction in the embedding between iterations
+        assert torch.mean(torch.sum(previous * current, dim=-1)).item() > 0.9
+
+    sampled_indices = model.anchor_indices
+    assert sampled_indices.shape == (60,)
+    assert len(torch.unique(sampled_indices)) == 60
+
+
+def test_fps_recursive_stops_once_stable(monkeypatch):
+    calls = []
+    fpsample = sampling_utils.fpsample
+    monkeypatch.setattr(sampling_utils, "fpsample", lambda features, config: calls.append(None) or fpsample(features, config))
+
+    config = SampleConfig(method="fps_recursive", num_sample=60, n_iter=10, stable_fraction=0.0)
+    NystromNCut(n_components=8, sample_config=config, eig_solver="eigh").fit(_clustered_features())
+    # the first embedding is sampled once and accepted
+    assert len(calls) == 2
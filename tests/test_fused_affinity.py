@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from nystrom_ncut import distance_from_features, get_normalization_factor
+from nystrom_ncut.distance_utils import AFFINITY_TO_DISTANCE, affinity_from_distance, fused_affinity
+
+
+def _unfused_affinity(features_A, features_B, affinity_type, normalization_factor):
+    D = distance_from_features(features_A, features_B, AFFINITY_TO_DISTANCE[affinity_type])
+    return affinity_from_distance(D, affinity_type, 0.3, normalization_factor=normalization_factor)
+
+
+@pytest.mark.parametrize("affinity_type", ["cosine", "rbf"])
+def test_fused_affinity_matches_unfused(affinity_type):
+    torch.manual_seed(0)
+    features_A = torch.randn((2, 80, 12), dtype=torch.float64)
+    features_B = torch.randn((2, 50, 12), dtype=torch.float64)
+    normalization_factor = get_normalization_factor(features_A)
+
+    expected = _unfused_affinity(features_A, features_B, affinity_type, normalization_factor)
+    torch.testing.assert_close(
+        fused_affinity(features_A, features_B, affinity_type, 0.3, normalization_factor=normalization_factor), expected,
+    )
+
+
+@pytest.mark.parametrize("affinity_type", ["cosine", "rbf"])
+def test_fused_affinity_writes_into_out(affinity_type):
+    torch.manual_seed(0)
+    features_A = torch.randn((80, 12), dtype=torch.float64)
+    features_B = torch.randn((50, 12), dtype=torch.float64)
+    normalization_factor = get_normalization_factor(features_A)
+    expected = _unfused_affinity(features_A, features_B, affinity_type, normalization_factor)
+
+    # a column slice of a larger buffer in another dtype, filled tile by tile
+    buffer = torch.zeros((80, 70), dtype=torch.float32)
+    out = fused_affinity(
+        features_A, features_B, affinity_type, 0.3,
+        normalization_factor=normalization_factor, out=buffer[:, 10:60], tile_size=16,
+    )
+    assert out.data_ptr() == buffer[:, 10:60].data_ptr()
+    torch.testing.assert_close(buffer[:, 10:60], expected.to(torch.float32))
+    assert torch.all(buffer[:, :10] == 0) and torch.all(buffer[:, 60:] == 0)
@@ -0,0 +1,47 @@
+import torch
+
+from nystrom_ncut import DtypePolicy
+from nystrom_ncut.kernel.kernel_ncut import KernelNCutBaseTransformer
+
+
+def _full_gram(transformer: KernelNCutBaseTransformer) -> torch.Tensor:
+    # G = sum_i k_i k_i^T / (k_i . r) recomputed from scratch
+    row_sum = transformer.kernelized_anchor @ transformer.r[..., None]                  # [n x 1]
+    normalized_kernelized_anchor = transformer.kernelized_anchor / row_sum ** 0.5
+    return normalized_kernelized_anchor.mT @ normalized_kernelized_anchor
+
+
+def _transformer(refresh_tol: float) -> KernelNCutBaseTransformer:
+    return KernelNCutBaseTransformer(
+        n_components=5, kernel_dim=128, affinity_type="rbf", affinity_focal_gamma=1.0,
+        dtype_policy=DtypePolicy(), incremental=True, refresh_tol=refresh_tol,
+    )
+
+
+def test_refresh_matches_full_recompute():
+    torch.manual_seed(0)
+    transformer = _transformer(refresh_tol=0.0)
+    transformer.fit(torch.randn((200, 10), dtype=torch.float64))
+    transformer.update(torch.randn((300, 10), dtype=torch.float64) + 2.0)
+
+    torch.testing.assert_close(transformer.gram_r, transformer.r)
+    torch.testing.assert_close(transformer.gram, _full_gram(transformer))
+    # the incremental eigenvalues are those of the exact statistic
+    eigenvalues = torch.linalg.eigvalsh(_full_gram(transformer)).flip(-1)[:5] * (500 / 200)
+    torch.testing.assert_close(transformer.eigenvalues_, eigenvalues)
+
+
+def test_drift_triggers_refresh():
+    torch.manual_seed(0)
+    transformer = _transformer(refresh_tol=0.05)
+    transformer.fit(torch.randn((200, 10), dtype=torch.float64))
+    gram_r = transformer.gram_r.clone()
+
+    # a batch like the anchors keeps the direction of r, so the statistic is only rescaled
+    transformer.update(torch.randn((20, 10), dtype=torch.float64))
+    torch.testing.assert_close(transformer.gram_r, gram_r)
+
+    # a shifted batch moves the direction of r past refresh_tol, so the statistic is recomputed
+    transformer.update(torch.randn((2000, 10), dtype=torch.float64) + 3.0)
+    torch.testing.assert_close(transformer.gram_r, transformer.r)
+    torch.testing.assert_close(transformer.gram, _full_gram(transformer))
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from nystrom_ncut import IVFIndex, distance_from_features
+
+
+@pytest.mark.parametrize("distance_type", ["cosine", "euclidean"])
+def test_ivf_search_with_every_list_is_exact(distance_type):
+    torch.manual_seed(0)
+    anchor_features = torch.randn((500, 8), dtype=torch.float64)
+    queries = torch.randn((40, 8), dtype=torch.float64)
+    index = IVFIndex(anchor_features, distance_type, n_lists=16, n_probe=16)
+    distances, indices = index.search(queries, k=10)
+
+    exact = distance_from_features(anchor_features, queries, distance_type).mT     # [40 x 500]
+    exact_distances, exact_indices = torch.topk(exact, k=10, dim=-1, largest=False)
+    torch.testing.assert_close(distances, exact_distances)
+    torch.testing.assert_close(indices, exact_indices)
+
+
+def test_ivf_search_pads_when_too_few_anchors_are_probed():
+    torch.manual_seed(0)
+    index = IVFIndex(torch.randn((100, 8)), "euclidean", n_lists=10, n_probe=1)
+    distances, indices = index.search(torch.randn((20, 8)), k=50)
+
+    assert torch.all((indices == -1) == torch.isinf(distances))
+    assert torch.all(torch.diff(distances, dim=-1)[torch.isfinite(distances[:, 1:])] >= 0)
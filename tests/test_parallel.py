@@ -0,0 +1,36 @@
+import copy
+
+import torch
+
+from nystrom_ncut import KernelNCut, NystromNCut, SampleConfig, persistent_worker_pool
+
+
+def _fitted_models():
+    torch.manual_seed(0)
+    features = torch.randn((600, 16), dtype=torch.float64)
+    indices = torch.randperm(600)[:100]
+    nystrom = NystromNCut(n_components=5, sample_config=SampleConfig(method="random", num_sample=100), eig_solver="eigh")
+    kernel = KernelNCut(n_components=5, kernel_dim=64, sample_config=SampleConfig(method="random", num_sample=100))
+    for model in (nystrom, kernel):
+        model.fit(features, precomputed_sampled_indices=indices)
+    return nystrom, kernel
+
+
+def test_update_parallel_matches_update():
+    new_features = torch.randn((400, 16), dtype=torch.float64)
+    for model in _fitted_models():
+        parallel_model = copy.deepcopy(model)
+        V = model.update(new_features)
+        V_parallel = parallel_model.update_parallel(new_features, num_workers=2)
+        torch.testing.assert_close(V_parallel, V)
+
+
+def test_persistent_worker_pool_reused():
+    new_features = torch.randn((400, 16), dtype=torch.float64)
+    model, _ = _fitted_models()
+    parallel_model = copy.deepcopy(model)
+    with persistent_worker_pool(2):
+        for chunk in torch.split(new_features, 200, dim=-2):
+            V = model.update(chunk)
+            V_parallel = parallel_model.update_parallel(chunk, num_workers=2)
+            torch.testing.assert_close(V_parallel, V)
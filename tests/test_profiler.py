@@ -0,0 +1,21 @@
+import pytest
+import torch
+
+from nystrom_ncut import CallbackSink, profiling, span
+from nystrom_ncut.profiler import current_rss_bytes
+
+
+@pytest.mark.skipif(current_rss_bytes() is None, reason="current RSS is not available on this platform")
+def test_rss_delta_is_per_stage():
+    records = []
+    with profiling(CallbackSink(records.append)):
+        with span("allocate"):
+            x = torch.ones((2 ** 25,), dtype=torch.float32)                 # 128 MiB, touched so it is resident
+        with span("idle"):
+            y = x.sum()
+    records = {record.name: record for record in records}
+
+    assert records["allocate"].rss_delta_bytes >= 2 ** 26
+    assert records["idle"].rss_delta_bytes < 2 ** 26
+    assert records["idle"].process_peak_rss_bytes is None or records["idle"].process_peak_rss_bytes >= 2 ** 27
+    assert y.item() == 2 ** 25
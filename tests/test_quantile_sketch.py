@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from nystrom_ncut import QuantileSketch, get_normalization_factor
+
+
+def _rank_error(sketch: QuantileSketch, features: torch.Tensor, q: torch.Tensor) -> float:
+    estimates = sketch.quantile(q)                                                      # [len(q) x d]
+    ranks = torch.mean((features[None, :, :] <= estimates[:, None, :]).to(torch.float64), dim=-2)    # [len(q) x d]
+    return torch.max(torch.abs(ranks - q[:, None])).item()
+
+
+@pytest.mark.parametrize("size", [128, 512])
+def test_streamed_sketch_within_rank_error(size):
+    torch.manual_seed(0)
+    features = torch.cat((torch.randn((60000, 3)), torch.rand((60000, 1)) ** 4), dim=-1).to(torch.float64)
+    sketch = QuantileSketch(size=size)
+    for chunk in features.split(4096):
+        sketch.update(chunk)
+
+    q = torch.linspace(0.01, 0.99, 25, dtype=torch.float64)
+    assert _rank_error(sketch, features, q) <= 3.0 / size
+
+
+def test_merged_sketch_within_rank_error():
+    torch.manual_seed(0)
+    features = torch.randn((40000, 4), dtype=torch.float64)
+    sketches = [QuantileSketch(size=256).update(chunk) for chunk in features.split(5000)]
+    sketch = sketches[0].merge(sketches[1:])
+
+    q = torch.linspace(0.01, 0.99, 25, dtype=torch.float64)
+    assert _rank_error(sketch, features, q) <= 3.0 / 256
+
+
+def test_sketch_normalization_factor_ignores_nan():
+    torch.manual_seed(0)
+    features = torch.randn((20000, 8), dtype=torch.float64)
+    padded = torch.cat((features, torch.full((5000, 8), torch.nan, dtype=torch.float64)), dim=-2)
+    sketch = QuantileSketch(size=1024)
+    for chunk in padded[torch.randperm(len(padded))].split(2048):
+        sketch.update(chunk)
+    torch.testing.assert_close(get_normalization_factor(sketch), get_normalization_factor(features), rtol=2e-2, atol=0.0)
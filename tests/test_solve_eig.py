@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from nystrom_ncut import DtypePolicy, MIXED_PRECISION_POLICY, NystromNCut, SampleConfig
+from nystrom_ncut.nystrom.nystrom_utils import solve_eig
+
+
+def _psd_matrix(dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    torch.manual_seed(0)
+    X = torch.randn((3, 40, 6), dtype=torch.float64)
+    return (X @ X.mT).to(dtype)                                         # [3 x 40 x 40]
+
+
+@pytest.mark.parametrize("eig_solver", ["svd", "eigh"])
+@pytest.mark.parametrize("eig_dtype", [None, torch.float32, torch.float64])
+def test_solve_eig_ordering_and_sign(eig_solver, eig_dtype):
+    A = _psd_matrix()
+    U, L = solve_eig(A, num_eig=4, eig_solver=eig_solver, eig_dtype=eig_dtype)
+
+    assert U.dtype == A.dtype and L.dtype == A.dtype
+    assert U.shape == (3, 40, 4) and L.shape == (3, 4)
+    assert torch.all(L[..., :-1].abs() >= L[..., 1:].abs())
+    assert torch.all(torch.sum(U, dim=-2) >= 0)
+    reference = torch.linalg.eigvalsh(A.double()).flip(-1)[..., :4]
+    torch.testing.assert_close(L.double(), reference, rtol=1e-4, atol=1e-4)
+
+
+def test_solve_eig_low_precision_input():
+    A = _psd_matrix(torch.bfloat16)
+    U, L = solve_eig(A, num_eig=4, eig_solver="eigh", eig_dtype=torch.float32)
+
+    assert U.dtype == torch.bfloat16 and L.dtype == torch.bfloat16
+    assert torch.all(L[..., :-1].abs() >= L[..., 1:].abs())
+    assert torch.all(torch.sum(U.float(), dim=-2) >= 0)
+
+
+@pytest.mark.parametrize("dtype_policy", [
+    DtypePolicy(),
+    DtypePolicy(eig_dtype=torch.float64),
+    MIXED_PRECISION_POLICY,
+])
+def test_nystrom_ncut_dtype_policy(dtype_policy):
+    torch.manual_seed(0)
+    features = torch.randn((500, 16))
+    model = NystromNCut(
+        n_components=5,
+        sample_config=SampleConfig(method="random", num_sample=100),
+        eig_solver="eigh",
+        dtype_policy=dtype_policy,
+    )
+    V = model.fit_transform(features)
+    eigenvalues = model.base_transformer.eigenvalues_
+
+    assert V.shape == (500, 5)
+    assert V.dtype == (dtype_policy.accumulate_dtype or features.dtype)
+    assert torch.all(torch.isfinite(V))
+    assert torch.all(eigenvalues[..., :-1].abs() >= eigenvalues[..., 1:].abs())
+
+
+def test_mixed_precision_affinities_stay_in_compute_dtype():
+    torch.manual_seed(0)
+    features = torch.randn((500, 16))
+    model = NystromNCut(
+        n_components=5,
+        sample_config=SampleConfig(method="random", num_sample=100),
+        eig_solver="eigh",
+        dtype_policy=MIXED_PRECISION_POLICY,
+    )
+    model.fit(features)
+    kernel = model.base_transformer.kernel
+
+    assert kernel.A.dtype == torch.float32
+    assert kernel.transform(features).dtype == torch.bfloat16
+    assert model.transform(features).dtype == torch.float32
+    V_reference = model.base_transformer.transform(features[:10])
+    torch.testing.assert_close(model.transform(features)[:10], V_reference)
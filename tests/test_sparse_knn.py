@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from nystrom_ncut import NystromNCut, SampleConfig
+from nystrom_ncut.nystrom.nystrom_utils import SparseLowRankMatrix, solve_eig
+
+
+def _as_sparse(A: torch.Tensor) -> SparseLowRankMatrix:
+    bsz, n = A.shape[0], A.shape[-1]
+    rows, cols = torch.meshgrid(torch.arange(n), torch.arange(n), indexing="ij")
+    return SparseLowRankMatrix.from_coo(
+        rows.flatten().expand((bsz, -1)), cols.flatten().expand((bsz, -1)), A.flatten(-2, -1), A.shape,
+    )
+
+
+def _matrix_with_spectrum(spectrum: torch.Tensor, bsz: int = 2) -> torch.Tensor:
+    torch.manual_seed(0)
+    Q = torch.linalg.qr(torch.randn((bsz, len(spectrum), len(spectrum)), dtype=torch.float64)).Q
+    return Q @ torch.diag_embed(spectrum.expand((bsz, -1))) @ Q.mT
+
+
+def test_sparse_solve_eig_matches_dense():
+    A = _matrix_with_spectrum(torch.cat((torch.tensor([10.0, 8.0, 6.0, 4.0]), torch.rand((76,)))).double())
+    U, L = solve_eig(_as_sparse(A), num_eig=4, eig_solver="eigh")
+
+    reference = torch.linalg.eigvalsh(A).flip(-1)[..., :4]
+    torch.testing.assert_close(L, reference, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(torch.linalg.norm(A @ U - U * L[..., None, :], dim=-2), torch.zeros_like(L), atol=1e-2, rtol=0.0)
+
+
+def test_sparse_solve_eig_warns_when_not_converged():
+    A = _matrix_with_spectrum(torch.linspace(1.0, 0.9, 80, dtype=torch.float64))
+    with pytest.warns(UserWarning, match="did not converge"):
+        solve_eig(_as_sparse(A), num_eig=4, eig_solver="eigh", sparse_n_iter=1, sparse_max_iter=1)
+
+
+def test_sparse_knn_eigenvalues_match_dense():
+    torch.manual_seed(0)
+    features = torch.randn((600, 16), dtype=torch.float64)
+    indices = torch.randperm(600)[:100]
+
+    models = {}
+    for sparse_knn in (None, 100):
+        models[sparse_knn] = NystromNCut(
+            n_components=5,
+            sample_config=SampleConfig(method="random", num_sample=100),
+            eig_solver="eigh",
+            sparse_knn=sparse_knn,
+        )
+        models[sparse_knn].fit(features, precomputed_sampled_indices=indices)
+    # keeping every neighbor reproduces the dense anchor graph, so only the solvers differ
+    torch.testing.assert_close(
+        models[100].base_transformer.eigenvalues_, models[None].base_transformer.eigenvalues_, rtol=1e-3, atol=1e-3,
+    )
@@ -0,0 +1,50 @@
+import torch
+
+from nystrom_ncut import KernelNCut, NystromNCut, SampleConfig
+from nystrom_ncut.common import StateDictMixin
+
+
+def test_nystrom_ncut_save_load(tmp_path):
+    torch.manual_seed(0)
+    features = torch.randn((500, 16))
+    model = NystromNCut(n_components=5, sample_config=SampleConfig(method="random", num_sample=100), eig_solver="eigh")
+    model.fit(features)
+
+    path = tmp_path / "model.pt"
+    model.save(path)
+    loaded = NystromNCut.load(path)
+
+    assert type(loaded) is NystromNCut
+    torch.testing.assert_close(loaded.transform(features), model.transform(features))
+    torch.testing.assert_close(loaded.anchor_indices, model.anchor_indices)
+
+
+def test_kernel_ncut_save_load(tmp_path):
+    torch.manual_seed(0)
+    features = torch.randn((500, 16))
+    model = KernelNCut(n_components=5, kernel_dim=64, sample_config=SampleConfig(method="random", num_sample=100))
+    model.fit(features)
+
+    path = tmp_path / "model.pt"
+    model.save(path)
+    loaded = StateDictMixin.load(path, mmap=False)
+
+    assert type(loaded) is KernelNCut
+    torch.testing.assert_close(loaded.transform(features), model.transform(features))
+
+
+def test_fps_recursive_load_then_update(tmp_path):
+    torch.manual_seed(0)
+    features = torch.randn((600, 16))
+    model = NystromNCut(n_components=5, sample_config=SampleConfig(method="fps_recursive", num_sample=100, n_iter=2))
+    model.fit(features)
+
+    path = tmp_path / "model.pt"
+    model.save(path)
+    loaded = NystromNCut.load(path)
+    assert loaded.sample_config._recursive_obj is not None
+
+    new_features = torch.randn((200, 16))
+    torch.testing.assert_close(loaded.update(new_features), model.update(new_features))
+    V = loaded.fit_transform(features)
+    assert V.shape == (600, 5) and torch.all(torch.isfinite(V))
@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from nystrom_ncut import NystromNCut, SampleConfig
+
+
+def _model() -> NystromNCut:
+    return NystromNCut(n_components=5, sample_config=SampleConfig(method="random", num_sample=100), eig_solver="eigh")
+
+
+@pytest.mark.parametrize("as_chunks", [False, True])
+def test_fit_transform_stream_matches_in_memory(as_chunks):
+    torch.manual_seed(0)
+    features = torch.randn((1000, 16), dtype=torch.float64)
+    source = list(torch.split(features, 128, dim=-2)) if as_chunks else features
+
+    streamed = _model()
+    V_stream = streamed.fit_transform_stream(source, chunk_size=128)
+
+    in_memory = _model()
+    V = in_memory.fit_transform(features, precomputed_sampled_indices=streamed.anchor_indices)
+    torch.testing.assert_close(V_stream, V)
+
+
+def test_fit_transform_stream_accepts_factory():
+    torch.manual_seed(0)
+    features = torch.randn((600, 16), dtype=torch.float64)
+    torch.manual_seed(1)
+    V_list = _model().fit_transform_stream(list(torch.split(features, 100, dim=-2)), chunk_size=100)
+    torch.manual_seed(1)
+    V_factory = _model().fit_transform_stream(lambda: iter(torch.split(features, 100, dim=-2)), chunk_size=100)
+    torch.testing.assert_close(V_factory, V_list)
+
+
+def test_fit_transform_stream_rejects_generator():
+    features = torch.randn((600, 16))
+    with pytest.raises(TypeError):
+        _model().fit_transform_stream(chunk for chunk in torch.split(features, 100, dim=-2))
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from nystrom_ncut import CallbackSink, NystromNCut, SampleConfig, profiling
+
+
+def _model(warm_start: bool) -> NystromNCut:
+    return NystromNCut(
+        n_components=5,
+        sample_config=SampleConfig(method="random", num_sample=50),
+        eig_solver="eigh",
+        warm_start=warm_start,
+        temporal=True,
+    )
+
+
+@pytest.mark.parametrize("warm_start", [False, True])
+def test_padded_frame_keeps_anchors(warm_start):
+    torch.manual_seed(0)
+    features = torch.randn((400, 16), dtype=torch.float64)
+    padded = torch.cat((features, torch.full((100, 16), torch.nan, dtype=torch.float64)), dim=-2)
+
+    model = _model(warm_start)
+    model.fit(features)
+    anchor_features = model.anchor_features.clone()
+    V = model.fit_transform(padded)
+
+    # padding rows are never the nearest point of an anchor, so an unchanged frame replaces no anchor
+    torch.testing.assert_close(model.anchor_features, anchor_features)
+    assert V.shape == (500, 5)
+    assert torch.all(torch.isfinite(V[:400]))
+
+
+@pytest.mark.parametrize("warm_start", [False, True])
+def test_drifted_frame_replaces_anchors(warm_start):
+    torch.manual_seed(0)
+    features = torch.randn((400, 16), dtype=torch.float64)
+    shifted = features.clone()
+    shifted[200:] += 10.0
+
+    model = _model(warm_start)
+    model.fit(features)
+    anchor_features = model.anchor_features.clone()
+    V = model.fit_transform(shifted)
+
+    num_replaced = torch.sum(torch.any(model.anchor_features != anchor_features, dim=-1)).item()
+    assert 0 < num_replaced <= int(model.max_drift_fraction * 50)
+    # new anchors are rows of the frame whose outputs come from the anchor embedding instead of update
+    assert V.shape == (400, 5)
+    assert torch.all(torch.isfinite(V))
+
+
+def test_unchanged_frame_skips_eigensolves():
+    torch.manual_seed(0)
+    features = torch.randn((400, 16), dtype=torch.float64)
+    model = _model(warm_start=False)
+    model.fit(features)
+
+    records = []
+    with profiling(CallbackSink(records.append)):
+        V = model.fit_transform(features)
+    names = [record.name for record in records]
+    # only the eigensolves of the update itself remain, the anchor eigenproblems are restored
+    assert "LaplacianKernel.solve_eig" not in names
+    assert names.count("OnlineNystrom.solve_eig") == 2
+    assert torch.all(torch.isfinite(V))
+
+
+def test_coverage_radius_follows_replaced_anchors():
+    torch.manual_seed(0)
+    features = torch.randn((400, 16), dtype=torch.float64)
+    model = _model(warm_start=False)
+    model.fit(features)
+    coverage_radius = model.coverage_radius.clone()
+
+    shifted = features.clone()
+    shifted[200:] += 10.0
+    model.fit_transform(shifted)
+    assert not torch.equal(model.coverage_radius, coverage_radius)